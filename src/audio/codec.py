@@ -0,0 +1,106 @@
+import wave
+from enum import Enum
+from io import BytesIO
+from typing import BinaryIO, List, Optional, Tuple
+from pydub import AudioSegment
+
+
+class UploadTier(Enum):
+    # (file name, mime type, approximate bytes per second of audio)
+    Pcm = ("record.wav", "audio/wav", 44100 * 2 * 2)
+    PcmMono16k = ("record.wav", "audio/wav", 16000 * 2)
+    Opus32k = ("record.ogg", "audio/ogg", 32000 // 8)
+    Opus12k = ("record.ogg", "audio/ogg", 12000 // 8)
+
+    def __init__(self, file_name: str, mime_type: str, bytes_per_second: int):
+        self.file_name = file_name
+        self.mime_type = mime_type
+        self.bytes_per_second = bytes_per_second
+
+
+class ReplyFormat(Enum):
+    # (config name, mime types, ffmpeg demuxer)
+    Wav = ("wav", ("audio/wav", "audio/x-wav", "audio/wave"), "wav")
+    Opus = ("opus", ("audio/ogg", "audio/opus"), "ogg")
+    Flac = ("flac", ("audio/flac", "audio/x-flac"), "flac")
+    Mp3 = ("mp3", ("audio/mpeg", "audio/mp3"), "mp3")
+
+    def __init__(self, config_name: str, mime_types: Tuple[str, ...], demuxer: str):
+        self.config_name = config_name
+        self.mime_types = mime_types
+        self.demuxer = demuxer
+
+
+def reply_format_from_name(name: str) -> Optional[ReplyFormat]:
+    for reply_format in ReplyFormat:
+        if reply_format.config_name == name:
+            return reply_format
+    return None
+
+
+def reply_format_from_content_type(content_type: str) -> ReplyFormat:
+    # Anything unknown is treated as WAV, as before negotiation existed.
+    mime_type = content_type.split(";")[0].strip().lower()
+    for reply_format in ReplyFormat:
+        if mime_type in reply_format.mime_types:
+            return reply_format
+    return ReplyFormat.Wav
+
+
+def accept_header(reply_formats: List[ReplyFormat]) -> str:
+    # Preferred formats first; WAV is always acceptable as the fallback.
+    accepts = []
+    for i, reply_format in enumerate(reply_formats):
+        if reply_format != ReplyFormat.Wav:
+            accepts.append(f"{reply_format.mime_types[0]};q={1 - i / 10:.1f}")
+    accepts.append(f"{ReplyFormat.Wav.mime_types[0]};q=0.1")
+    return ", ".join(accepts)
+
+
+def wav_seconds(file: BinaryIO) -> Optional[float]:
+    position = file.tell()
+    try:
+        with wave.open(file, "rb") as wf:
+            return wf.getnframes() / wf.getframerate()
+    except (wave.Error, EOFError):
+        return None
+    finally:
+        file.seek(position)
+
+
+def choose_tier(
+    audio_seconds: float,
+    throughput: Optional[float],
+    rtt: Optional[float],
+    target_seconds: float,
+) -> UploadTier:
+    # Without a throughput estimate, send what was recorded.
+    if throughput is None:
+        return UploadTier.Pcm
+    for tier in UploadTier:
+        predicted = (rtt or 0) + audio_seconds * tier.bytes_per_second / throughput
+        if predicted <= target_seconds:
+            return tier
+    return list(UploadTier)[-1]
+
+
+def encode(file: BinaryIO, tier: UploadTier) -> BinaryIO:
+    if tier == UploadTier.Pcm:
+        return file
+    position = file.tell()
+    audio = AudioSegment.from_file(file, "wav")
+    file.seek(position)
+    encoded = BytesIO()
+    if tier == UploadTier.PcmMono16k:
+        audio.set_channels(1).set_frame_rate(16000).export(encoded, format="wav")
+    else:
+        audio.set_channels(1).export(
+            encoded,
+            format="ogg",
+            codec="libopus",
+            bitrate=f"{tier.bytes_per_second * 8 // 1000}k",
+            parameters=["-application", "voip"],
+        )
+    encoded.seek(0)
+    encoded.name = tier.file_name
+    return encoded
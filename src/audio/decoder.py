@@ -0,0 +1,159 @@
+import os
+import shutil
+import subprocess
+import threading
+from time import monotonic
+from typing import BinaryIO, Optional
+from src.audio.codec import ReplyFormat
+from src.metrics.metrics import metrics
+from src.log.log import log
+
+
+FFMPEG = "ffmpeg"
+SAMPLE_WIDTH = 2  # s16le
+FEED_SIZE = 16 * 1024
+CPU_RATIO_BUCKETS = (0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1)
+
+
+class DecodeError(Exception):
+    def __init__(self, audio_format: ReplyFormat, returncode, stderr):
+        self.audio_format = audio_format
+        self.returncode = returncode
+        self.stderr = stderr
+
+    def __str__(self):
+        return f"ffmpeg failed to decode {self.audio_format.config_name} ({self.returncode}, {self.stderr})"
+
+
+def decoder_available() -> bool:
+    return shutil.which(FFMPEG) is not None
+
+
+def process_cpu_seconds(pid: int) -> Optional[float]:
+    # utime + stime of a (not yet reaped) child process.
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rpartition(")")[2].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+class StreamDecoder:
+    # Decodes compressed audio to PCM (s16le) with an ffmpeg child process.
+    # Input is fed from a thread while PCM is read out, so playback can start
+    # after the first chunk instead of after the whole reply is decoded.
+    def __init__(
+        self,
+        file: BinaryIO,
+        audio_format: ReplyFormat,
+        rate: int,
+        channels: int,
+        delta_volume: float = 0,
+    ):
+        self.logger = log.get_logger("Decoder")
+        self.file = file
+        self.audio_format = audio_format
+        self.rate = rate
+        self.channels = channels
+        self.delta_volume = delta_volume
+        self.process: Optional[subprocess.Popen] = None
+        self.feeder: Optional[threading.Thread] = None
+        self.eof = False
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.started_at = 0.0
+
+    def start(self):
+        self.started_at = monotonic()
+        self.process = subprocess.Popen(
+            [
+                FFMPEG,
+                "-hide_banner",
+                "-loglevel",
+                "error",
+                "-f",
+                self.audio_format.demuxer,
+                "-i",
+                "pipe:0",
+                "-af",
+                f"volume={self.delta_volume}dB",
+                "-f",
+                "s16le",
+                "-ac",
+                str(self.channels),
+                "-ar",
+                str(self.rate),
+                "pipe:1",
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        self.feeder = threading.Thread(
+            target=self.feed, name="Decoder-Feed", daemon=True
+        )
+        self.feeder.start()
+
+    def feed(self):
+        stdin = self.process.stdin
+        try:
+            while data := self.file.read(FEED_SIZE):
+                stdin.write(data)
+                self.input_bytes += len(data)
+        except (BrokenPipeError, ValueError):
+            # Decoder was stopped before the input was consumed.
+            pass
+        finally:
+            try:
+                stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def read(self, frames: int) -> bytes:
+        data = self.process.stdout.read(frames * self.channels * SAMPLE_WIDTH)
+        if not data:
+            self.eof = True
+        self.output_bytes += len(data)
+        return data
+
+    def close(self):
+        process = self.process
+        if process is None:
+            return
+        stopped = not self.eof
+        if stopped:
+            process.kill()
+        else:
+            # Wait for exit without reaping, so the CPU time is still readable.
+            os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+        cpu_seconds = process_cpu_seconds(process.pid)
+        process.stdout.close()
+        stderr = process.stderr.read().decode(errors="replace").strip()
+        process.stderr.close()
+        returncode = process.wait()
+        self.feeder.join()
+        self.process = None
+
+        if stopped:
+            self.logger.info("Decoder stopped.")
+            return
+        if returncode != 0:
+            raise DecodeError(self.audio_format, returncode, stderr)
+        self.report(cpu_seconds)
+
+    def report(self, cpu_seconds: Optional[float]):
+        name = self.audio_format.config_name
+        audio_seconds = self.output_bytes / (self.rate * self.channels * SAMPLE_WIDTH)
+        elapsed = monotonic() - self.started_at
+        metrics.counter(f"decode.{name}.input_bytes").inc(self.input_bytes)
+        metrics.counter(f"decode.{name}.audio_seconds").inc(audio_seconds)
+        if cpu_seconds is not None:
+            metrics.counter(f"decode.{name}.cpu_seconds").inc(cpu_seconds)
+            if audio_seconds:
+                metrics.histogram(
+                    f"decode.{name}.cpu_ratio", CPU_RATIO_BUCKETS
+                ).observe(cpu_seconds / audio_seconds)
+        self.logger.info(
+            f"Decoded. ({name=}, {self.input_bytes=}, {audio_seconds=:.2f}, {cpu_seconds=}, {elapsed=:.3f}s)"
+        )
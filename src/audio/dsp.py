@@ -0,0 +1,66 @@
+import wave
+from io import BytesIO
+from typing import BinaryIO, Iterable, List
+from pydub import AudioSegment
+
+
+# Audio stages used by playback and recording. Kept free of config and
+# device imports so that they can be benchmarked offline (src/bench/audio.py).
+
+
+def decode_wav(file: BinaryIO) -> AudioSegment:
+    with wave.open(file, "rb") as wf:
+        return AudioSegment.from_raw(
+            file,
+            sample_width=wf.getsampwidth(),
+            frame_rate=wf.getframerate(),
+            channels=wf.getnchannels(),
+        )
+
+
+def resample(audio: AudioSegment, rate: int) -> AudioSegment:
+    return audio.set_frame_rate(rate)
+
+
+def gain(audio: AudioSegment, delta_volume: float) -> AudioSegment:
+    return audio + delta_volume
+
+
+def encode_wav(audio: AudioSegment) -> BytesIO:
+    file = BytesIO()
+    audio.export(file, format="wav")
+    file.seek(0)
+    return file
+
+
+def convert(file: BinaryIO, rate: int, delta_volume: float) -> BytesIO:
+    return encode_wav(gain(resample(decode_wav(file), rate), delta_volume))
+
+
+def voice_activity(
+    audio: AudioSegment, frame_ms: int = 30, threshold_dbfs: float = -45.0
+) -> List[bool]:
+    # Energy based: a frame is voiced when its level is above the threshold.
+    return [
+        audio[start : start + frame_ms].dBFS > threshold_dbfs
+        for start in range(0, len(audio), frame_ms)
+    ]
+
+
+def write_wav_chunks(
+    file: BinaryIO,
+    chunks: Iterable[bytes],
+    channels: int,
+    sample_width: int,
+    rate: int,
+) -> int:
+    # Same writes as RecordThread.record: header first, then one chunk at a time.
+    written = 0
+    with wave.open(file, "wb") as wf:
+        wf.setnchannels(channels)
+        wf.setsampwidth(sample_width)
+        wf.setframerate(rate)
+        for chunk in chunks:
+            wf.writeframes(chunk)
+            written += len(chunk)
+    return written
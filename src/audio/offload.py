@@ -0,0 +1,162 @@
+import json
+import os
+import select
+import subprocess
+import sys
+import threading
+from io import BytesIO
+from multiprocessing.shared_memory import SharedMemory
+from os import path
+from time import monotonic
+from typing import BinaryIO, Dict, Optional
+import src.config.config as config
+from src.audio import dsp
+from src.audio.codec import UploadTier, encode
+from src.metrics.metrics import metrics
+from src.log.log import log
+
+
+AUDIO_WORKER = config.get("audio_worker")
+ROOT_DIR = path.dirname(path.dirname(path.dirname(path.abspath(__file__))))
+STOP_TIMEOUT = 3
+JOB_TIMEOUT = 30  # a worker that takes longer is considered hung
+
+
+class WorkerError(Exception):
+    pass
+
+
+class AudioWorker:
+    # Client of the audio worker process (src/audio/worker.py). Jobs are run
+    # one at a time; the calling thread blocks on the pipe without holding the
+    # GIL, so the asyncio loop is not slowed down by the DSP itself. If the
+    # worker is disabled or fails, the job runs in this process instead.
+    def __init__(self, enabled: bool = AUDIO_WORKER):
+        self.logger = log.get_logger("AudioWorker")
+        self.enabled = enabled
+        self.process: Optional[subprocess.Popen] = None
+        self.lock = threading.Lock()
+        self.logger.info(f"Initialized. ({enabled=})")
+
+    def start(self):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.ensure_started()
+
+    def ensure_started(self) -> subprocess.Popen:
+        if self.process is not None and self.process.poll() is None:
+            return self.process
+        if self.process is not None:
+            self.logger.warn(f"Audio worker exited. Restart. ({self.process.returncode=})")
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "src.audio.worker"],
+            cwd=ROOT_DIR,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        self.logger.info(f"Audio worker started. ({self.process.pid=})")
+        return self.process
+
+    def run_job(self, job: str, data: bytes, args: Dict) -> bytes:
+        started_at = monotonic()
+        with self.lock:
+            process = self.ensure_started()
+            shm = SharedMemory(create=True, size=max(len(data), 1))
+            try:
+                shm.buf[: len(data)] = data
+                request = {"job": job, "input": shm.name, "size": len(data), "args": args}
+                process.stdin.write(json.dumps(request).encode() + b"\n")
+                process.stdin.flush()
+                line = self.read_line(process, JOB_TIMEOUT)
+            except (BrokenPipeError, ValueError) as e:
+                raise WorkerError(f"audio worker is not running ({e})")
+            except TimeoutError:
+                # Kill it so that the next job gets a fresh worker.
+                self.logger.error(f"Audio worker hung. Kill. ({job=}, {JOB_TIMEOUT=})")
+                self.kill(process)
+                raise WorkerError("audio worker timed out")
+            finally:
+                shm.close()
+                shm.unlink()
+        if not line:
+            raise WorkerError("audio worker exited")
+
+        try:
+            reply = json.loads(line)
+            if "error" in reply:
+                raise WorkerError(reply["error"])
+            output = SharedMemory(reply["output"])
+            size = int(reply["size"])
+        except (json.JSONDecodeError, KeyError, TypeError, ValueError, OSError) as e:
+            raise WorkerError(f"bad reply from audio worker ({e!r})")
+        try:
+            result = bytes(output.buf[:size])
+        finally:
+            output.close()
+            output.unlink()
+        metrics.histogram(f"audio_worker.{job}.seconds").observe(monotonic() - started_at)
+        return result
+
+    def read_line(self, process: subprocess.Popen, timeout: float) -> bytes:
+        # readline() with a deadline; empty if the worker exited.
+        fd = process.stdout.fileno()
+        deadline = monotonic() + timeout
+        line = b""
+        while not line.endswith(b"\n"):
+            remaining = deadline - monotonic()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                raise TimeoutError
+            data = os.read(fd, 64 * 1024)
+            if not data:
+                return b""
+            line += data
+        return line
+
+    def kill(self, process: subprocess.Popen):
+        process.kill()
+        process.wait()
+
+    def convert(self, file: BinaryIO, rate: int, delta_volume: float) -> BytesIO:
+        data = file.read()
+        if self.enabled:
+            try:
+                return BytesIO(
+                    self.run_job(
+                        "convert", data, {"rate": rate, "delta_volume": delta_volume}
+                    )
+                )
+            except WorkerError as e:
+                self.logger.warn(f"Audio worker failed. Convert in process. ({e})")
+        return dsp.convert(BytesIO(data), rate, delta_volume)
+
+    def encode(self, file: BinaryIO, tier: UploadTier) -> BinaryIO:
+        if tier == UploadTier.Pcm:
+            return file
+        if self.enabled:
+            position = file.tell()
+            data = file.read()
+            file.seek(position)
+            try:
+                encoded = BytesIO(self.run_job("encode", data, {"tier": tier.name}))
+                encoded.name = tier.file_name
+                return encoded
+            except WorkerError as e:
+                self.logger.warn(f"Audio worker failed. Encode in process. ({e})")
+        return encode(file, tier)
+
+    def stop(self):
+        with self.lock:
+            process = self.process
+            self.process = None
+        if process is None or process.poll() is not None:
+            return
+        process.stdin.close()
+        try:
+            process.wait(STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self.kill(process)
+        self.logger.info("Audio worker stopped.")
+
+
+audio_worker = AudioWorker()
@@ -0,0 +1,79 @@
+# Audio worker process: runs CPU heavy audio jobs away from the asyncio
+# process (see src/audio/offload.py for the client).
+#
+#   python -m src.audio.worker
+#
+# One JSON request per line on stdin, one JSON reply per line on stdout.
+# Audio is passed in shared memory blocks, not through the pipe:
+#   {"job": "convert", "input": <shm name>, "size": n, "args": {...}}
+#   -> {"output": <shm name>, "size": n} or {"error": "..."}
+# The caller owns (and unlinks) both the input and the output blocks.
+#
+# Keep imports free of config and devices; this process must not touch them.
+import json
+import os
+import sys
+import traceback
+from io import BytesIO
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable, Dict
+from src.audio import dsp
+from src.audio.codec import UploadTier, encode
+
+
+NICE = 5  # below the main process, which handles buttons, LED and network
+
+
+def untrack(shm: SharedMemory):
+    # The block is owned by the other process; do not unlink it at exit.
+    resource_tracker.unregister(shm._name, "shared_memory")
+
+
+def read_input(name: str, size: int) -> bytes:
+    shm = SharedMemory(name)
+    try:
+        untrack(shm)
+        return bytes(shm.buf[:size])
+    finally:
+        shm.close()
+
+
+def write_output(data: bytes) -> str:
+    shm = SharedMemory(create=True, size=max(len(data), 1))
+    shm.buf[: len(data)] = data
+    untrack(shm)
+    shm.close()
+    return shm.name
+
+
+def convert_job(data: bytes, args: Dict) -> bytes:
+    return dsp.convert(BytesIO(data), args["rate"], args["delta_volume"]).getvalue()
+
+
+def encode_job(data: bytes, args: Dict) -> bytes:
+    return encode(BytesIO(data), UploadTier[args["tier"]]).read()
+
+
+jobs: Dict[str, Callable[[bytes, Dict], bytes]] = {
+    "convert": convert_job,
+    "encode": encode_job,
+}
+
+
+def serve():
+    os.nice(NICE)
+    for line in sys.stdin:
+        try:
+            request = json.loads(line)
+            data = read_input(request["input"], request["size"])
+            output = jobs[request["job"]](data, request.get("args", {}))
+            reply = {"output": write_output(output), "size": len(output)}
+        except Exception:
+            reply = {"error": traceback.format_exc()}
+        sys.stdout.write(json.dumps(reply) + "\n")
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    serve()
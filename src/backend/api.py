@@ -1,13 +1,32 @@
 import src.config.config as config
 import json
 from src.interface.led import led, LedPattern
-from io import BytesIO
+from src.interface.wifi import wifi, INTERFACE
+from src.backend.link import link_estimator
+from src.backend.inbox import inbox
+from src.audio.codec import (
+    ReplyFormat,
+    UploadTier,
+    accept_header,
+    choose_tier,
+    reply_format_from_content_type,
+    reply_format_from_name,
+    wav_seconds,
+)
+from src.audio.decoder import decoder_available
+from src.audio.offload import audio_worker
+from src.util.spool import Spool
+from src.metrics.metrics import metrics
+from src.diag.trace import tracer
+from os import path, remove, replace
+import re
+from time import monotonic
 from src.log.log import log
 import httpx
 import asyncio
 from websockets.asyncio.client import connect
 import websockets
-from typing import Literal, Optional
+from typing import BinaryIO, Callable, List, Literal, Optional, Tuple
 from enum import Enum, auto
 
 PING_INTERVAL = 10
@@ -17,6 +36,11 @@ ID = config.get("id")
 RETRIES = 4
 SENSOR_INTERVAL = 0.1
 TIMEOUT = 120
+ADAPTIVE_UPLOAD = config.get("adaptive_upload")
+CHUNKED_UPLOAD = config.get("chunked_upload")
+UPLOAD_PART_SIZE = config.get("upload_part_size")
+UPLOAD_TARGET_SECONDS = config.get("upload_target_seconds")
+REPLY_FORMATS = config.get("reply_formats")
 
 
 class Endpoint(Enum):
@@ -24,6 +48,7 @@ class Endpoint(Enum):
     Ping = auto()
     Normal = auto()
     Messages = auto()
+    Logs = auto()
 
 
 endpoints = {
@@ -31,46 +56,225 @@ endpoints = {
     Endpoint.Ping: "/ping",
     Endpoint.Normal: f"/v{VERSION}/raspis/{ID}",
     Endpoint.Messages: f"/v{VERSION}/raspis/{ID}/messages",
+    Endpoint.Logs: f"/v{VERSION}/raspis/{ID}/logs",
 }
 
 
+JSON_CONTENT_TYPES = ("application/json",)
+CONTENT_RANGE_PATTERN = re.compile(r"bytes (\d+)-(\d+)/(\d+|\*)")
+
+DownloadProgress = Callable[[int, Optional[int]], None]
+SPOOL_MAX_MEMORY = 1024 * 1024
+
+
+class ResourceGoneError(Exception):
+    # 404 or 410: retrying will not help.
+    def __init__(self, endpoint: str, status_code: int):
+        self.endpoint = endpoint
+        self.status_code = status_code
+
+    def __str__(self):
+        return f"{self.endpoint} returned {self.status_code}"
+
+
 class Response:
-    def __init__(self, response):
+    # Body is streamed into a Spool: kept in memory while small, spilled to a
+    # temp file when large. JSON is parsed lazily and only for JSON bodies.
+    # Close it once the body has been read; whoever takes .file owns it.
+    def __init__(self, status_code: int, headers: httpx.Headers, body: Spool):
         self.logger = log.get_logger("Response")
-        try:
-            self.json = response.json()
-        except (json.JSONDecodeError, UnicodeDecodeError):
-            self.json = None
-            self.logger.warn("Failed to get json from response.")
+        self.status_code = status_code
+        self.headers = headers
+        self.content_type = headers.get("content-type", "").split(";")[0].strip()
+        self.body = body
+        self.parsed_json = None
+        self.json_parsed = False
 
-        try:
-            self.file = BytesIO(response.content)
-        except httpx.ResponseNotRead:
-            self.file = None
-            self.logger.warn("Failed to file json from response.")
+    def is_json(self) -> bool:
+        return self.content_type in JSON_CONTENT_TYPES or self.content_type.endswith(
+            "+json"
+        )
+
+    @property
+    def json(self):
+        if not self.json_parsed:
+            self.json_parsed = True
+            if self.is_json():
+                try:
+                    self.body.seek(0)
+                    self.parsed_json = json.loads(self.body.read())
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    self.logger.warn("Failed to get json from response.")
+        return self.parsed_json
+
+    @property
+    def file(self) -> Spool:
+        self.body.seek(0)
+        return self.body
+
+    def size(self) -> int:
+        return self.body.size()
+
+    def view(self) -> memoryview:
+        return self.body.view()
+
+    def audio_format(self) -> ReplyFormat:
+        return reply_format_from_content_type(self.content_type)
+
+    def close(self):
+        self.body.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class TimedReader:
+    # Wraps an upload file and records when its last byte was handed to the
+    # HTTP client, so upload time excludes server processing time.
+    def __init__(self, file: BinaryIO):
+        self.file = file
+        self.finished_at: Optional[float] = None
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.file.read(size)
+        if not data or size < 0:
+            self.finished_at = self.finished_at or monotonic()
+        return data
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        self.finished_at = None
+        return self.file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self.file.tell()
 
 
 class Api:
     def __init__(self):
         self.logger = log.get_logger("Api")
         self.logger.info("Initialized.")
-        self.notified = False
-        self.message_id = None
+        self.client = httpx.AsyncClient(timeout=TIMEOUT)
+        self.download_retry_at = 0.0
         self.ws_rul = None
+        self.ws_task: Optional[asyncio.Task] = None
+        self.accept = self.get_accept_header()
+
+    def get_accept_header(self) -> str:
+        # Ask for compressed reply audio only when it can be decoded here.
+        reply_formats = []
+        for name in REPLY_FORMATS:
+            reply_format = reply_format_from_name(name)
+            if reply_format is None:
+                self.logger.warn(f"Unknown reply format. ({name=})")
+            else:
+                reply_formats.append(reply_format)
+        if reply_formats and not decoder_available():
+            self.logger.warn("ffmpeg not found. Accept WAV replies only.")
+            reply_formats = []
+        accept = accept_header(reply_formats)
+        self.logger.info(f"Reply audio negotiation. ({accept=})")
+        return accept
 
     # for ping, get message
     async def get(self, endpoint: str) -> Optional[Response]:
+        started_at = monotonic()
+        response = await self.request("GET", endpoint)
+        self.trace("GET", endpoint, started_at, response)
+        return response
+
+    async def post(
+        self,
+        endpoint: str,
+        audio_file=None,
+        tier: UploadTier = UploadTier.Pcm,
+        headers: Optional[dict] = None,
+        on_response: Optional[Callable[[], None]] = None,
+    ) -> Optional[Response]:
+        if audio_file:
+            size = audio_file.seek(0, 2)
+            audio_file.seek(0)
+            reader = TimedReader(audio_file)
+            files = {"file": (tier.file_name, reader, tier.mime_type)}
+        else:
+            size = 0
+            reader = None
+            files = None
+
+        started_at = monotonic()
+        response = await self.request(
+            "POST", endpoint, files=files, headers=headers, on_response=on_response
+        )
+        upload_seconds = None
+        if response is not None and reader is not None and reader.finished_at:
+            upload_seconds = elapsed = reader.finished_at - started_at
+            link_estimator.observe_upload(INTERFACE, size, elapsed)
+            self.logger.info(f"Uploaded. ({tier=}, {size=}, {elapsed=:.3f}s)")
+        self.trace("POST", endpoint, started_at, response, size, upload_seconds)
+        return response
+
+    def trace(
+        self,
+        method: str,
+        endpoint: str,
+        started_at: float,
+        response: Optional[Response],
+        request_bytes: int = 0,
+        upload_seconds: Optional[float] = None,
+    ):
+        tracer.event(
+            "http",
+            method=method,
+            endpoint=endpoint,
+            status=response.status_code if response else None,
+            request_bytes=request_bytes,
+            response_bytes=response.size() if response else None,
+            upload_seconds=upload_seconds,
+            elapsed=round(monotonic() - started_at, 4),
+            content_type=response.content_type if response else None,
+        )
+
+    async def request(
+        self,
+        method: str,
+        endpoint: str,
+        files=None,
+        content: Optional[bytes] = None,
+        json_body=None,
+        headers: Optional[dict] = None,
+        retries: int = RETRIES,
+        on_response: Optional[Callable[[], None]] = None,
+    ) -> Optional[Response]:
+        # on_response is called once the successful response starts arriving,
+        # before its body is read.
         url = f"{ORIGIN}{endpoint}"
-        for _ in range(RETRIES):
-            self.logger.info(f"Send GET HTTP Req. ({url=})")
+        for _ in range(retries):
+            self.logger.info(f"Send {method} HTTP Req. ({url=})")
             try:
-                async with httpx.AsyncClient() as client:
-                    response = await client.get(url, timeout=TIMEOUT)
-                    if response.status_code == httpx.codes.OK:
+                async with self.client.stream(
+                    method,
+                    url,
+                    files=files,
+                    content=content,
+                    json=json_body,
+                    headers=headers,
+                ) as response:
+                    if response.is_success:
                         self.logger.info(
                             f"Connection successful. ({url=}, {response.status_code=})"
                         )
-                        return Response(response)
+                        if on_response:
+                            on_response()
+                        body = Spool(SPOOL_MAX_MEMORY, name="response")
+                        try:
+                            async for chunk in response.aiter_bytes():
+                                body.write(chunk)
+                        except BaseException:
+                            body.close()
+                            raise
+                        return Response(response.status_code, response.headers, body)
                     else:
                         self.logger.warn(
                             f"Response has error code. Will be retry. ({url=}, {response.status_code=})"
@@ -79,40 +283,97 @@ class Api:
             except httpx.HTTPError:
                 self.logger.warn("HTTP error. Will be retry.")
                 continue
-        self.logger.error(f"HTTP error {RETRIES} times. Finish trying to connect.")
+        self.logger.error(
+            f"HTTP error {retries} times. Finish trying to connect.",
+            extra={"flight_dump": "api_retries_exhausted"},
+        )
         return None
 
-    async def post(self, endpoint: str, audio_file=None) -> Optional[Response]:
-        url = f"{ORIGIN}{endpoint}"
-        if audio_file:
-            files = {"file": ("record.wav", audio_file, "multipart/form-data")}
-        else:
-            files = None
+    async def upload_chunked(
+        self, endpoint: str, audio_file: BinaryIO, tier: UploadTier
+    ) -> Optional[Response]:
+        # Resumable upload in fixed-size parts (see src/backend/standin.py for
+        # the protocol). Each part is retried on its own and, after a failed
+        # round, only the parts the server is missing are sent again.
+        size = audio_file.seek(0, 2)
+        uploads_endpoint = f"{endpoint}/uploads"
+        response = await self.request(
+            "POST",
+            uploads_endpoint,
+            json_body={
+                "size": size,
+                "part_size": UPLOAD_PART_SIZE,
+                "file_name": tier.file_name,
+                "content_type": tier.mime_type,
+            },
+        )
+        session = None
+        if response is not None:
+            with response:
+                session = response.json
+        try:
+            upload_endpoint = f"{uploads_endpoint}/{session['upload_id']}"
+            part_size = int(session["part_size"])
+        except (KeyError, TypeError, ValueError):
+            self.logger.warn("Chunked upload is not available. Send in one request.")
+            return await self.post(endpoint, audio_file=audio_file, tier=tier)
 
+        parts = range((size + part_size - 1) // part_size)
+        # Only the part uploads count for the link estimate, not the status
+        # and commit round trips.
+        sent_bytes = 0
+        sent_seconds = 0.0
         for _ in range(RETRIES):
-            self.logger.info(f"Send GET HTTP Req. ({url=})")
-            try:
-                async with httpx.AsyncClient() as client:
-                    response = await client.post(url, files=files, timeout=TIMEOUT)
-                    if response.status_code == httpx.codes.OK:
-                        self.logger.info(
-                            f"Connection successful. ({url=}, {response.status_code=})"
-                        )
-                        return Response(response)
-                    else:
-                        self.logger.warn(
-                            f"Response has error code. Will be retry. ({url=}, {response.status_code=})"
-                        )
-                        continue
-            except httpx.HTTPError:
-                self.logger.warn("HTTP error. Will be retry.")
+            status = await self.get(upload_endpoint)
+            if status is None:
+                continue
+            with status:
+                status_json = status.json
+            if not isinstance(status_json, dict):
                 continue
-        self.logger.error(f"HTTP error {RETRIES} times. Finish trying to connect.")
+            received = set(status_json.get("received", []))
+            missing = [index for index in parts if index not in received]
+            self.logger.info(f"Upload parts. ({len(missing)=}, {len(parts)=})")
+            for index in missing:
+                audio_file.seek(index * part_size)
+                data = audio_file.read(part_size)
+                started_at = monotonic()
+                part = await self.request(
+                    "PUT", f"{upload_endpoint}/parts/{index}", content=data
+                )
+                if part is None:
+                    break
+                part.close()
+                sent_seconds += monotonic() - started_at
+                sent_bytes += len(data)
+                metrics.counter("upload.part_bytes").inc(len(data))
+            else:
+                response = await self.request("POST", f"{upload_endpoint}/commit")
+                if response is not None:
+                    if sent_bytes:
+                        link_estimator.observe_upload(
+                            INTERFACE, sent_bytes, sent_seconds
+                        )
+                    self.logger.info(
+                        f"Chunked upload completed. ({tier=}, {size=}, {sent_bytes=}, {sent_seconds=:.3f}s)"
+                    )
+                    return response
+        self.logger.error(
+            f"Chunked upload failed. ({size=}, {sent_bytes=})",
+            extra={"flight_dump": "api_retries_exhausted"},
+        )
         return None
 
+    async def close(self):
+        await self.client.aclose()
+
     async def wait_for_connect(self) -> Literal[True]:
         self.logger.info("Try to connect API")
         while True:
+            if wifi.is_disconnected():
+                self.logger.info("Wi-Fi is disconnected. Wait for Wi-Fi.")
+                await wifi.wait_for_change(PING_INTERVAL)
+                continue
             is_success = await self.ping()
             if is_success:
                 self.logger.info("Connected to API server.")
@@ -122,22 +383,34 @@ class Api:
                 await asyncio.sleep(PING_INTERVAL)
 
     async def ping(self) -> bool:
+        started_at = monotonic()
         response = await self.get(endpoints[Endpoint.Ping])
         if response is not None:
+            response.close()
+            link_estimator.observe_rtt(INTERFACE, monotonic() - started_at)
             self.logger.info("Ping success.")
             return True
         else:
             self.logger.info("Ping fail.")
             return False
 
-    async def normal(self, audio_file) -> Optional[BytesIO]:
+    async def normal(
+        self, audio_file, on_response: Optional[Callable[[], None]] = None
+    ) -> Optional[Response]:
         led.req(LedPattern.ApiProcessing)
         endpoint = endpoints[Endpoint.Normal]
-        response = await self.post(endpoint, audio_file=audio_file)
+        audio_file, tier = await self.prepare_upload(audio_file)
+        response = await self.post(
+            endpoint,
+            audio_file=audio_file,
+            tier=tier,
+            headers={"Accept": self.accept},
+            on_response=on_response,
+        )
         if response is not None:
-            response_file = response.file
+            self.observe_reply(response.audio_format(), response.size())
             led.req(LedPattern.ApiSuccess)
-            return response_file
+            return response
         else:
             led.req(LedPattern.ApiFail)
             return None
@@ -146,58 +419,246 @@ class Api:
         self.logger.info("Start Api.messages()")
         led.req(LedPattern.ApiPostingMessage)
         endpoint = endpoints[Endpoint.Messages]
-        response = await self.post(endpoint, audio_file=audio_file)
+        audio_file, tier = await self.prepare_upload(audio_file)
+        if CHUNKED_UPLOAD:
+            response = await self.upload_chunked(endpoint, audio_file, tier)
+        else:
+            response = await self.post(endpoint, audio_file=audio_file, tier=tier)
         if response is None:
             self.logger.info("Post message fail.")
             led.req(LedPattern.ApiFail)
             return False
         else:
+            response.close()
             self.logger.info("Post message success.")
             led.req(LedPattern.ApiSuccess)
             return True
 
-    async def req_get_message(self) -> bool:
-        endpoint = f"{endpoints[Endpoint.Messages]}/{self.message_id}"
-        response = await self.get(endpoint)
-        if response is not None:
-            self.message_file = response.file
-            self.logger.error("Success to get message.")
+    def observe_reply(self, audio_format: ReplyFormat, size: int):
+        name = audio_format.config_name
+        metrics.counter(f"reply.{name}.count").inc()
+        metrics.counter(f"reply.{name}.bytes").inc(size)
+        self.logger.info(f"Reply audio received. ({name=}, {size=})")
+
+    async def prepare_upload(self, audio_file) -> Tuple[BinaryIO, UploadTier]:
+        if not ADAPTIVE_UPLOAD:
+            return audio_file, UploadTier.Pcm
+        audio_seconds = wav_seconds(audio_file)
+        if audio_seconds is None:
+            return audio_file, UploadTier.Pcm
+
+        stats = link_estimator.get(INTERFACE)
+        tier = choose_tier(
+            audio_seconds, stats.throughput, stats.rtt, UPLOAD_TARGET_SECONDS
+        )
+        predicted = stats.predict_seconds(int(audio_seconds * tier.bytes_per_second))
+        self.logger.info(
+            f"Upload tier chosen. ({tier=}, {audio_seconds=:.2f}, {stats.throughput=}, {stats.rtt=}, {predicted=})"
+        )
+        if tier == UploadTier.Pcm:
+            return audio_file, tier
+        try:
+            return await asyncio.to_thread(audio_worker.encode, audio_file, tier), tier
+        except Exception as e:
+            self.logger.warn(f"Failed to encode upload. Send as recorded. ({e=})")
+            audio_file.seek(0)
+            return audio_file, UploadTier.Pcm
+
+    async def download(
+        self,
+        endpoint: str,
+        file_path: str,
+        on_progress: Optional[DownloadProgress] = None,
+        accept: Optional[str] = None,
+        wanted: Optional[Callable[[], bool]] = None,
+    ) -> Optional[str]:
+        # Resumable download: data goes to `<file_path>.part` and ETag/length/
+        # content type to `<file_path>.part.json`; retries (and restarts)
+        # continue with Range. Return the content type, or None on failure;
+        # raise ResourceGoneError when the resource does not exist. Once
+        # wanted() returns False, the part is deleted instead of kept.
+        url = f"{ORIGIN}{endpoint}"
+        started_at = monotonic()
+        part_path = f"{file_path}.part"
+        meta_path = f"{part_path}.json"
+        etag, total, content_type = None, None, ""
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            etag, total = meta["etag"], meta["total"]
+            content_type = meta.get("content_type", "")
+        except (FileNotFoundError, json.JSONDecodeError, KeyError, TypeError):
+            pass
+        offset = path.getsize(part_path) if path.exists(part_path) and total else 0
+
+        for _ in range(RETRIES):
+            if total is not None and offset >= total:
+                break
+            if wanted is not None and not wanted():
+                break
+            headers = {"Accept": accept} if accept else {}
+            if offset:
+                headers["Range"] = f"bytes={offset}-"
+                if etag:
+                    headers["If-Range"] = etag
+            self.logger.info(f"Send GET HTTP Req. ({url=}, {offset=}, {total=})")
+            try:
+                async with self.client.stream("GET", url, headers=headers) as response:
+                    response_etag = response.headers.get("etag")
+                    if response.status_code == httpx.codes.PARTIAL_CONTENT:
+                        match = CONTENT_RANGE_PATTERN.fullmatch(
+                            response.headers.get("content-range", "")
+                        )
+                        if (
+                            match is None
+                            or int(match[1]) != offset
+                            or (etag and response_etag and etag != response_etag)
+                        ):
+                            self.logger.warn("Invalid partial response. Restart.")
+                            offset, total, etag = 0, None, None
+                            continue
+                        if match[3] != "*":
+                            total = int(match[3])
+                    elif response.status_code == httpx.codes.OK:
+                        # Server ignored Range or the resource changed.
+                        offset = 0
+                        length = response.headers.get("content-length")
+                        total = int(length) if length else None
+                    elif response.status_code in (httpx.codes.NOT_FOUND, httpx.codes.GONE):
+                        raise ResourceGoneError(endpoint, response.status_code)
+                    elif (
+                        response.status_code
+                        == httpx.codes.REQUESTED_RANGE_NOT_SATISFIABLE
+                    ):
+                        self.logger.warn("Range not satisfiable. Restart.")
+                        offset, total, etag = 0, None, None
+                        continue
+                    else:
+                        self.logger.warn(
+                            f"Response has error code. Will be retry. ({url=}, {response.status_code=})"
+                        )
+                        continue
+
+                    etag = response_etag or etag
+                    content_type = response.headers.get("content-type", content_type)
+                    with open(meta_path, "w") as f:
+                        json.dump(
+                            {"etag": etag, "total": total, "content_type": content_type},
+                            f,
+                        )
+                    with open(part_path, "r+b" if offset else "wb") as f:
+                        f.seek(offset)
+                        f.truncate()
+                        async for chunk in response.aiter_bytes():
+                            f.write(chunk)
+                            offset += len(chunk)
+                            metrics.counter("download.bytes").inc(len(chunk))
+                            if total:
+                                metrics.set_gauge("download.progress", offset / total)
+                            if on_progress:
+                                on_progress(offset, total)
+                    if total is None:
+                        total = offset
+            except httpx.HTTPError:
+                metrics.counter("download.retries").inc()
+                self.logger.warn(f"HTTP error. Will be retry. ({offset=}, {total=})")
+                continue
+
+        if wanted is not None and not wanted():
+            self.logger.info(f"Download is no longer wanted. Discard. ({url=})")
+            for leftover in (part_path, meta_path):
+                try:
+                    remove(leftover)
+                except FileNotFoundError:
+                    pass
+            return None
+        if total is None or offset < total:
+            self.logger.error(
+                f"HTTP error {RETRIES} times. Finish trying to download. ({offset=}, {total=})",
+                extra={"flight_dump": "api_retries_exhausted"},
+            )
+            return None
+        replace(part_path, file_path)
+        remove(meta_path)
+        self.logger.info(f"Download completed. ({url=}, {total=}, {content_type=})")
+        tracer.event(
+            "http",
+            method="GET",
+            endpoint=endpoint,
+            status=httpx.codes.OK,
+            request_bytes=0,
+            response_bytes=total,
+            elapsed=round(monotonic() - started_at, 4),
+            content_type=content_type,
+        )
+        return content_type
+
+    async def req_get_message(
+        self, message_id: int, on_progress: Optional[DownloadProgress] = None
+    ) -> bool:
+        endpoint = f"{endpoints[Endpoint.Messages]}/{message_id}"
+        try:
+            content_type = await self.download(
+                endpoint,
+                inbox.message_path(message_id),
+                on_progress,
+                self.accept,
+                # Consumed or dropped meanwhile: nothing would track the file.
+                wanted=lambda: inbox.find(message_id) is not None,
+            )
+        except ResourceGoneError as e:
+            inbox.drop(message_id, str(e))
+            return False
+        if content_type is None and inbox.find(message_id) is None:
+            self.logger.info(f"Message left the inbox while downloading. ({message_id=})")
+            return False
+        if content_type is not None:
+            audio_format = reply_format_from_content_type(content_type)
+            inbox.mark_stored(message_id, audio_format)
+            self.observe_reply(
+                audio_format, path.getsize(inbox.message_path(message_id))
+            )
+            self.logger.info(f"Success to get message. ({message_id=})")
             return True
         else:
-            self.logger.error("Fail to get message.")
+            self.logger.error(f"Fail to get message. ({message_id=})")
+            inbox.mark_failed(message_id)
             return False
 
-    async def get_message(self) -> Optional[BytesIO]:
-        if not self.message_file:
-            response = await self.req_get_message()
-            if response is None:
-                return None
-        message_file = self.message_file
-        self.notified = False
-        self.message_file = None
-        return message_file
+    async def download_messages(
+        self, on_progress: Optional[DownloadProgress] = None
+    ) -> List[int]:
+        # Return downloaded message ids in the order they were received. A
+        # failed message is retried later and does not block the others.
+        for message_id in inbox.not_downloaded():
+            if not inbox.has_room():
+                self.logger.info(f"Message cache is full. ({inbox.stored_bytes()=})")
+                break
+            if not await self.req_get_message(message_id, on_progress):
+                self.download_retry_at = monotonic() + PING_INTERVAL
+        return inbox.downloaded()
 
     ### Notification
     async def init_notification_connection(self) -> Literal[True]:
         self.logger.info("Get WebSocket url.")
         endpoint = endpoints[Endpoint.WsNegotiate]
-        response = await self.post(endpoint)
         while True:
+            response = await self.post(endpoint)
             try:
-                if response is None or response.json is None:
-                    continue
-                else:
-                    self.ws_url = response.json["url"]
-                    return True
+                if response is not None:
+                    with response:
+                        if response.json is not None:
+                            self.ws_url = response.json["url"]
+                            return True
             except KeyError:
                 self.logger.error("Key('url') not found")
-                continue
+            self.logger.info("Failed to get WebSocket url. Retry.")
+            await asyncio.sleep(PING_INTERVAL)
 
     async def wait_for_notification(self):
         self.logger.debug("Wait for notification.")
-        while not self.notified:
+        while not inbox.pending() or monotonic() < self.download_retry_at:
             await asyncio.sleep(SENSOR_INTERVAL)
-        await self.req_get_message()
 
     async def start_listening_notifications(self):
         self.logger.info("Establish a WebSocket connection.")
@@ -206,7 +667,8 @@ class Api:
 
     async def stop_listening_notifications(self):
         self.logger.info("Close WebSocket connection.")
-        self.ws_task.cancel()
+        if self.ws_task:
+            self.ws_task.cancel()
 
     async def run_websockets(self):
         while True:
@@ -217,12 +679,12 @@ class Api:
                     while True:
                         self.logger.info("Listening notification.")
                         json_str = await ws.recv()
+                        tracer.event("ws", data=json_str)
                         try:
                             json_obj = json.loads(json_str)
                             if json_obj["type"] == "message":
-                                self.message_id = int(json_obj["id"])
-                                self.notified = True
                                 self.logger.info("Message notified.")
+                                inbox.add(int(json_obj["id"]))
                             else:
                                 self.logger.info(f"Other data notified.{json_str}")
                         except (json.JSONDecodeError, KeyError):
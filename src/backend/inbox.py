@@ -0,0 +1,161 @@
+from typing import BinaryIO, List, NotRequired, Optional, TypedDict
+from os import makedirs, path, remove, replace
+from time import time
+import json
+import src.config.config as config
+from src.audio.codec import ReplyFormat, reply_format_from_name
+from src.log.log import log
+
+
+CACHE_DIR = config.get("cache_dir")
+CACHE_MAX_BYTES = config.get("message_cache_max_bytes")
+INBOX_FILE_PATH = path.join(CACHE_DIR, "inbox.json")
+MESSAGES_DIR = path.join(CACHE_DIR, "messages")
+CONSUMED_HISTORY = 100  # to ignore duplicated notifications
+MAX_DOWNLOAD_ATTEMPTS = 5
+
+
+class InboxMessage(TypedDict):
+    id: int
+    received_at: float
+    size: Optional[int]  # None until downloaded
+    format: NotRequired[str]  # ReplyFormat.config_name of the stored audio
+    attempts: NotRequired[int]  # failed downloads
+
+
+class Inbox:
+    def __init__(self):
+        self.logger = log.get_logger("Inbox")
+        self.messages: List[InboxMessage] = []
+        self.consumed: List[int] = []
+        self.load()
+        self.logger.info(f"Initialized. ({len(self.messages)=})")
+
+    def load(self):
+        makedirs(MESSAGES_DIR, exist_ok=True)
+        try:
+            with open(INBOX_FILE_PATH) as f:
+                data = json.load(f)
+            self.messages = data["messages"]
+            self.consumed = data["consumed"]
+        except FileNotFoundError:
+            return
+        except (json.JSONDecodeError, KeyError, TypeError):
+            self.logger.error("Broken inbox file. Start with an empty inbox.")
+            self.messages = []
+            self.consumed = []
+
+        for message in self.messages:
+            if message["size"] is not None and not path.exists(
+                self.message_path(message["id"])
+            ):
+                message["size"] = None
+
+    def save(self):
+        temp_path = f"{INBOX_FILE_PATH}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump({"messages": self.messages, "consumed": self.consumed}, f)
+        replace(temp_path, INBOX_FILE_PATH)
+
+    def message_path(self, message_id: int) -> str:
+        # The audio may be WAV or compressed; see format().
+        return path.join(MESSAGES_DIR, f"{message_id}.audio")
+
+    def find(self, message_id: int) -> Optional[InboxMessage]:
+        for message in self.messages:
+            if message["id"] == message_id:
+                return message
+        return None
+
+    def add(self, message_id: int) -> bool:
+        if message_id in self.consumed or self.find(message_id):
+            self.logger.info(f"Already in inbox. ({message_id=})")
+            return False
+        self.messages.append({"id": message_id, "received_at": time(), "size": None})
+        self.save()
+        self.logger.info(f"Message added. ({message_id=}, {len(self.messages)=})")
+        return True
+
+    def pending(self) -> List[InboxMessage]:
+        return list(self.messages)
+
+    def not_downloaded(self) -> List[int]:
+        return [message["id"] for message in self.messages if message["size"] is None]
+
+    def downloaded(self) -> List[int]:
+        return [
+            message["id"] for message in self.messages if message["size"] is not None
+        ]
+
+    def stored_bytes(self) -> int:
+        return sum(message["size"] or 0 for message in self.messages)
+
+    def has_room(self) -> bool:
+        # Every stored message is still waiting to be played, so nothing is
+        # evicted; further downloads wait until played ones are consumed.
+        return self.stored_bytes() < CACHE_MAX_BYTES
+
+    def mark_stored(self, message_id: int, audio_format: ReplyFormat):
+        # Called once the audio is complete at message_path().
+        message = self.find(message_id)
+        if message is None:
+            return
+        size = path.getsize(self.message_path(message_id))
+        message["size"] = size
+        message["format"] = audio_format.config_name
+        message.pop("attempts", None)
+        self.save()
+        self.logger.info(f"Message stored. ({message_id=}, {size=}, {audio_format=})")
+
+    def mark_failed(self, message_id: int):
+        # Give up on a message after MAX_DOWNLOAD_ATTEMPTS failed downloads,
+        # so that it does not hold back the others forever.
+        message = self.find(message_id)
+        if message is None:
+            return
+        message["attempts"] = message.get("attempts", 0) + 1
+        if message["attempts"] >= MAX_DOWNLOAD_ATTEMPTS:
+            self.drop(message_id, f"failed {message['attempts']} times")
+        else:
+            self.save()
+
+    def drop(self, message_id: int, reason: str):
+        # For messages that can never be played.
+        if self.find(message_id) is None:
+            return
+        self.logger.warn(f"Drop message. ({message_id=}, {reason=})")
+        self.consume(message_id)
+
+    def format(self, message_id: int) -> ReplyFormat:
+        message = self.find(message_id)
+        name = message.get("format") if message else None
+        return reply_format_from_name(name or "") or ReplyFormat.Wav
+
+    def open(self, message_id: int) -> BinaryIO:
+        return open(self.message_path(message_id), "rb")
+
+    def consume(self, message_id: int):
+        message = self.find(message_id)
+        if message is None:
+            return
+        self.messages.remove(message)
+        self.consumed = (self.consumed + [message_id])[-CONSUMED_HISTORY:]
+        self.remove_audio(message_id)
+        self.save()
+        self.logger.info(f"Message consumed. ({message_id=}, {len(self.messages)=})")
+
+    def remove_audio(self, message_id: int):
+        message_path = self.message_path(message_id)
+        # Partial downloads are left by Api.download next to the audio.
+        for file_path in (
+            message_path,
+            f"{message_path}.part",
+            f"{message_path}.part.json",
+        ):
+            try:
+                remove(file_path)
+            except FileNotFoundError:
+                pass
+
+
+inbox = Inbox()
@@ -0,0 +1,56 @@
+from typing import Dict, Optional
+from src.log.log import log
+
+
+SMOOTHING = 0.3  # EWMA weight of the newest sample
+MIN_TRANSFER_SECONDS = 0.01
+
+
+class LinkStats:
+    def __init__(self):
+        self.rtt: Optional[float] = None  # seconds
+        self.throughput: Optional[float] = None  # bytes/second
+        self.samples = 0
+
+    def update_rtt(self, rtt: float):
+        self.rtt = ewma(self.rtt, rtt)
+
+    def update_throughput(self, throughput: float):
+        self.throughput = ewma(self.throughput, throughput)
+        self.samples += 1
+
+    def predict_seconds(self, size: int) -> Optional[float]:
+        if self.throughput is None:
+            return None
+        return (self.rtt or 0) + size / self.throughput
+
+
+def ewma(old: Optional[float], new: float) -> float:
+    return new if old is None else old + SMOOTHING * (new - old)
+
+
+class LinkEstimator:
+    def __init__(self):
+        self.logger = log.get_logger("LinkEstimator")
+        self.links: Dict[str, LinkStats] = {}
+
+    def get(self, link: str) -> LinkStats:
+        if link not in self.links:
+            self.links[link] = LinkStats()
+        return self.links[link]
+
+    def observe_rtt(self, link: str, elapsed: float):
+        stats = self.get(link)
+        stats.update_rtt(elapsed)
+        self.logger.debug(f"RTT observed. ({link=}, {elapsed=:.3f}, {stats.rtt=:.3f})")
+
+    def observe_upload(self, link: str, size: int, elapsed: float):
+        stats = self.get(link)
+        transfer_seconds = max(elapsed - (stats.rtt or 0), MIN_TRANSFER_SECONDS)
+        stats.update_throughput(size / transfer_seconds)
+        self.logger.debug(
+            f"Upload observed. ({link=}, {size=}, {elapsed=:.3f}, {stats.throughput=:.0f})"
+        )
+
+
+link_estimator = LinkEstimator()
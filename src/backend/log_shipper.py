@@ -0,0 +1,225 @@
+import asyncio
+import gzip
+import json
+from contextlib import contextmanager
+from os import makedirs, path, replace, stat
+from time import monotonic
+from typing import List, Optional, Tuple
+import httpx
+import src.config.config as config
+from src.backend.api import api, endpoints, Endpoint, ORIGIN
+from src.interface.wifi import wifi
+from src.metrics.metrics import metrics
+from src.log.log import log, LOG_FILE_NAME, LOG_BACKUP_COUNT
+
+
+LOG_SHIPPING = config.get("log_shipping")
+SHIP_INTERVAL = config.get("log_ship_interval")
+STATE_FILE_PATH = path.join(config.get("cache_dir"), "log_shipper.json")
+BATCH_MAX_BYTES = 256 * 1024
+BATCH_MIN_BYTES = 16 * 1024
+BACKLOG_MAX_BYTES = 4 * 1024 * 1024  # older records are skipped
+BATCH_GAP = 1.0  # between batches while catching up
+MAX_BACKOFF = 30 * 60
+SHIP_TIMEOUT = 30
+
+
+def log_files() -> List[str]:
+    # Oldest first, as rotated by SizeTimedRotatingFileHandler.
+    return [f"{LOG_FILE_NAME}.{i}" for i in range(LOG_BACKUP_COUNT, 0, -1)] + [
+        LOG_FILE_NAME
+    ]
+
+
+def inode(file_path: str) -> Optional[int]:
+    try:
+        return stat(file_path).st_ino
+    except FileNotFoundError:
+        return None
+
+
+class LogShipper:
+    # Uploads the JSON lines of the log file in gzip batches. The position is
+    # kept as (inode, offset) so that it survives restarts and rotation.
+    # Shipping waits while paused (a user turn is running) and backs off when
+    # the server fails or asks to slow down.
+    def __init__(self):
+        self.logger = log.get_logger("LogShipper")
+        self.inode: Optional[int] = None
+        self.offset = 0
+        self.batch_max_bytes = BATCH_MAX_BYTES
+        self.backoff = SHIP_INTERVAL
+        self.pauses = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.task: Optional[asyncio.Task] = None
+        self.upload_task: Optional[asyncio.Task] = None
+        self.load_state()
+        self.logger.info(f"Initialized. ({LOG_SHIPPING=}, {self.inode=}, {self.offset=})")
+
+    def load_state(self):
+        try:
+            with open(STATE_FILE_PATH) as f:
+                state = json.load(f)
+            self.inode, self.offset = state["inode"], state["offset"]
+        except FileNotFoundError:
+            return
+        except (json.JSONDecodeError, KeyError, TypeError):
+            self.logger.error("Broken log shipper state. Start from the current log.")
+
+    def save_state(self):
+        makedirs(path.dirname(STATE_FILE_PATH) or ".", exist_ok=True)
+        temp_path = f"{STATE_FILE_PATH}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump({"inode": self.inode, "offset": self.offset}, f)
+        replace(temp_path, STATE_FILE_PATH)
+
+    def locate(self) -> Optional[str]:
+        # Find the file holding the saved position, moving on to the next
+        # newer file once a rotated one is shipped completely.
+        files = [(file_path, inode(file_path)) for file_path in log_files()]
+        files = [(file_path, ino) for file_path, ino in files if ino is not None]
+        if not files:
+            return None
+        for i, (file_path, ino) in enumerate(files):
+            if ino != self.inode:
+                continue
+            if self.offset < path.getsize(file_path) or i == len(files) - 1:
+                return file_path
+            self.inode, self.offset = files[i + 1][1], 0
+            return self.locate()
+        # Position lost (first run, or rotated out): start at the current file.
+        self.inode, self.offset = files[-1][1], 0
+        return files[-1][0]
+
+    def read_batch(self) -> Optional[Tuple[bytes, int]]:
+        file_path = self.locate()
+        if file_path is None:
+            return None
+        size = path.getsize(file_path)
+        if size < self.offset:
+            # Truncated in place.
+            self.offset = 0
+        if size - self.offset > BACKLOG_MAX_BYTES:
+            skipped = size - BACKLOG_MAX_BYTES - self.offset
+            metrics.counter("log_ship.skipped_bytes").inc(skipped)
+            self.logger.warn(f"Log backlog too large. Skip old records. ({skipped=})")
+            self.offset = size - BACKLOG_MAX_BYTES
+
+        with open(file_path, "rb") as f:
+            if self.offset:
+                # Skip the rest of a partial line (after skipping the backlog).
+                f.seek(self.offset - 1)
+                if f.read(1) != b"\n":
+                    f.readline()
+            start = f.tell()
+            data = f.read(self.batch_max_bytes)
+        # Only complete lines; a single line longer than the batch goes as is.
+        end = data.rfind(b"\n") + 1
+        if end == 0 and len(data) < self.batch_max_bytes:
+            return None
+        data = data[:end] if end else data
+        if not data:
+            return None
+        return data, start + len(data)
+
+    async def ship_once(self) -> bool:
+        # Return True if there may be more to ship right away.
+        batch = self.read_batch()
+        if batch is None:
+            return False
+        data, next_offset = batch
+        body = await asyncio.to_thread(gzip.compress, data, 6)
+        started_at = monotonic()
+        try:
+            response = await api.client.post(
+                f"{ORIGIN}{endpoints[Endpoint.Logs]}",
+                content=body,
+                headers={
+                    "Content-Type": "application/x-ndjson",
+                    "Content-Encoding": "gzip",
+                },
+                timeout=SHIP_TIMEOUT,
+            )
+        except httpx.HTTPError as e:
+            self.fail(f"{e!r}")
+            return False
+
+        if response.status_code == httpx.codes.REQUEST_ENTITY_TOO_LARGE:
+            self.batch_max_bytes = max(self.batch_max_bytes // 2, BATCH_MIN_BYTES)
+            self.fail(f"Batch too large. ({self.batch_max_bytes=})")
+            return False
+        if not response.is_success:
+            retry_after = response.headers.get("retry-after", "")
+            self.fail(
+                f"{response.status_code=}",
+                float(retry_after) if retry_after.isdigit() else None,
+            )
+            return False
+
+        self.offset = next_offset
+        self.save_state()
+        self.backoff = SHIP_INTERVAL
+        metrics.counter("log_ship.bytes").inc(len(data))
+        metrics.counter("log_ship.compressed_bytes").inc(len(body))
+        self.logger.debug(
+            f"Logs shipped. ({len(data)=}, {len(body)=}, elapsed={monotonic() - started_at:.3f}s)"
+        )
+        return True
+
+    def fail(self, reason: str, retry_after: Optional[float] = None):
+        metrics.counter("log_ship.failures").inc()
+        self.backoff = min(max(self.backoff * 2, retry_after or 0), MAX_BACKOFF)
+        self.logger.warn(f"Failed to ship logs. ({reason}, {self.backoff=})")
+
+    async def run(self):
+        more = False
+        while True:
+            await asyncio.sleep(BATCH_GAP if more else self.backoff)
+            await self.idle.wait()
+            if wifi.is_disconnected():
+                more = False
+                continue
+            self.upload_task = asyncio.create_task(self.ship_once())
+            try:
+                more = await self.upload_task
+            except asyncio.CancelledError:
+                if self.task is None or self.task.cancelling():
+                    raise
+                # Paused by a user turn; the batch is sent again later.
+                more = False
+            finally:
+                self.upload_task = None
+
+    def start(self):
+        if not LOG_SHIPPING or self.task is not None:
+            return
+        self.logger.info("Start shipping logs.")
+        self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def pause(self):
+        self.pauses += 1
+        self.idle.clear()
+        if self.upload_task is not None:
+            self.upload_task.cancel()
+
+    def resume(self):
+        self.pauses = max(self.pauses - 1, 0)
+        if self.pauses == 0:
+            self.idle.set()
+
+    @contextmanager
+    def paused(self):
+        self.pause()
+        try:
+            yield
+        finally:
+            self.resume()
+
+
+log_shipper = LogShipper()
@@ -0,0 +1,194 @@
+# Local stand-in for the futarin backend, for trying the device code without
+# the real server:
+#
+#   python -m src.backend.standin --port 8000
+#
+# and set api_origin="http://127.0.0.1:8000" in futarin.toml.
+#
+# Chunked upload protocol (Api.upload_chunked):
+#   POST /v2/raspis/{id}/messages/uploads            {"size", "part_size", "file_name", "content_type"}
+#        -> {"upload_id", "part_size"}
+#   GET  /v2/raspis/{id}/messages/uploads/{upload_id} -> {"received": [part index, ...]}
+#   PUT  /v2/raspis/{id}/messages/uploads/{upload_id}/parts/{index}   (raw bytes)
+#   POST /v2/raspis/{id}/messages/uploads/{upload_id}/commit          -> {"id"}
+from argparse import ArgumentParser
+from collections import deque
+from os import path
+from typing import Deque, Dict, Iterable, Iterator, Optional
+import gzip
+import itertools
+import random
+import tempfile
+import threading
+import time
+import uuid
+from flask import Flask, abort, jsonify, request, send_file
+from src.log.log import log
+
+VERSION = 2
+PREFIX = f"/v{VERSION}/raspis/<int:raspi_id>"
+
+logger = log.get_logger("StandIn")
+
+
+class StandIn:
+    def __init__(self, data_dir: str, fail_rate: float = 0.0, reply_delay: float = 0.0):
+        self.data_dir = data_dir
+        # Drop this ratio of part uploads, and cut off this ratio of message
+        # downloads halfway through the body.
+        self.fail_rate = fail_rate
+        self.reply_delay = reply_delay  # seconds before answering a normal turn
+        self.reply_delays: Deque[float] = deque()  # per turn, used first (replay)
+        self.lock = threading.Lock()
+        self.message_ids = itertools.count(1)
+        self.uploads: Dict[str, Dict] = {}
+        self.ws_url = "ws://127.0.0.1:8001"
+
+    def message_path(self, message_id: int) -> str:
+        return path.join(self.data_dir, f"message-{message_id}.wav")
+
+    def save_message(self, data: bytes) -> int:
+        with self.lock:
+            message_id = next(self.message_ids)
+        with open(self.message_path(message_id), "wb") as f:
+            f.write(data)
+        logger.info(f"Message saved. ({message_id=}, {len(data)=})")
+        return message_id
+
+    def add_message(self, message_id: int, data: bytes):
+        # A message that exists before the session (replay); new ids follow it.
+        with self.lock:
+            with open(self.message_path(message_id), "wb") as f:
+                f.write(data)
+            self.message_ids = itertools.count(
+                max(message_id + 1, next(self.message_ids))
+            )
+
+    def next_reply_delay(self) -> float:
+        with self.lock:
+            return self.reply_delays.popleft() if self.reply_delays else self.reply_delay
+
+
+def truncated(chunks: Iterable[bytes], size: int) -> Iterator[bytes]:
+    # Sends the first `size` bytes, then drops the connection.
+    sent = 0
+    try:
+        for chunk in chunks:
+            yield chunk[: size - sent]
+            sent += len(chunk)
+            if sent >= size:
+                break
+    finally:
+        close = getattr(chunks, "close", None)
+        if close:
+            close()
+    raise ConnectionAbortedError("dropped by --fail-rate")
+
+
+def create_app(standin: StandIn) -> Flask:
+    app = Flask(__name__)
+
+    @app.get("/ping")
+    def ping():
+        return "pong"
+
+    @app.post(f"{PREFIX}/negotiate")
+    def negotiate(raspi_id: int):
+        return jsonify({"url": standin.ws_url})
+
+    @app.post(PREFIX)
+    def normal(raspi_id: int):
+        # Reply with what was recorded.
+        data = request.files["file"].read()
+        time.sleep(standin.next_reply_delay())
+        return data, 200, {"Content-Type": "audio/wav"}
+
+    @app.post(f"{PREFIX}/messages")
+    def post_message(raspi_id: int):
+        message_id = standin.save_message(request.files["file"].read())
+        return jsonify({"id": message_id})
+
+    @app.get(f"{PREFIX}/messages/<int:message_id>")
+    def get_message(raspi_id: int, message_id: int):
+        message_path = standin.message_path(message_id)
+        if not path.exists(message_path):
+            abort(404)
+        response = send_file(
+            message_path, mimetype="audio/wav", conditional=True, etag=True
+        )
+        if response.status_code in (200, 206) and random.random() < standin.fail_rate:
+            response.response = truncated(
+                response.response, (response.content_length or 0) // 2
+            )
+        return response
+
+    @app.post(f"{PREFIX}/logs")
+    def post_logs(raspi_id: int):
+        data = request.get_data()
+        if request.headers.get("Content-Encoding") == "gzip":
+            data = gzip.decompress(data)
+        with open(path.join(standin.data_dir, "logs.ndjson"), "ab") as f:
+            f.write(data)
+        return "", 204
+
+    @app.post(f"{PREFIX}/messages/uploads")
+    def create_upload(raspi_id: int):
+        body = request.get_json()
+        upload_id = uuid.uuid4().hex
+        standin.uploads[upload_id] = {
+            "size": int(body["size"]),
+            "part_size": int(body["part_size"]),
+            "parts": {},
+        }
+        return jsonify({"upload_id": upload_id, "part_size": int(body["part_size"])})
+
+    @app.get(f"{PREFIX}/messages/uploads/<upload_id>")
+    def get_upload(raspi_id: int, upload_id: str):
+        upload = standin.uploads.get(upload_id) or abort(404)
+        return jsonify({"received": sorted(upload["parts"])})
+
+    @app.put(f"{PREFIX}/messages/uploads/<upload_id>/parts/<int:index>")
+    def put_part(raspi_id: int, upload_id: str, index: int):
+        upload = standin.uploads.get(upload_id) or abort(404)
+        if random.random() < standin.fail_rate:
+            abort(503)
+        upload["parts"][index] = request.get_data()
+        return "", 204
+
+    @app.post(f"{PREFIX}/messages/uploads/<upload_id>/commit")
+    def commit_upload(raspi_id: int, upload_id: str):
+        upload = standin.uploads.get(upload_id) or abort(404)
+        parts = upload["parts"]
+        count = (upload["size"] + upload["part_size"] - 1) // upload["part_size"]
+        if sorted(parts) != list(range(count)):
+            abort(409)
+        data = b"".join(parts[index] for index in range(count))
+        if len(data) != upload["size"]:
+            abort(409)
+        del standin.uploads[upload_id]
+        return jsonify({"id": standin.save_message(data)})
+
+    return app
+
+
+def run(
+    port: int = 8000,
+    data_dir: Optional[str] = None,
+    fail_rate: float = 0.0,
+    reply_delay: float = 0.0,
+):
+    standin = StandIn(
+        data_dir or tempfile.mkdtemp(prefix="futarin-standin-"), fail_rate, reply_delay
+    )
+    logger.info(f"Start stand-in backend. ({port=}, {standin.data_dir=})")
+    create_app(standin).run(port=port, debug=False, threaded=True)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--data-dir")
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--reply-delay", type=float, default=0.0)
+    args = parser.parse_args()
+    run(args.port, args.data_dir, args.fail_rate, args.reply_delay)
@@ -0,0 +1,204 @@
+# Offline microbenchmarks of the audio stages (src/audio/dsp.py, codec.py).
+#
+#   python -m src.bench.audio --output bench/audio.json
+#   python -m src.bench.audio --compare bench/audio.json
+#
+# For each stage and input: throughput (seconds of audio processed per wall
+# second), CPU time, and memory traced with tracemalloc in a separate run:
+# peak during the stage and what is still allocated after it (the result).
+# Work done inside ffmpeg child processes is not in the memory figures.
+import json
+import platform
+import shutil
+import statistics
+import sys
+import tracemalloc
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from glob import glob
+from io import BytesIO
+from time import perf_counter, process_time
+from typing import Callable, Dict, List, NamedTuple, Optional
+from pydub import AudioSegment
+from src.audio import dsp
+from src.audio.codec import UploadTier, encode
+from src.util.spool import Spool
+
+
+FIXTURES = "assets/vox/*.wav"
+SYNTHETIC_SECONDS = (30, 120)
+PLAYBACK_RATE = 44100  # speaker.RATE
+DELTA_VOLUME = -6
+RECORD_CHUNK = 1024 * 8  # mic.CHUNK
+RECORD_CHANNELS = 2
+RECORD_SPOOL_MAX_MEMORY = 1024 * 1024
+
+
+class Clip(NamedTuple):
+    name: str
+    wav: bytes
+    audio: AudioSegment
+
+
+class Stage(NamedTuple):
+    name: str
+    run: Callable[[Clip], object]
+    needs_ffmpeg: bool = False
+
+
+def load_clip(name: str, wav: bytes) -> Clip:
+    return Clip(name, wav, dsp.decode_wav(BytesIO(wav)))
+
+
+def synthetic_clip(fixtures: List[Clip], seconds: float) -> Clip:
+    # Fixture speech repeated up to the length, so it keeps real pauses.
+    audio = AudioSegment.empty()
+    while audio.duration_seconds < seconds:
+        for clip in fixtures:
+            audio += clip.audio
+    audio = audio[: int(seconds * 1000)]
+    return Clip(f"synthetic-{seconds}s", dsp.encode_wav(audio).getvalue(), audio)
+
+
+def record_chunks(clip: Clip) -> List[bytes]:
+    audio = clip.audio.set_channels(RECORD_CHANNELS).set_frame_rate(PLAYBACK_RATE)
+    data = audio.raw_data
+    size = RECORD_CHUNK * audio.frame_width
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+def write_chunks(clip: Clip) -> int:
+    chunks = record_chunks_cache[clip.name]
+    with Spool(RECORD_SPOOL_MAX_MEMORY, name="bench") as spool:
+        return dsp.write_wav_chunks(
+            spool, chunks, RECORD_CHANNELS, 2, PLAYBACK_RATE
+        )
+
+
+record_chunks_cache: Dict[str, List[bytes]] = {}
+
+stages = [
+    Stage("decode", lambda clip: dsp.decode_wav(BytesIO(clip.wav))),
+    Stage("resample", lambda clip: dsp.resample(clip.audio, PLAYBACK_RATE)),
+    Stage("gain", lambda clip: dsp.gain(clip.audio, DELTA_VOLUME)),
+    Stage("encode_wav", lambda clip: dsp.encode_wav(clip.audio)),
+    Stage(
+        "encode_opus",
+        lambda clip: encode(BytesIO(clip.wav), UploadTier.Opus32k),
+        needs_ffmpeg=True,
+    ),
+    Stage(
+        "convert",
+        lambda clip: dsp.convert(BytesIO(clip.wav), PLAYBACK_RATE, DELTA_VOLUME),
+    ),
+    Stage("vad", lambda clip: dsp.voice_activity(clip.audio)),
+    Stage("write_chunks", write_chunks),
+]
+
+
+def measure(stage: Stage, clip: Clip, repeat: int) -> Dict:
+    walls = []
+    cpus = []
+    for _ in range(repeat):
+        started_at, cpu_started_at = perf_counter(), process_time()
+        stage.run(clip)
+        walls.append(perf_counter() - started_at)
+        cpus.append(process_time() - cpu_started_at)
+
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    result = stage.run(clip)
+    after, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    del result
+
+    audio_seconds = clip.audio.duration_seconds
+    wall = statistics.median(walls)
+    return {
+        "stage": stage.name,
+        "input": clip.name,
+        "audio_seconds": round(audio_seconds, 3),
+        "repeat": repeat,
+        "wall_seconds_median": wall,
+        "wall_seconds_min": min(walls),
+        "cpu_seconds_median": statistics.median(cpus),
+        "throughput": audio_seconds / wall if wall else None,
+        "retained_bytes": after - before,
+        "retained_blocks": sum(stat.count for stat in snapshot.statistics("filename")),
+        "peak_bytes": peak - before,
+    }
+
+
+def run(repeat: int, stage_names: Optional[List[str]]) -> Dict:
+    fixtures = []
+    for fixture_path in sorted(glob(FIXTURES)):
+        with open(fixture_path, "rb") as f:
+            fixtures.append(load_clip(fixture_path, f.read()))
+    clips = fixtures + [synthetic_clip(fixtures, s) for s in SYNTHETIC_SECONDS]
+    for clip in clips:
+        record_chunks_cache[clip.name] = record_chunks(clip)
+
+    has_ffmpeg = shutil.which("ffmpeg") is not None
+    results = []
+    skipped = []
+    for stage in stages:
+        if stage_names and stage.name not in stage_names:
+            continue
+        if stage.needs_ffmpeg and not has_ffmpeg:
+            skipped.append(stage.name)
+            continue
+        for clip in clips:
+            result = measure(stage, clip, repeat)
+            results.append(result)
+            print(
+                f"{stage.name:>12} {clip.name:<32} {result['throughput']:10.1f}x "
+                f"peak={result['peak_bytes'] / 1024:9.1f}KiB",
+                file=sys.stderr,
+            )
+
+    return {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+        "ffmpeg": has_ffmpeg,
+        "skipped": skipped,
+        "results": results,
+    }
+
+
+def compare(base: Dict, current: Dict):
+    # Throughput ratio per stage/input; > 1 means faster than the base run.
+    base_results = {(r["stage"], r["input"]): r for r in base["results"]}
+    for result in current["results"]:
+        base_result = base_results.get((result["stage"], result["input"]))
+        if base_result is None or not base_result["throughput"]:
+            continue
+        ratio = result["throughput"] / base_result["throughput"]
+        peak_delta = result["peak_bytes"] - base_result["peak_bytes"]
+        print(
+            f"{result['stage']:>12} {result['input']:<32} {ratio:6.2f}x "
+            f"peak{peak_delta / 1024:+10.1f}KiB"
+        )
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Audio pipeline microbenchmarks")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--stage", action="append", help="Run only these stages")
+    parser.add_argument("--output", help="Write results as JSON to this path")
+    parser.add_argument("--compare", help="Compare with a previous JSON result")
+    args = parser.parse_args()
+
+    current = run(args.repeat, args.stage)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=2)
+    else:
+        json.dump(current, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), current)
@@ -11,12 +11,22 @@ from typing import (
     List,
     NotRequired,
     IO,
+    Set,
+    Tuple,
 )
 from argparse import (
+    SUPPRESS,
     ArgumentParser,
     Action,
     FileType,
 )
+from types import MappingProxyType
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
 import tomllib
 from os import getcwd, path
 from src.log.log import log
@@ -44,10 +54,20 @@ class Prop(TypedDict, Generic[T]):
     type: Type[T]
     help: str
     default: NotRequired[T]
+    live: NotRequired[bool]  # applied without restart when the file changes
     argparse_options: NotRequired[ArgparseOptions]
 
 
 Config = Dict[str, Prop]
+Subscriber = Callable[["Snapshot", Set[str]], None]
+
+UNSET = object()
+WATCH_DEBOUNCE = 0.2
+WATCH_POLL_INTERVAL = 2.0  # without inotify
+IN_CLOSE_WRITE = 0x08
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+INOTIFY_EVENT = struct.Struct("iIII")
 
 
 class ConfigNotSetError(Exception):
@@ -63,7 +83,9 @@ def add_prop(prop: Prop):
 
 
 def get_arg_parser(config: Config) -> ArgumentParser:
-    parser = ArgumentParser()
+    # Options not given on the command line are left out of the result, so
+    # that the file (or the default) applies; e.g. --profile is False then.
+    parser = ArgumentParser(argument_default=SUPPRESS)
     for prop in config.values():
         if "argparse_options" in prop:
             kwargs = {
@@ -91,45 +113,88 @@ def get_arg_parser(config: Config) -> ArgumentParser:
     return parser
 
 
-def get_config_from_file(file: Optional[IO] = None):
+def get_config_file_path(file: Optional[IO] = None) -> str:
     if file:
-        return tomllib.load(file)
-    else:
-        search_dir = getcwd()
-        while search_dir:
-            config_file_path = path.join(search_dir, FILE_NAME)
-            if path.exists(config_file_path):
-                with open(config_file_path, "rb") as config_file:
-                    return tomllib.load(config_file)
-            search_dir = None if search_dir == "/" else path.dirname(search_dir)
-        raise FileNotFoundError("config file not found")
+        file.close()
+        return file.name
+    search_dir = getcwd()
+    while search_dir:
+        config_file_path = path.join(search_dir, FILE_NAME)
+        if path.exists(config_file_path):
+            return config_file_path
+        search_dir = None if search_dir == "/" else path.dirname(search_dir)
+    raise FileNotFoundError("config file not found")
+
+
+def get_config_from_file(file_path: str) -> Dict[str, Any]:
+    with open(file_path, "rb") as config_file:
+        return tomllib.load(config_file)
+
+
+class Snapshot:
+    # Resolved values of all props, built once per (re)load and never
+    # modified afterwards; get() is a single dict lookup.
+    def __init__(self, values: Dict[str, Any], version: int = 0):
+        self.values = MappingProxyType(dict(values))
+        self.version = version
+
+    def get(self, key: str) -> Any:
+        if key not in self.values:
+            raise KeyError(f"{key} is not found from config")
+        value = self.values[key]
+        if value is UNSET:
+            raise ConfigNotSetError(key)
+        return value
+
+    def changed_keys(self, other: "Snapshot") -> Set[str]:
+        return {key for key, value in self.values.items() if other.values[key] != value}
+
+
+def check_type(prop: Prop, value: Any) -> Any:
+    expected = prop["type"]
+    if expected is float and type(value) is int:
+        return float(value)
+    if expected in (int, float) and isinstance(value, str):
+        try:
+            return expected(value)  # e.g. id="1"
+        except ValueError:
+            pass
+    if not isinstance(value, expected) or (expected is int and type(value) is bool):
+        raise TypeError(
+            f"{prop['name']} must be {expected.__name__}, not {type(value).__name__}"
+        )
+    return value
+
+
+def build_snapshot(
+    from_file: Dict[str, Any],
+    from_args: Dict[str, Any],
+    previous: Optional[Snapshot] = None,
+) -> Snapshot:
+    # Arguments override the file. Values from the file are type checked; a
+    # bad one is ignored (keeps the previous or default value).
+    values = {}
+    for key, prop in config.items():
+        value = prop.get("default", UNSET)
+        if key in from_file:
+            try:
+                value = check_type(prop, from_file[key])
+            except TypeError as e:
+                logger.error(f"Invalid config value. ({e})")
+                value = previous.values[key] if previous else value
+        if key in from_args:
+            value = from_args[key]
+        values[key] = value
+    return Snapshot(values, previous.version + 1 if previous else 0)
 
 
 def get(*keys: str, **keys_with_default: Any) -> Any:
     if len(keys) == 1:
-        key = keys[0]
-        if key in config:
-            prop = config[key]
-            if "value" in prop:
-                return prop["value"]
-            elif "default" in prop:
-                return prop["default"]
-            else:
-                raise ConfigNotSetError(key)
-        else:
-            raise KeyError(f"{key} is not found from config")
+        return snapshot.get(keys[0])
     elif len(keys_with_default) == 1:
-        key, value = next(iter(keys_with_default))
-        if key in config:
-            prop = config[key]
-            if "value" in prop:
-                return prop["value"]
-            elif "default" in prop:
-                return prop["default"]
-            else:
-                return value
-        else:
-            raise KeyError(f"{key} is not found from config")
+        key, default = next(iter(keys_with_default.items()))
+        value = snapshot.get(key) if snapshot.values.get(key) is not UNSET else default
+        return value
     else:
         args_count = len(keys) + len(keys_with_default)
         raise TypeError(
@@ -138,32 +203,137 @@ def get(*keys: str, **keys_with_default: Any) -> Any:
 
 
 def get_multiple(*keys: str, **keys_with_default: Any) -> tuple:
-    result: List[Any] = []
-    for key in keys:
-        if key in config:
-            prop: Prop = config[key]
-            if "value" in prop:
-                result.append(prop["value"])
-            elif "default" in prop:
-                result.append(prop["default"])
-            else:
-                raise ConfigNotSetError(key)
-        else:
-            raise KeyError(f"{key} is not found from config")
+    return tuple(get(key) for key in keys) + tuple(
+        get(**{key: value}) for key, value in keys_with_default.items()
+    )
 
-    for key, value in keys_with_default.items():
-        if key in config:
-            prop: Prop = config[key]
-            if "value" in prop:
-                result.append(prop["value"])
-            elif "default" in prop:
-                result.append(prop["default"])
-            else:
-                result.append(value)
-        else:
-            raise KeyError(f"{key} is not found from config")
 
-    return tuple(result)
+def subscribe(callback: Subscriber, keys: Iterable[str]):
+    # callback(snapshot, changed_keys) is called on the watcher thread after
+    # a reload changes any of the keys.
+    subscribers.append((callback, set(keys)))
+
+
+def reload():
+    global snapshot
+    try:
+        from_file = get_config_from_file(config_file_path)
+    except (OSError, tomllib.TOMLDecodeError) as e:
+        logger.error(f"Failed to reload config. Keep the current one. ({e=})")
+        return
+    current = snapshot
+    loaded = build_snapshot(from_file, config_from_args, current)
+    changed = loaded.changed_keys(current)
+    live = {key for key in changed if config[key].get("live")}
+    if changed - live:
+        logger.warn(f"Restart to apply config changes. (keys={sorted(changed - live)})")
+    if not live:
+        return
+    values = dict(current.values)
+    values.update({key: loaded.values[key] for key in live})
+    snapshot = Snapshot(values, current.version + 1)
+    logger.info(f"Config reloaded. (keys={sorted(live)}, {snapshot.version=})")
+    for callback, keys in list(subscribers):
+        if keys & live:
+            try:
+                callback(snapshot, keys & live)
+            except Exception:
+                logger.exception(f"Config subscriber failed. ({callback=})")
+
+
+class ConfigWatcher:
+    # Reloads the config file when it is written or replaced. Watches the
+    # directory with inotify (editors often save by renaming a new file over
+    # the old one); polls the modification time where inotify is missing.
+    def __init__(self, file_path: str):
+        self.file_path = path.abspath(file_path)
+        self.thread: Optional[threading.Thread] = None
+        self.stop_event = threading.Event()
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name="Config-Watch", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        fd = self.open_inotify()
+        logger.info(f"Watch config file. ({self.file_path=}, inotify={fd is not None})")
+        if fd is None:
+            self.poll()
+            return
+        try:
+            self.watch(fd)
+        finally:
+            os.close(fd)
+
+    def open_inotify(self) -> Optional[int]:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if libc.inotify_add_watch(fd, path.dirname(self.file_path).encode(), mask) < 0:
+            os.close(fd)
+            return None
+        return fd
+
+    def watch(self, fd: int):
+        name = path.basename(self.file_path).encode()
+        while not self.stop_event.is_set():
+            if not select.select([fd], [], [], 1.0)[0]:
+                continue
+            if not any(event == name for event in self.read_events(fd)):
+                continue
+            # Let the writer finish; a save is often several events.
+            self.stop_event.wait(WATCH_DEBOUNCE)
+            self.read_events(fd)
+            reload()
+
+    def read_events(self, fd: int) -> List[bytes]:
+        names = []
+        try:
+            data = os.read(fd, 64 * 1024)
+        except BlockingIOError:
+            return names
+        offset = 0
+        while offset < len(data):
+            _, _, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            names.append(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+        return names
+
+    def poll(self):
+        mtime = self.mtime()
+        while not self.stop_event.wait(WATCH_POLL_INTERVAL):
+            if self.mtime() != mtime:
+                mtime = self.mtime()
+                reload()
+
+    def mtime(self) -> Optional[float]:
+        try:
+            return path.getmtime(self.file_path)
+        except OSError:
+            return None
+
+
+def start_watching():
+    watcher.start()
+
+
+def stop_watching():
+    watcher.stop()
 
 
 logger = log.get_logger("Config")
@@ -183,6 +353,7 @@ add_prop(
         "type": str,
         "help": "futarin-led server origin",
         "default": "http://127.0.0.1:8080",
+        "live": True,
     }
 )
 add_prop(
@@ -191,6 +362,7 @@ add_prop(
         "type": str,
         "help": "Microphone name",
         "default": "BY Y02",
+        "live": True,
     }
 )
 add_prop(
@@ -199,6 +371,7 @@ add_prop(
         "type": str,
         "help": "Speaker name",
         "default": "BY Y02",
+        "live": True,
     }
 )
 add_prop(
@@ -223,6 +396,175 @@ add_prop(
         "type": int,
         "help": "Delta Volume(decibel) (Default volume - this)",
         "default": 0,
+        "live": True,
+    }
+)
+add_prop(
+    {
+        "name": "wifi_interface",
+        "type": str,
+        "help": "Wi-Fi interface name",
+        "default": "wlan0",
+    }
+)
+add_prop(
+    {
+        "name": "wifi_sample_interval",
+        "type": float,
+        "help": "Wi-Fi link quality sampling interval(seconds)",
+        "default": 2.0,
+    }
+)
+add_prop(
+    {
+        "name": "adaptive_upload",
+        "type": bool,
+        "help": "Choose upload encoding (16 kHz mono WAV, Ogg/Opus) from measured link throughput. The backend must accept these formats",
+        "default": False,
+    }
+)
+add_prop(
+    {
+        "name": "upload_target_seconds",
+        "type": float,
+        "help": "Target upload time(seconds) per turn for adaptive upload",
+        "default": 3.0,
+    }
+)
+add_prop(
+    {
+        "name": "chunked_upload",
+        "type": bool,
+        "help": "Upload message recordings in resumable parts",
+        "default": False,
+    }
+)
+add_prop(
+    {
+        "name": "upload_part_size",
+        "type": int,
+        "help": "Part size(bytes) for chunked upload",
+        "default": 64 * 1024,
+    }
+)
+add_prop(
+    {
+        "name": "cache_dir",
+        "type": str,
+        "help": "Directory for persistent data such as the message inbox",
+        "default": "cache",
+    }
+)
+add_prop(
+    {
+        "name": "message_cache_max_bytes",
+        "type": int,
+        "help": "Maximum size(bytes) of downloaded message audio kept on disk; further downloads wait until messages are played",
+        "default": 64 * 1024 * 1024,
+    }
+)
+add_prop(
+    {
+        "name": "max_record_seconds",
+        "type": float,
+        "help": "Maximum recording length(seconds); recording stops automatically",
+        "default": 60.0,
+    }
+)
+add_prop(
+    {
+        "name": "reply_formats",
+        "type": list,
+        "help": "Compressed reply audio formats to accept, in order of preference (opus, mp3, flac). WAV is always accepted",
+        "default": ["opus", "flac", "mp3"],
+    }
+)
+add_prop(
+    {
+        "name": "audio_worker",
+        "type": bool,
+        "help": "Run audio conversion and encoding in a separate worker process",
+        "default": True,
+    }
+)
+add_prop(
+    {
+        "name": "log_shipping",
+        "type": bool,
+        "help": "Upload the log file to the backend in compressed batches",
+        "default": False,
+    }
+)
+add_prop(
+    {
+        "name": "log_ship_interval",
+        "type": float,
+        "help": "Interval(seconds) between log uploads when caught up",
+        "default": 60.0,
+    }
+)
+add_prop(
+    {
+        "name": "adaptive_audio_buffers",
+        "type": bool,
+        "help": "Tune audio chunk sizes per device to the smallest one without xruns",
+        "default": False,
+    }
+)
+add_prop(
+    {
+        "name": "please_wait_after",
+        "type": float,
+        "help": "Play the please-wait prompt when no reply has arrived after this many seconds(0 to disable)",
+        "default": 2.0,
+    }
+)
+add_prop(
+    {
+        "name": "loop_lag_threshold",
+        "type": float,
+        "help": "Log the blocking call when the event loop is blocked longer than this(seconds, 0 to disable)",
+        "default": 0.2,
+    }
+)
+add_prop(
+    {
+        "name": "metrics_log_interval",
+        "type": float,
+        "help": "Interval(seconds) between metrics snapshots in the log(0 to disable)",
+        "default": 600.0,
+    }
+)
+add_prop(
+    {
+        "name": "memory_accounting",
+        "type": bool,
+        "help": "Trace memory per turn with tracemalloc and alert on growth (slows turns down)",
+        "default": False,
+    }
+)
+add_prop(
+    {
+        "name": "memory_leak_turns",
+        "type": int,
+        "help": "Alert when memory left after a turn grows this many turns in a row",
+        "default": 5,
+    }
+)
+add_prop(
+    {
+        "name": "trace_output",
+        "type": str,
+        "help": "Record a session trace (button edges, WebSocket messages, API timings) to this file for src/diag/replay.py. Empty to disable",
+        "default": "",
+    }
+)
+add_prop(
+    {
+        "name": "trace_audio",
+        "type": bool,
+        "help": "Also save recorded audio with the session trace",
+        "default": False,
     }
 )
 add_prop(
@@ -237,6 +579,26 @@ add_prop(
         },
     }
 )
+add_prop(
+    {
+        "name": "profile",
+        "type": bool,
+        "help": "Profile the runtime (asyncio debug, sampling profiler) and write a flamegraph file on shutdown",
+        "default": False,
+        "argparse_options": {
+            "name_or_flugs": ["--profile"],
+            "action": "store_true",
+        },
+    }
+)
+add_prop(
+    {
+        "name": "profile_output",
+        "type": str,
+        "help": "Output file of --profile, in folded stack format",
+        "default": "futarin-raspi.profile.folded",
+    }
+)
 add_prop(
     {
         "name": "config_file",
@@ -252,13 +614,15 @@ add_prop(
 
 arg_parser = get_arg_parser(config)
 config_from_args = vars(arg_parser.parse_args())
-config_from_file = get_config_from_file(config_from_args.get("config_file"))
+config_file_path = get_config_file_path(config_from_args.get("config_file"))
+config_from_file = get_config_from_file(config_file_path)
 
-for key, value in (config_from_file | config_from_args).items():
-    if key in config:
-        config[key]["value"] = value
-    else:
-        logger.warn(f"{key} is not found from config")
+for key in (config_from_file | config_from_args).keys() - config.keys():
+    logger.warn(f"{key} is not found from config")
+
+snapshot = build_snapshot(config_from_file, config_from_args)
+subscribers: List[Tuple[Subscriber, Set[str]]] = []
+watcher = ConfigWatcher(config_file_path)
 
 logger.info("Initialized.")
 
@@ -0,0 +1,163 @@
+import gc
+import os
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Dict, Optional
+import src.config.config as config
+from src.metrics.metrics import metrics
+from src.log.log import log
+
+
+# Per-turn memory accounting (memory_accounting = true). tracemalloc
+# snapshots taken at the start and end of each turn are diffed per module
+# (mic, speaker, api, pydub, ...), peaks are measured per stage (record,
+# api, play), and RSS is sampled from /proc. When the memory left after a
+# turn grows over LEAK_TURNS turns in a row, a warning with the modules
+# that grew is logged.
+
+MEMORY_ACCOUNTING = config.get("memory_accounting")
+LEAK_TURNS = config.get("memory_leak_turns")
+LEAK_MIN_BYTES = 256 * 1024  # growth over the window to alert on
+TRACE_FRAMES = 1
+REPORT_TOP = 5
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+ModuleSizes = Dict[str, int]
+
+
+def rss_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def module_name(file_name: str) -> str:
+    # src/interface/mic.py -> mic, .../site-packages/pydub/audio_segment.py -> pydub
+    parts = file_name.replace("\\", "/").split("/")
+    if "site-packages" in parts:
+        return parts[parts.index("site-packages") + 1].removesuffix(".py")
+    if "src" in parts:
+        return parts[-1].removesuffix(".py")
+    return "python" if "lib" in parts else "other"
+
+
+def module_sizes(snapshot: tracemalloc.Snapshot) -> ModuleSizes:
+    sizes: ModuleSizes = {}
+    for stat in snapshot.statistics("filename"):
+        name = module_name(stat.traceback[0].filename)
+        sizes[name] = sizes.get(name, 0) + stat.size
+    return sizes
+
+
+def top_changes(after: ModuleSizes, before: ModuleSizes) -> Dict[str, int]:
+    changes = {name: after.get(name, 0) - before.get(name, 0) for name in after | before}
+    ranked = sorted(changes.items(), key=lambda item: -abs(item[1]))
+    return {name: change for name, change in ranked[:REPORT_TOP] if change}
+
+
+class MemoryAccounting:
+    def __init__(self):
+        self.logger = log.get_logger("Memory")
+        self.enabled = False
+        self.turns = 0
+        self.history: Deque[ModuleSizes] = deque(maxlen=LEAK_TURNS + 1)
+        self.stage_peaks: Dict[str, int] = {}
+        self.turn_started = 0
+        self.turn_peak = 0  # stages reset the tracemalloc peak
+
+    def start(self):
+        if not MEMORY_ACCOUNTING or self.enabled:
+            return
+        self.logger.info(f"Start memory accounting. ({LEAK_TURNS=})")
+        tracemalloc.start(TRACE_FRAMES)
+        self.enabled = True
+
+    def stop(self):
+        if self.enabled:
+            tracemalloc.stop()
+            self.enabled = False
+
+    def take(self) -> ModuleSizes:
+        gc.collect()
+        snapshot = tracemalloc.take_snapshot()
+        # Not our own history of module sizes.
+        return module_sizes(snapshot.filter_traces([tracemalloc.Filter(False, __file__)]))
+
+    @contextmanager
+    def turn(self):
+        if not self.enabled:
+            yield
+            return
+        before = self.take()
+        rss_before = rss_bytes()
+        self.stage_peaks = {}
+        self.turn_started, self.turn_peak = tracemalloc.get_traced_memory()[0], 0
+        tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            _, peak = tracemalloc.get_traced_memory()
+            peak = max(peak, self.turn_peak) - self.turn_started
+            after = self.take()
+            self.report(before, after, peak, rss_before, rss_bytes())
+
+    @contextmanager
+    def stage(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            _, peak = tracemalloc.get_traced_memory()
+            self.turn_peak = max(self.turn_peak, peak)
+            self.stage_peaks[name] = max(self.stage_peaks.get(name, 0), peak - current)
+
+    def report(
+        self,
+        before: ModuleSizes,
+        after: ModuleSizes,
+        peak: int,
+        rss_before: Optional[int],
+        rss_after: Optional[int],
+    ):
+        self.turns += 1
+        retained = sum(after.values()) - sum(before.values())
+        metrics.gauge("memory.turn.retained_bytes").set(retained)
+        metrics.gauge("memory.turn.peak_bytes").set(peak)
+        for name, stage_peak in self.stage_peaks.items():
+            metrics.gauge(f"memory.stage.{name}.peak_bytes").set(stage_peak)
+        if rss_after is not None:
+            metrics.gauge("memory.rss_bytes").set(rss_after)
+        rss_delta = (
+            rss_after - rss_before if rss_after is not None and rss_before is not None else None
+        )
+        self.logger.info(
+            f"Turn memory. ({self.turns=}, {retained=}, {peak=}, {rss_after=}, {rss_delta=}, stage_peaks={self.stage_peaks}, modules={top_changes(after, before)})"
+        )
+        self.check_leak(after)
+
+    def check_leak(self, sizes: ModuleSizes):
+        # Alert when the total after each turn grew LEAK_TURNS times in a row.
+        self.history.append(sizes)
+        if len(self.history) <= LEAK_TURNS:
+            return
+        totals = [sum(sizes.values()) for sizes in self.history]
+        growth = totals[-1] - totals[0]
+        if growth < LEAK_MIN_BYTES or any(b <= a for a, b in zip(totals, totals[1:])):
+            return
+        metrics.counter("memory.leak_alerts").inc()
+        self.logger.warn(
+            f"Memory grows every turn. ({LEAK_TURNS=}, {growth=}, modules={top_changes(self.history[-1], self.history[0])})",
+            extra={"flight_dump": "memory_leak"},
+        )
+        self.history.clear()
+        self.history.append(sizes)
+
+
+memory = MemoryAccounting()
@@ -0,0 +1,178 @@
+import asyncio
+import sys
+import threading
+from collections import Counter
+from collections.abc import Coroutine
+from logging import Filter, LogRecord, WARNING
+from os import getcwd, path
+from time import monotonic, perf_counter, thread_time
+from typing import Dict, List, Optional
+import src.config.config as config
+from src.metrics.metrics import metrics
+from src.log.log import log
+
+
+# Profiling mode (--profile): asyncio debug with slow callback reports, a
+# sampling profiler over all threads, and per-coroutine wall/CPU accounting.
+# On stop, samples are written in the folded format of flamegraph.pl and
+# speedscope:
+#
+#   flamegraph.pl futarin-raspi.profile.folded > profile.svg
+
+PROFILE = config.get("profile")
+PROFILE_OUTPUT = config.get("profile_output")
+SAMPLE_INTERVAL = 0.01
+SLOW_CALLBACK_DURATION = 0.05
+MAX_STACK_DEPTH = 64
+COROUTINE_REPORT_TOP = 20
+
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    file_name = code.co_filename
+    if file_name.startswith(getcwd()):
+        file_name = path.relpath(file_name)
+    else:
+        file_name = path.basename(file_name)
+    return f"{code.co_qualname} ({file_name}:{code.co_firstlineno})"
+
+
+class CoroutineStats:
+    def __init__(self):
+        self.tasks = 0
+        self.steps = 0
+        self.wall = 0.0  # time spent running on the loop, not waiting
+        self.cpu = 0.0
+        self.lifetime = 0.0  # of finished tasks, including waits
+
+
+class TimedCoroutine(Coroutine):
+    # Wraps the coroutine of a task and times each step it runs on the loop.
+    # Nested awaits are counted for the task's own coroutine.
+    def __init__(self, coro, stats: CoroutineStats):
+        self.coro = coro
+        self.stats = stats
+        # Keeps task reprs (and so slow callback reports) readable.
+        self.__name__ = getattr(coro, "__name__", type(coro).__name__)
+        self.__qualname__ = getattr(coro, "__qualname__", self.__name__)
+        self.created_at = monotonic()
+        stats.tasks += 1
+
+    def step(self, method, *args):
+        started_at, cpu_started_at = perf_counter(), thread_time()
+        try:
+            return method(*args)
+        except BaseException:
+            self.stats.lifetime += monotonic() - self.created_at
+            raise
+        finally:
+            self.stats.steps += 1
+            self.stats.wall += perf_counter() - started_at
+            self.stats.cpu += thread_time() - cpu_started_at
+
+    def send(self, value):
+        return self.step(self.coro.send, value)
+
+    def throw(self, *args):
+        return self.step(self.coro.throw, *args)
+
+    def close(self):
+        return self.coro.close()
+
+    def __await__(self):
+        return self
+
+    def __next__(self):
+        return self.send(None)
+
+    def __iter__(self):
+        return self
+
+
+class SlowCallbackFilter(Filter):
+    # Counts asyncio's slow callback reports ("Executing ... took 0.123
+    # seconds") and lets them through to the log.
+    def filter(self, record: LogRecord) -> bool:
+        if record.getMessage().startswith("Executing "):
+            metrics.counter("profile.slow_callbacks").inc()
+        return True
+
+
+class Profiler:
+    def __init__(self):
+        self.logger = log.get_logger("Profiler")
+        self.samples: Counter = Counter()
+        self.sample_count = 0
+        self.coroutines: Dict[str, CoroutineStats] = {}
+        self.thread: Optional[threading.Thread] = None
+        self.stop_event = threading.Event()
+        self.started_at = 0.0
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        if not PROFILE or self.thread is not None:
+            return
+        self.logger.info(f"Start profiling. ({SAMPLE_INTERVAL=}, {PROFILE_OUTPUT=})")
+        loop.set_debug(True)
+        loop.slow_callback_duration = SLOW_CALLBACK_DURATION
+        asyncio_logger = log.get_logger("asyncio")
+        asyncio_logger.setLevel(WARNING)
+        asyncio_logger.addFilter(SlowCallbackFilter())
+        loop.set_task_factory(self.task_factory)
+
+        self.started_at = monotonic()
+        self.stop_event.clear()
+        self.thread = threading.Thread(
+            target=self.sample_loop, name="Profiler", daemon=True
+        )
+        self.thread.start()
+
+    def task_factory(self, loop: asyncio.AbstractEventLoop, coro, **kwargs):
+        name = getattr(coro, "__qualname__", type(coro).__name__)
+        if name not in self.coroutines:
+            self.coroutines[name] = CoroutineStats()
+        return asyncio.Task(
+            TimedCoroutine(coro, self.coroutines[name]), loop=loop, **kwargs
+        )
+
+    def sample_loop(self):
+        own_ident = threading.get_ident()
+        while not self.stop_event.wait(SAMPLE_INTERVAL):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack: List[str] = []
+                while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                    stack.append(frame_label(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, f"thread-{ident}"))
+                self.samples[";".join(reversed(stack))] += 1
+            self.sample_count += 1
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        elapsed = monotonic() - self.started_at
+        self.write(PROFILE_OUTPUT)
+        self.logger.info(
+            f"Profile written. ({PROFILE_OUTPUT=}, {self.sample_count=}, {elapsed=:.1f}s)"
+        )
+        self.report_coroutines()
+
+    def write(self, output: str):
+        with open(output, "w") as f:
+            for stack, count in sorted(self.samples.items()):
+                f.write(f"{stack} {count}\n")
+
+    def report_coroutines(self):
+        ranked = sorted(self.coroutines.items(), key=lambda item: -item[1].cpu)
+        for name, stats in ranked[:COROUTINE_REPORT_TOP]:
+            self.logger.info(
+                f"Coroutine time. ({name=}, {stats.tasks=}, {stats.steps=}, wall={stats.wall:.3f}s, cpu={stats.cpu:.3f}s, lifetime={stats.lifetime:.1f}s)"
+            )
+
+
+profiler = Profiler()
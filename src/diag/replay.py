@@ -0,0 +1,374 @@
+# Replays a session trace (src/diag/trace.py) against the current code, with
+# the stand-in backend (src/backend/standin.py), a local WebSocket server,
+# mock GPIO pins and fake audio devices, and reports latency and CPU:
+#
+#   python -m src.diag.replay session.trace.ndjson --speed 4 --output replay.json
+#   python -m src.diag.replay session.trace.ndjson --compare replay.json
+#
+# --speed shortens idle gaps between events, fake audio and backend delays.
+# Button holds keep their real length (gpiozero hold times are real time).
+# Button presses made while Main was idle wait until it is idle again, so a
+# slower build does not lose presses. Recorded audio (trace_audio) is fed to
+# the microphone in order; without it the microphone hears silence. Messages
+# are served as silent WAV of the traced size.
+#
+# The config module parses sys.argv at import, so nothing from src is
+# imported before the replay config has been written.
+import asyncio
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import wave
+from argparse import ArgumentParser
+from collections import deque
+from io import BytesIO
+from time import monotonic, sleep
+from typing import Deque, Dict, List
+
+
+IDLE_TIMEOUT = 60
+WS_TIMEOUT = 30
+LED_SUCCESS = 202  # led.CODE_SUCCESS
+DEVICE_NAME = "replay"
+MESSAGE_RATE = 24000
+
+
+def load_trace(trace_path: str) -> List[Dict]:
+    with open(trace_path) as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    if not events or events[0]["type"] != "start":
+        raise ValueError(f"not a session trace: {trace_path}")
+    return events
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def write_config(work_dir: str, header: Dict, api_port: int, led_port: int) -> str:
+    config_path = os.path.join(work_dir, "futarin.toml")
+    with open(config_path, "w") as f:
+        for key, value in {
+            "api_origin": f"http://127.0.0.1:{api_port}",
+            "id": header.get("id") or 1,
+            "led_server_origin": f"http://127.0.0.1:{led_port}",
+            "mic_name": DEVICE_NAME,
+            "speaker_name": DEVICE_NAME,
+            "cache_dir": os.path.join(work_dir, "cache"),
+            "reply_formats": [],
+            "log_shipping": False,
+        }.items():
+            f.write(f"{key}={json.dumps(value)}\n")
+    return config_path
+
+
+def silent_wav(size: int) -> bytes:
+    file = BytesIO()
+    with wave.open(file, "wb") as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(MESSAGE_RATE)
+        wf.writeframes(bytes(max(size - 44, 0) // 2 * 2))
+    return file.getvalue()
+
+
+def create_led_app():
+    # futarin-led stand-in: accepts every pattern.
+    from flask import Flask
+
+    app = Flask("led")
+
+    @app.post("/<path:pattern>")
+    def set_pattern(pattern: str):
+        return "", LED_SUCCESS
+
+    return app
+
+
+def serve_app(app, origin: str):
+    from werkzeug.serving import make_server
+
+    port = int(origin.rsplit(":", 1)[1])
+    server = make_server("127.0.0.1", port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="Replay-Server", daemon=True).start()
+    return server
+
+
+def is_normal_endpoint(endpoint: str) -> bool:
+    # /v2/raspis/{id}
+    parts = endpoint.strip("/").split("/")
+    return len(parts) == 3 and parts[1] == "raspis"
+
+
+class ReplayStream:
+    # Stands in for a PyAudio stream: output is paced by the frame rate, input
+    # is fed through the callback from the recordings of the trace.
+    def __init__(
+        self,
+        audio: "ReplayAudio",
+        format: int,
+        channels: int,
+        rate: int,
+        input: bool = False,
+        output: bool = False,
+        frames_per_buffer: int = 1024,
+        stream_callback=None,
+        **kwargs,
+    ):
+        self.audio = audio
+        self.channels = channels
+        self.rate = rate
+        self.chunk = frames_per_buffer
+        self.frame_size = channels * audio.sample_size(format)
+        self.active = True
+        if input and stream_callback:
+            self.data = audio.next_recording(rate, channels)
+            self.callback = stream_callback
+            threading.Thread(target=self.feed, name="Replay-Mic", daemon=True).start()
+
+    def feed(self):
+        size = self.chunk * self.frame_size
+        offset = 0
+        while self.active:
+            sleep(self.chunk / self.rate / self.audio.speed)
+            data = self.data[offset : offset + size].ljust(size, b"\0")
+            offset += size
+            if self.active:
+                self.callback(data, self.chunk, {}, 0)
+
+    def write(self, data: bytes, num_frames=None, exception_on_underflow=False):
+        sleep(len(data) / self.frame_size / self.rate / self.audio.speed)
+
+    def is_active(self) -> bool:
+        return self.active
+
+    def is_stopped(self) -> bool:
+        return not self.active
+
+    def start_stream(self):
+        self.active = True
+
+    def stop_stream(self):
+        self.active = False
+
+    def close(self):
+        self.active = False
+
+    def get_input_latency(self) -> float:
+        return self.chunk / self.rate
+
+    def get_output_latency(self) -> float:
+        return self.chunk / self.rate
+
+
+class ReplayAudio:
+    # Stands in for PyAudio with one device for both directions.
+    def __init__(self, pyaudio_module, speed: float, recordings: Deque[bytes]):
+        self.pyaudio = pyaudio_module
+        self.speed = speed
+        self.recordings = recordings
+
+    def sample_size(self, format: int) -> int:
+        return self.pyaudio.get_sample_size(format)
+
+    def next_recording(self, rate: int, channels: int) -> bytes:
+        if not self.recordings:
+            return b""
+        with wave.open(BytesIO(self.recordings.popleft()), "rb") as wf:
+            if wf.getframerate() != rate or wf.getnchannels() != channels:
+                return b""
+            return wf.readframes(wf.getnframes())
+
+    def get_device_count(self) -> int:
+        return 1
+
+    def get_device_info_by_index(self, index: int) -> Dict:
+        return {"index": index, "name": DEVICE_NAME}
+
+    def get_format_from_width(self, width: int) -> int:
+        return self.pyaudio.get_format_from_width(width)
+
+    def open(self, **kwargs) -> ReplayStream:
+        return ReplayStream(self, **kwargs)
+
+    def terminate(self):
+        pass
+
+
+class Replay:
+    def __init__(self, trace_path: str, events: List[Dict], speed: float, settle: float):
+        self.trace_path = trace_path
+        self.events = events
+        self.speed = speed
+        self.settle = settle
+        self.connections: set = set()
+
+    def recordings(self) -> Deque[bytes]:
+        recordings: Deque[bytes] = deque()
+        audio_dir = f"{self.trace_path}.audio"
+        for event in self.events:
+            if event["type"] == "audio" and event.get("file"):
+                with open(os.path.join(audio_dir, event["file"]), "rb") as f:
+                    recordings.append(f.read())
+        return recordings
+
+    def seed(self, standin):
+        # Messages announced over WebSocket, with the size they had, and the
+        # backend delay of each normal turn.
+        sizes = {
+            event["endpoint"].rsplit("/", 1)[-1]: event["response_bytes"]
+            for event in self.events
+            if event["type"] == "http" and "/messages/" in event["endpoint"]
+        }
+        for event in self.events:
+            if event["type"] == "ws":
+                try:
+                    message_id = int(json.loads(event["data"])["id"])
+                except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+                    continue
+                size = sizes.get(str(message_id)) or MESSAGE_RATE * 2
+                standin.add_message(message_id, silent_wav(size))
+            elif (
+                event["type"] == "http"
+                and event["method"] == "POST"
+                and is_normal_endpoint(event["endpoint"])
+            ):
+                server_seconds = event["elapsed"] - (event.get("upload_seconds") or 0)
+                standin.reply_delays.append(max(server_seconds, 0) / self.speed)
+
+    async def serve_ws(self, websocket):
+        self.connections.add(websocket)
+        try:
+            await websocket.wait_closed()
+        finally:
+            self.connections.discard(websocket)
+
+    async def send_ws(self, data: str):
+        deadline = monotonic() + WS_TIMEOUT
+        while not self.connections and monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        for websocket in list(self.connections):
+            await websocket.send(data)
+
+    async def wait_idle(self, main):
+        deadline = monotonic() + IDLE_TIMEOUT
+        while not main.idle and monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+    async def run(self) -> Dict:
+        import pyaudio
+        from websockets.asyncio.server import serve
+        from src.main import Main
+        from src.backend.standin import StandIn, create_app
+        from src.interface.audio import engine
+        from src.interface.button import button
+        from src.metrics.metrics import metrics
+        import src.config.config as config
+
+        engine.py_audio = ReplayAudio(pyaudio, self.speed, self.recordings())
+
+        ws_port = free_port()
+        standin = StandIn(os.path.join(os.path.dirname(config.config_file_path), "standin"))
+        os.makedirs(standin.data_dir, exist_ok=True)
+        standin.ws_url = f"ws://127.0.0.1:{ws_port}"
+        self.seed(standin)
+        servers = [
+            serve_app(create_app(standin), config.get("api_origin")),
+            serve_app(create_led_app(), config.get("led_server_origin")),
+        ]
+
+        cpu_started_at = os.times()
+        started_at = monotonic()
+        async with serve(self.serve_ws, "127.0.0.1", ws_port):
+            main = Main()
+            main_task = asyncio.create_task(main.main())
+            pressed = set()
+            last_t = self.events[0]["t"]
+            for event in self.events[1:]:
+                if event["type"] not in ("button", "ws"):
+                    continue
+                gap = event["t"] - last_t
+                last_t = event["t"]
+                await asyncio.sleep(gap if pressed else gap / self.speed)
+                if event["type"] == "ws":
+                    await self.send_ws(event["data"])
+                    continue
+                pin = getattr(button, event["button"]).pin
+                if event["edge"] == "press":
+                    if event.get("idle"):
+                        await self.wait_idle(main)
+                    pin.drive_low()  # pulled up: low is pressed
+                    pressed.add(event["button"])
+                else:
+                    pin.drive_high()
+                    pressed.discard(event["button"])
+
+            await asyncio.sleep(self.settle)
+            await self.wait_idle(main)
+            if not main_task.done():
+                main_task.cancel()
+                await asyncio.gather(main_task, return_exceptions=True)
+                await main.shutdown()
+        for server in servers:
+            server.shutdown()
+
+        cpu = os.times()
+        return {
+            "trace": self.trace_path,
+            "speed": self.speed,
+            "events": len(self.events),
+            "wall_seconds": monotonic() - started_at,
+            "cpu_seconds": sum(cpu[:4]) - sum(cpu_started_at[:4]),
+            "metrics": metrics.snapshot(),
+        }
+
+
+def histogram_means(result: Dict) -> Dict[str, float]:
+    return {
+        name: histogram["sum"] / histogram["count"]
+        for name, histogram in result["metrics"]["histograms"].items()
+        if histogram["count"]
+    }
+
+
+def compare(base: Dict, current: Dict):
+    # Ratio to the base run; > 1 means slower or more CPU than the base.
+    for key in ("wall_seconds", "cpu_seconds"):
+        if base[key]:
+            print(f"{key:>40} {current[key] / base[key]:6.2f}x {current[key]:10.3f}")
+    base_means = histogram_means(base)
+    for name, mean in sorted(histogram_means(current).items()):
+        if base_means.get(name):
+            print(f"{name:>40} {mean / base_means[name]:6.2f}x {mean:10.3f}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Replay a session trace")
+    parser.add_argument("trace")
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("--settle", type=float, default=5.0, help="Seconds to run after the last event")
+    parser.add_argument("--output", help="Write results as JSON to this path")
+    parser.add_argument("--compare", help="Compare with a previous JSON result")
+    args = parser.parse_args()
+
+    events = load_trace(args.trace)
+    work_dir = tempfile.mkdtemp(prefix="futarin-replay-")
+    config_path = write_config(work_dir, events[0], free_port(), free_port())
+    sys.argv = [sys.argv[0], "--config-file", config_path]
+    os.environ.setdefault("GPIOZERO_PIN_FACTORY", "mock")
+
+    current = asyncio.run(Replay(args.trace, events, args.speed, args.settle).run())
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=2)
+    else:
+        json.dump(current, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), current)
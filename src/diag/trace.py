@@ -0,0 +1,98 @@
+import json
+import threading
+from os import makedirs, path
+from time import monotonic, time
+from typing import BinaryIO, Callable, Optional
+import src.config.config as config
+from src.log.log import log
+
+
+# Session trace recorder (trace_output = "session.trace.ndjson"). One JSON
+# event per line, "t" in seconds since the start:
+#   {"type": "start", "version": 1, "wall": ..., "id": ...}
+#   {"type": "button", "button": "main", "edge": "press", "idle": true}
+#   {"type": "ws", "data": "{\"type\": \"message\", \"id\": 3}"}
+#   {"type": "http", "method": "POST", "endpoint": ..., "status": 200,
+#    "request_bytes": ..., "response_bytes": ..., "upload_seconds": ...,
+#    "elapsed": ..., "content_type": ...}
+#   {"type": "audio", "kind": "record", "file": "1.wav", "bytes": ...}
+# With trace_audio, recordings are saved next to the trace in
+# <trace_output>.audio/. Played back by src/diag/replay.py.
+
+TRACE_OUTPUT = config.get("trace_output")
+TRACE_AUDIO = config.get("trace_audio")
+TRACE_VERSION = 1
+
+
+class TraceRecorder:
+    def __init__(self, output: str = TRACE_OUTPUT, audio: bool = TRACE_AUDIO):
+        self.logger = log.get_logger("Trace")
+        self.output = output
+        self.audio_dir = f"{output}.audio"
+        self.record_audio = audio
+        self.lock = threading.Lock()
+        self.file = None
+        self.started_at = 0.0
+        self.audio_count = 0
+
+    def enabled(self) -> bool:
+        return self.file is not None
+
+    def start(self):
+        if not self.output or self.file is not None:
+            return
+        self.logger.info(f"Start recording trace. ({self.output=}, {self.record_audio=})")
+        if self.record_audio:
+            makedirs(self.audio_dir, exist_ok=True)
+        self.file = open(self.output, "a", encoding="utf-8")
+        self.started_at = monotonic()
+        self.event(
+            "start", version=TRACE_VERSION, wall=round(time(), 3), id=config.get("id")
+        )
+
+    def stop(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def event(self, event_type: str, **fields):
+        # Called from the loop, gpiozero and audio threads.
+        if self.file is None:
+            return
+        record = {"t": round(monotonic() - self.started_at, 4), "type": event_type}
+        record.update(fields)
+        with self.lock:
+            if self.file is not None:
+                self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+                self.file.flush()
+
+    def watch_buttons(self, button, idle: Callable[[], bool]):
+        if self.file is None:
+            return
+        for name, device in (("main", button.main), ("sub", button.sub)):
+            device.when_pressed = self.on_edge(name, "press", idle)
+            device.when_released = self.on_edge(name, "release", idle)
+
+    def on_edge(self, name: str, edge: str, idle: Callable[[], bool]):
+        # idle: whether Main was waiting for input, so that replay can wait
+        # for the same state before pressing.
+        return lambda: self.event("button", button=name, edge=edge, idle=idle())
+
+    def audio(self, kind: str, file: BinaryIO):
+        if self.file is None:
+            return
+        fields = {"kind": kind, "bytes": file.seek(0, 2)}
+        file.seek(0)
+        if self.record_audio:
+            with self.lock:
+                self.audio_count += 1
+                file_name = f"{self.audio_count}.wav"
+            with open(path.join(self.audio_dir, file_name), "wb") as f:
+                f.write(file.read())
+            file.seek(0)
+            fields["file"] = file_name
+        self.event("audio", **fields)
+
+
+tracer = TraceRecorder()
@@ -0,0 +1,108 @@
+import asyncio
+import sys
+import threading
+import traceback
+from os import path, sep
+from time import monotonic
+from typing import Optional
+import src
+import src.config.config as config
+from src.diag.profiler import frame_label
+from src.metrics.metrics import metrics
+from src.log.log import log
+
+
+# Event loop lag watchdog. A task on the loop sleeps for INTERVAL and
+# records how late it wakes up (loop.lag_seconds). A thread watches the
+# task's heartbeat; when the loop has not come back for longer than the
+# threshold, it captures the loop thread's stack while it is still blocked.
+
+LAG_THRESHOLD = config.get("loop_lag_threshold")
+INTERVAL = 0.25
+STALL_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+FLIGHT_DUMP_INTERVAL = 10 * 60  # between flight recorder dumps for stalls
+SRC_DIR = path.dirname(path.abspath(src.__file__)) + sep
+
+
+def is_own_code(file_name: str) -> bool:
+    # Not the working directory: the service runs from the project root,
+    # which also holds .venv.
+    return file_name.startswith(SRC_DIR) and ".venv" not in file_name.split(sep)
+
+
+def blocking_call(frame) -> str:
+    # Innermost frame of our own code; the innermost one overall is usually
+    # a socket or lock call in the standard library.
+    while frame is not None:
+        if is_own_code(frame.f_code.co_filename):
+            return f"{frame_label(frame)} line {frame.f_lineno}"
+        frame = frame.f_back
+    return "unknown"
+
+
+class Watchdog:
+    def __init__(self):
+        self.logger = log.get_logger("Watchdog")
+        self.beat = monotonic()
+        self.loop_ident: Optional[int] = None
+        self.task: Optional[asyncio.Task] = None
+        self.thread: Optional[threading.Thread] = None
+        self.stop_event = threading.Event()
+        self.dumped_at: Optional[float] = None
+
+    def start(self):
+        if self.task is not None or LAG_THRESHOLD <= 0:
+            return
+        self.logger.info(f"Start watching event loop. ({LAG_THRESHOLD=})")
+        self.loop_ident = threading.get_ident()
+        self.beat = monotonic()
+        self.task = asyncio.create_task(self.run())
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.watch, name="Watchdog", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+
+    async def run(self):
+        while True:
+            self.beat = monotonic()
+            await asyncio.sleep(INTERVAL)
+            lag = max(monotonic() - self.beat - INTERVAL, 0)
+            metrics.histogram("loop.lag_seconds").observe(lag)
+            if lag > LAG_THRESHOLD:
+                metrics.histogram("loop.stall_seconds", STALL_BUCKETS).observe(lag)
+                self.logger.warn(f"Event loop was blocked. ({lag=:.3f}s)")
+
+    def watch(self):
+        reported_beat = None
+        while not self.stop_event.wait(INTERVAL / 2):
+            beat = self.beat
+            blocked = monotonic() - beat - INTERVAL
+            if blocked <= LAG_THRESHOLD or beat == reported_beat:
+                continue
+            # Report each stall once, while it is happening.
+            reported_beat = beat
+            frame = sys._current_frames().get(self.loop_ident)
+            if frame is None:
+                continue
+            metrics.counter("loop.stalls").inc()
+            stack = "".join(traceback.format_stack(frame))
+            extra = {}
+            now = monotonic()
+            if self.dumped_at is None or now - self.dumped_at > FLIGHT_DUMP_INTERVAL:
+                self.dumped_at = now
+                extra["flight_dump"] = "loop_stall"
+            self.logger.warn(
+                f"Event loop blocked. ({blocked=:.3f}s, call={blocking_call(frame)})\n{stack}",
+                extra=extra,
+            )
+
+
+watchdog = Watchdog()
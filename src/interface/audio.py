@@ -0,0 +1,249 @@
+from pyaudio import PyAudio
+from typing import Any, Callable, Dict, Generator, Literal, Optional
+from os import makedirs, path, replace
+import asyncio
+import json
+import threading
+import src.config.config as config
+from src.metrics.metrics import metrics
+from src.log.log import log
+
+
+ADAPTIVE_BUFFERS = config.get("adaptive_audio_buffers")
+BUFFERS_FILE_PATH = path.join(config.get("cache_dir"), "audio_buffers.json")
+CHUNK_MIN = 256
+CHUNK_MAX = 1024 * 16
+SHRINK_AFTER = 5  # clean streams in a row before trying a smaller chunk
+FORGET_AFTER = 50  # clean streams in a row before retrying sizes that had xruns
+LATENCY_BUCKETS = (0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5)
+
+Direction = Literal["input", "output"]
+
+
+class AudioEngine:
+    def __init__(self):
+        self.logger = log.get_logger("AudioEngine")
+        self.lock = threading.Lock()
+        self.py_audio: Optional[PyAudio] = None
+        self.device_indexes: Dict[str, Optional[int]] = {}
+        self.logger.info("Initialized.")
+
+    def get_py_audio(self) -> PyAudio:
+        with self.lock:
+            if self.py_audio is None:
+                self.logger.info("Start PortAudio.")
+                self.py_audio = PyAudio()
+            return self.py_audio
+
+    def get_device_index(self, device_name: str) -> Optional[int]:
+        py_audio = self.get_py_audio()
+        with self.lock:
+            if device_name in self.device_indexes:
+                return self.device_indexes[device_name]
+            index = None
+            for i in range(py_audio.get_device_count()):
+                if device_name in str(py_audio.get_device_info_by_index(i)["name"]):
+                    self.logger.info(f"Found device. ({device_name=}, {i=})")
+                    index = i
+                    break
+            else:
+                self.logger.error(f"Not found device. ({device_name=})")
+                return None
+            self.device_indexes[device_name] = index
+            return index
+
+    def warm_up(self, *device_names: str):
+        for device_name in device_names:
+            self.get_device_index(device_name)
+
+    def terminate(self):
+        with self.lock:
+            if self.py_audio is not None:
+                self.py_audio.terminate()
+                self.py_audio = None
+            self.device_indexes.clear()
+
+
+class BufferTuner:
+    # Chunk (and PortAudio buffer) size per device and direction. In adaptive
+    # mode a stream with xruns doubles the chunk and SHRINK_AFTER clean
+    # streams halve it, but not down to a size that has had xruns (until
+    # FORGET_AFTER clean streams). The sizes are kept in BUFFERS_FILE_PATH.
+    def __init__(self, adaptive: bool = ADAPTIVE_BUFFERS):
+        self.logger = log.get_logger("BufferTuner")
+        self.adaptive = adaptive
+        self.lock = threading.Lock()
+        self.devices: Dict[str, Dict] = {}
+        self.load()
+        self.logger.info(f"Initialized. ({adaptive=}, {self.devices=})")
+
+    def load(self):
+        try:
+            with open(BUFFERS_FILE_PATH) as f:
+                self.devices = json.load(f)
+        except FileNotFoundError:
+            return
+        except (json.JSONDecodeError, TypeError):
+            self.logger.error("Broken audio buffers file. Use default sizes.")
+
+    def save(self):
+        makedirs(path.dirname(BUFFERS_FILE_PATH) or ".", exist_ok=True)
+        temp_path = f"{BUFFERS_FILE_PATH}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.devices, f)
+        replace(temp_path, BUFFERS_FILE_PATH)
+
+    def state(self, device_name: str, direction: Direction, default: int) -> Dict:
+        key = f"{direction}:{device_name}"
+        if key not in self.devices:
+            self.devices[key] = {"chunk": default, "bad": 0, "clean": 0}
+        return self.devices[key]
+
+    def chunk(self, device_name: str, direction: Direction, default: int) -> int:
+        if not self.adaptive:
+            return default
+        with self.lock:
+            return self.state(device_name, direction, default)["chunk"]
+
+    def report(
+        self,
+        device_name: str,
+        direction: Direction,
+        chunk: int,
+        xruns: int,
+        seconds: float,
+        latency: float,
+    ):
+        metrics.counter(f"audio.{direction}.xruns").inc(xruns)
+        metrics.counter(f"audio.{direction}.seconds").inc(seconds)
+        metrics.histogram(f"audio.{direction}.latency", LATENCY_BUCKETS).observe(latency)
+        self.logger.info(
+            f"Stream closed. ({device_name=}, {direction=}, {chunk=}, {xruns=}, {seconds=:.2f}, {latency=:.4f})"
+        )
+        if not self.adaptive or seconds == 0:
+            return
+
+        with self.lock:
+            state = self.state(device_name, direction, chunk)
+            if state["chunk"] != chunk:
+                return  # tuned meanwhile by another stream
+            if xruns:
+                state["bad"] = max(state["bad"], chunk)
+                state["chunk"] = min(chunk * 2, CHUNK_MAX)
+                state["clean"] = 0
+            else:
+                state["clean"] += 1
+                if state["clean"] >= FORGET_AFTER:
+                    state["bad"] = 0
+                smaller = chunk // 2
+                if (
+                    state["clean"] >= SHRINK_AFTER
+                    and smaller >= CHUNK_MIN
+                    and smaller > state["bad"]
+                ):
+                    state["chunk"] = smaller
+                    state["clean"] = 0
+            if state["chunk"] != chunk:
+                self.logger.info(
+                    f"Chunk size changed. ({device_name=}, {direction=}, {chunk} -> {state['chunk']})"
+                )
+            if state["chunk"] != chunk or xruns:
+                self.save()
+
+
+class AudioHandle:
+    # Bridges a Mic/Speaker thread and asyncio: the thread reports progress and
+    # completion with report_*(), coroutines await the handle. Never blocks the
+    # event loop.
+    def __init__(self, name: str):
+        self.name = name
+        self.thread: Optional[threading.Thread] = None
+        self.stop_callback: Optional[Callable[[], None]] = None
+        self.finished = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.progress = 0.0  # seconds of audio played or recorded
+        try:
+            self.loop: Optional[asyncio.AbstractEventLoop] = asyncio.get_running_loop()
+        except RuntimeError:
+            self.loop = None
+        self.done_future: Optional[asyncio.Future] = (
+            self.loop.create_future() if self.loop else None
+        )
+        self.progress_event = asyncio.Event()
+        self.ready = threading.Event()
+        self.ready_event = asyncio.Event()
+
+    ### Thread side
+    def report_ready(self):
+        # The audio can start without delay (converted or decoding).
+        self.ready.set()
+        self.call_soon(self.ready_event.set)
+
+    def report_progress(self, seconds: float):
+        self.progress = seconds
+        self.call_soon(self.progress_event.set)
+
+    def report_finish(self, result: Any = None, error: Optional[BaseException] = None):
+        self.result = result
+        self.error = error
+        self.finished.set()
+        self.call_soon(self.set_done)
+
+    def call_soon(self, callback: Callable[[], None]):
+        if self.loop is None:
+            return
+        try:
+            self.loop.call_soon_threadsafe(callback)
+        except RuntimeError:
+            # Event loop already closed.
+            pass
+
+    def set_done(self):
+        if self.done_future and not self.done_future.done():
+            self.done_future.set_result(None)
+        self.progress_event.set()
+        self.ready_event.set()
+
+    ### Loop side
+    def done(self) -> bool:
+        return self.finished.is_set()
+
+    def stop(self):
+        if not self.done() and self.stop_callback:
+            self.stop_callback()
+
+    async def wait(self) -> Any:
+        if self.done_future is None:
+            await asyncio.to_thread(self.finished.wait)
+        elif not self.finished.is_set():
+            await asyncio.shield(self.done_future)
+        if self.error:
+            raise self.error
+        return self.result
+
+    def __await__(self) -> Generator[Any, None, Any]:
+        return self.wait().__await__()
+
+    async def wait_ready(self):
+        # Until the audio can start at once, or has finished.
+        if not self.ready.is_set() and not self.done():
+            await self.ready_event.wait()
+
+    async def cancel(self) -> Any:
+        self.stop()
+        return await self.wait()
+
+    async def wait_for_progress(self) -> float:
+        if not self.done():
+            self.progress_event.clear()
+            await self.progress_event.wait()
+        return self.progress
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        # For callers outside the event loop only.
+        return self.finished.wait(timeout)
+
+
+engine = AudioEngine()
+buffer_tuner = BufferTuner()
@@ -1,5 +1,6 @@
 import httpx
 from enum import Enum, auto
+from typing import Set
 import threading
 import src.config.config as config
 from src.log.log import log
@@ -7,9 +8,7 @@ from src.log.log import log
 
 RETRIES = 2
 CODE_SUCCESS = 202
-ORIGIN = config.get("led_server_origin")
 CHECK_INTERVAL = 0.2
-TRANSPORT = httpx.HTTPTransport(retries=RETRIES)
 
 
 class LedPattern(Enum):
@@ -49,9 +48,26 @@ led_endpoints = {
 }
 
 
+def new_client() -> httpx.Client:
+    return httpx.Client(transport=httpx.HTTPTransport(retries=RETRIES))
+
+
 class Led:
+    # One client (and connection) to futarin-led, reconnected when
+    # led_server_origin changes.
     def __init__(self):
         self.logger = log.get_logger("Led")
+        self.lock = threading.Lock()
+        self.origin = config.get("led_server_origin")
+        self.client = new_client()
+        config.subscribe(self.on_config_changed, ["led_server_origin"])
+
+    def on_config_changed(self, snapshot: config.Snapshot, keys: Set[str]):
+        with self.lock:
+            self.origin = snapshot.get("led_server_origin")
+            self.client.close()
+            self.client = new_client()
+        self.logger.info(f"Reconnect LED server. ({self.origin=})")
 
     def req(self, led_pattern: LedPattern):
         thread = threading.Thread(target=self.req_for_thread, args=(led_pattern,))
@@ -59,10 +75,10 @@ class Led:
 
     def req_for_thread(self, led_pattern: LedPattern):
         led_endpoint = led_endpoints[led_pattern]
-        url = f"{ORIGIN}{led_endpoint}"
-        with httpx.Client(transport=TRANSPORT) as client:
+        with self.lock:
+            url = f"{self.origin}{led_endpoint}"
             try:
-                r = client.post(url)
+                r = self.client.post(url)
                 if r.status_code == CODE_SUCCESS:
                     self.logger.info(f"Change LED pattern. ({led_pattern})")
                 else:
@@ -1,9 +1,11 @@
-from pyaudio import PyAudio, get_sample_size, paInt16
-from typing import Optional
+from pyaudio import get_sample_size, paContinue, paInputOverflow, paInt16
+from queue import Empty, Queue
+from typing import Set
 import wave
-from io import BytesIO
 import threading
 import src.config.config as config
+from src.interface.audio import engine, buffer_tuner, AudioHandle
+from src.util.spool import Spool
 from src.log.log import log
 
 
@@ -11,6 +13,9 @@ CHUNK = 1024 * 8
 FORMAT = paInt16
 CHANNELS = 2
 RATE = 44100
+MAX_RECORD_SECONDS = config.get("max_record_seconds")
+SPOOL_MAX_MEMORY = 1024 * 1024
+READ_TIMEOUT = 1
 
 
 class RecordThread(threading.Thread):
@@ -24,13 +29,38 @@ class RecordThread(threading.Thread):
         self.device_name = device_name
         self.logger = logger
         self.stop_req = False
+        self.overflows = 0
+        self.chunks: Queue = Queue()
+        self.handle = AudioHandle(name)
+        self.handle.thread = self
+        self.handle.stop_callback = self.stop
         self.logger.info("Initialized.")
 
     def run(self):
         self.logger.info("Run.")
-        py_audio = PyAudio()
-        buffer = BytesIO()
+        try:
+            self.record()
+        except Exception as e:
+            self.logger.exception("Failed to record.")
+            self.handle.report_finish(error=e)
+        else:
+            self.handle.report_finish(self.buffer)
+
+    def callback(self, in_data, frame_count, time_info, status_flags):
+        # PortAudio thread: only hand the data over.
+        if status_flags & paInputOverflow:
+            self.overflows += 1
+        self.chunks.put(in_data)
+        return (None, paContinue)
+
+    def record(self):
+        py_audio = engine.get_py_audio()
+        chunk = buffer_tuner.chunk(self.device_name, "input", CHUNK)
+        # Memory stays bounded: the recording spills to a temp file once it
+        # outgrows SPOOL_MAX_MEMORY.
+        buffer = Spool(SPOOL_MAX_MEMORY, name="record")
         buffer.name = "record.wav"
+        max_frames = int(MAX_RECORD_SECONDS * RATE)
 
         with wave.open(buffer, "wb") as wf:
             wf.setnchannels(CHANNELS)
@@ -38,37 +68,54 @@ class RecordThread(threading.Thread):
             wf.setframerate(RATE)
 
             self.logger.info("Start recording.")
+            # Callback mode, so that PortAudio's overflow flags are visible.
             stream = py_audio.open(
                 format=FORMAT,
                 channels=CHANNELS,
                 rate=RATE,
                 input=True,
-                input_device_index=self.get_device_index(py_audio),
+                input_device_index=engine.get_device_index(self.device_name),
+                frames_per_buffer=chunk,
+                stream_callback=self.callback,
+            )
+            frame_size = CHANNELS * get_sample_size(FORMAT)
+            frames = 0
+            # The device cannot be opened again while the stream is open.
+            try:
+                while True:
+                    if self.stop_req:
+                        self.logger.info("Stop recording.")
+                        break
+                    elif frames >= max_frames:
+                        self.logger.warn(
+                            f"Reached max record seconds. ({MAX_RECORD_SECONDS=})"
+                        )
+                        break
+                    try:
+                        data = self.chunks.get(timeout=READ_TIMEOUT)
+                    except Empty:
+                        if not stream.is_active():
+                            raise OSError("Input stream stopped.")
+                        continue
+                    wf.writeframes(data)
+                    frames += len(data) // frame_size
+                    self.handle.report_progress(frames / RATE)
+                latency = stream.get_input_latency()
+            finally:
+                stream.stop_stream()
+                stream.close()
+            if self.overflows:
+                self.logger.warn(
+                    f"Input overflow. ({self.overflows=})", extra={"flight_dump": "xrun"}
+                )
+            buffer_tuner.report(
+                self.device_name, "input", chunk, self.overflows, frames / RATE, latency
             )
-            while True:
-                if self.stop_req:
-                    self.logger.info("Stop recording.")
-                    break
-                else:
-                    wf.writeframes(stream.read(CHUNK, exception_on_overflow=False))
-
-            stream.close()
-            py_audio.terminate()
 
         self.logger.info("Finalize record.")
         buffer.seek(0)
         self.buffer = buffer
 
-    def get_device_index(self, py_audio: PyAudio = PyAudio()) -> Optional[int]:
-        for index in range(py_audio.get_device_count()):
-            if self.device_name in str(
-                py_audio.get_device_info_by_index(index)["name"]
-            ):
-                self.logger.info(f"Found speaker. ({index=})")
-                return index
-        self.logger.error("Not found mic.")
-        return None
-
     def stop(self):
         self.logger.info("Stop requested.")
         self.stop_req = True
@@ -81,12 +128,22 @@ class Mic:
     def __init__(self):
         self.logger = log.get_logger("Mic")
         self.device_name = config.get("mic_name")
+        config.subscribe(self.on_config_changed, ["mic_name"])
         self.logger.info("Initialized.")
 
-    def record(self) -> RecordThread:
+    def warm_up(self):
+        engine.warm_up(self.device_name)
+
+    def on_config_changed(self, snapshot: config.Snapshot, keys: Set[str]):
+        # Used from the next recording on.
+        self.device_name = snapshot.get("mic_name")
+        self.logger.info(f"Switch microphone. ({self.device_name=})")
+        self.warm_up()
+
+    def record(self) -> AudioHandle:
         thread = RecordThread(self.device_name)
         thread.start()
-        return thread
+        return thread.handle
 
 
 mic = Mic()
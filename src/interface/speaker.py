@@ -1,19 +1,27 @@
-from pyaudio import PyAudio
+import heapq
+import itertools
 import threading
 import wave
 from io import BytesIO
-from typing import BinaryIO, Optional
-from pydub import AudioSegment
+from typing import BinaryIO, List, Optional, Set, Tuple
+from pyaudio import paOutputUnderflowed
 import src.config.config as config
+from src.interface.audio import engine, buffer_tuner, AudioHandle
+from src.audio.offload import audio_worker
+from src.audio.codec import ReplyFormat
+from src.audio.decoder import StreamDecoder, SAMPLE_WIDTH
 from src.log.log import log
-from enum import Enum, auto
-from os import PathLike
+from enum import Enum, IntEnum, auto
+from os import PathLike, path as os_path
 from typing import Dict
 
 
-DELTA_VOLUME = config.get("delta_volume")
 RATE = 44100
+CHANNELS = 1  # of decoded compressed audio, same as the prompts
 CHUNK = 1024 * 4
+IDLE_CLOSE = 5  # seconds to keep the stopped stream before closing it
+
+StreamFormat = Tuple[int, int, int]  # (sample width, channels, rate)
 
 
 class LocalVox(Enum):
@@ -25,6 +33,7 @@ class LocalVox(Enum):
     NormalMode = auto()
     SendMessage = auto()
     ReceiveMessage = auto()
+    PleaseWait = auto()
     Fail = auto()
 
 
@@ -38,97 +47,414 @@ local_vox_paths: Dict[LocalVox, str | PathLike] = {
     LocalVox.NormalMode: "assets/vox/normal.wav",
     LocalVox.SendMessage: "assets/vox/send_message.wav",
     LocalVox.ReceiveMessage: "assets/vox/receive_message.wav",
+    LocalVox.PleaseWait: "assets/vox/please_wait.wav",
+}
+
+
+class Priority(IntEnum):
+    Normal = 0
+    Alert = 10  # preempts whatever is playing
+
+
+local_vox_priorities: Dict[LocalVox, Priority] = {
+    LocalVox.Fail: Priority.Alert,
 }
 
 
-class PlayThread(threading.Thread):
+def convert(file: BinaryIO) -> BytesIO:
+    return audio_worker.convert(file, RATE, config.get("delta_volume"))
+
+
+class WavSource:
+    def __init__(self, file: BinaryIO, converted: bool):
+        self.wave = wave.open(file if converted else convert(file), "rb")
+        self.format: StreamFormat = (
+            self.wave.getsampwidth(),
+            self.wave.getnchannels(),
+            self.wave.getframerate(),
+        )
+
+    def read(self, frames: int) -> bytes:
+        return self.wave.readframes(frames)
+
+    def close(self):
+        self.wave.close()
+
+
+class DecodedSource:
+    # Resampling and volume are done by the decoder.
+    def __init__(self, file: BinaryIO, audio_format: ReplyFormat):
+        self.decoder = StreamDecoder(
+            file, audio_format, RATE, CHANNELS, config.get("delta_volume")
+        )
+        self.decoder.start()
+        self.format: StreamFormat = (SAMPLE_WIDTH, CHANNELS, RATE)
+
+    def read(self, frames: int) -> bytes:
+        return self.decoder.read(frames)
+
+    def close(self):
+        self.decoder.close()
+
+
+class PlaybackItem:
     def __init__(
         self,
         file: BinaryIO,
-        device_name,
-        logger=log.get_logger("SpeakerPlayThread"),
-        name="Speaker-Play",
+        converted: bool,
+        audio_format: ReplyFormat,
+        priority: Priority,
+        seq: int,
     ):
-        super().__init__(name=name, daemon=True)
         self.file = file
+        self.converted = converted
+        self.audio_format = audio_format
+        self.priority = priority
+        self.seq = seq
+        self.stop_req = False
+        self.handle = AudioHandle(f"Speaker-Item-{seq}")
+        self.lock = threading.Lock()
+        self.preparing = False
+        self.discarded = False
+        self.prepared = threading.Event()
+        self.source: Optional[WavSource | DecodedSource] = None
+        self.error: Optional[Exception] = None
+
+    def __lt__(self, other: "PlaybackItem") -> bool:
+        # Higher priority first, then in order of enqueue.
+        return (-self.priority, self.seq) < (-other.priority, other.seq)
+
+    def open(self):
+        if self.audio_format == ReplyFormat.Wav:
+            return WavSource(self.file, self.converted)
+        return DecodedSource(self.file, self.audio_format)
+
+    def prepare(self):
+        # Convert, or start decoding, ahead of playback. Runs once, on the
+        # prepare thread or on the playback thread, whichever comes first.
+        with self.lock:
+            if self.preparing:
+                return
+            self.preparing = True
+        source, error = None, None
+        try:
+            source = self.open()
+        except Exception as e:
+            error = e
+        with self.lock:
+            if self.discarded:
+                discard, source = source, None
+            else:
+                discard = None
+            self.source, self.error = source, error
+        if discard is not None:
+            discard.close()
+        self.prepared.set()
+        self.handle.report_ready()
+
+    def take_source(self) -> WavSource | DecodedSource:
+        self.prepare()
+        self.prepared.wait()
+        if self.error:
+            raise self.error
+        return self.source
+
+    def discard(self):
+        # Closes the source, also when it is still being prepared, and then
+        # the file, which the queue owns once it is enqueued.
+        with self.lock:
+            self.discarded = True
+            source, self.source = self.source, None
+        if source is not None:
+            source.close()
+        self.file.close()
+
+
+class PlaybackQueue(threading.Thread):
+    # Plays queued items one after another on one output stream. The stream
+    # stays open while items of the same format follow each other, so there
+    # is no gap and no device reopen between them. An item with a higher
+    # priority than the playing one stops it (preemption). The next item is
+    # prepared on another thread while the current one plays.
+    def __init__(self, device_name, logger=log.get_logger("SpeakerQueue")):
+        super().__init__(name="Speaker-Queue", daemon=True)
         self.device_name = device_name
+        self.next_device_name = device_name  # switched to at the next stream open
         self.logger = logger
-        self.stop_req = False
-        self.logger.info("Initialized")
+        self.condition = threading.Condition()
+        self.items: List[PlaybackItem] = []
+        self.current: Optional[PlaybackItem] = None
+        self.seq = itertools.count()
+        self.stream = None
+        self.stream_format: Optional[StreamFormat] = None
+        self.chunk = CHUNK
+        self.frames = 0
+        self.underflows = 0
+        self.prepare_thread = threading.Thread(
+            target=self.run_prepare, name="Speaker-Prepare", daemon=True
+        )
+
+    def start(self):
+        super().start()
+        self.prepare_thread.start()
+
+    def enqueue(
+        self,
+        file: BinaryIO,
+        converted: bool,
+        audio_format: ReplyFormat,
+        priority: Priority,
+    ) -> AudioHandle:
+        item = PlaybackItem(file, converted, audio_format, priority, next(self.seq))
+        item.handle.thread = self
+        item.handle.stop_callback = lambda: self.cancel(item)
+        with self.condition:
+            heapq.heappush(self.items, item)
+            if self.current is not None and priority > self.current.priority:
+                self.logger.info(f"Preempt playing item. ({priority=})")
+                self.current.stop_req = True
+            self.condition.notify_all()
+        return item.handle
+
+    def cancel(self, item: PlaybackItem):
+        with self.condition:
+            if item is self.current:
+                self.logger.info("Stop requested.")
+                item.stop_req = True
+                return
+            if item not in self.items:
+                return
+            self.items.remove(item)
+            heapq.heapify(self.items)
+            self.condition.notify_all()
+        item.discard()
+        item.handle.report_finish()
+
+    def cancel_pending(self):
+        with self.condition:
+            items = self.items
+            self.items = []
+        self.logger.info(f"Cancel pending items. ({len(items)=})")
+        for item in items:
+            item.discard()
+            item.handle.report_finish()
 
     def run(self):
-        self.logger.info("Run")
-        self.logger.info("Convert framerate and volume.")
-        with wave.open(self.file, "rb") as wf:
-            audio = AudioSegment.from_raw(
-                self.file,
-                sample_width=wf.getsampwidth(),
-                frame_rate=wf.getframerate(),
-                channels=wf.getnchannels(),
-            )
-            audio = audio.set_frame_rate(RATE) + DELTA_VOLUME
-            processed_file = BytesIO()
-            processed_file = audio.export(processed_file, format="wav")
-
-        with wave.open(processed_file, "rb") as wf:
-            p = PyAudio()
-            stream = p.open(
-                format=p.get_format_from_width(wf.getsampwidth()),
-                channels=wf.getnchannels(),
-                rate=wf.getframerate(),
+        # Nothing here may end the thread: every handle must be finished,
+        # or whoever awaits it waits forever.
+        while True:
+            item = self.next_item()
+            error: Optional[Exception] = None
+            try:
+                self.play(item)
+                with self.condition:
+                    last = not self.items
+                if last:
+                    self.stop_stream()
+            except Exception as e:
+                self.logger.exception("Failed to play sound.")
+                error = e
+                self.discard_stream()
+            finally:
+                with self.condition:
+                    self.current = None
+                item.handle.report_finish(error=error)
+
+    def run_prepare(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(
+                    lambda: self.items and not self.items[0].preparing
+                )
+                item = self.items[0]
+            item.prepare()
+
+    def next_item(self) -> PlaybackItem:
+        with self.condition:
+            if not self.items and self.stream is not None:
+                try:
+                    # Nothing left: let the buffered audio play out.
+                    self.stop_stream()
+                    if not self.condition.wait_for(lambda: self.items, IDLE_CLOSE):
+                        self.close_stream()
+                except Exception:
+                    self.logger.exception("Failed to stop stream.")
+                    self.discard_stream()
+            self.condition.wait_for(lambda: self.items)
+            item = heapq.heappop(self.items)
+            self.current = item
+            self.condition.notify_all()  # the prepare thread moves on
+            return item
+
+    def play(self, item: PlaybackItem):
+        try:
+            source = item.take_source()
+            self.ensure_stream(source.format)
+            _, _, frame_rate = source.format
+            frames = 0
+            self.logger.info(f"Start playing sound. ({item.audio_format=}, {item.priority=})")
+            while not item.stop_req and len(data := source.read(self.chunk)):
+                self.write(data)
+                frames += self.chunk
+                item.handle.report_progress(frames / frame_rate)
+            if item.stop_req:
+                self.logger.info("Stop playing sound.")
+                with self.condition:
+                    last = not self.items
+                if last:
+                    # Cut off now instead of playing out the buffer.
+                    self.close_stream()
+            else:
+                self.logger.info("Finish playing sound.")
+        finally:
+            item.discard()
+
+    def set_device(self, device_name: str):
+        self.next_device_name = device_name
+
+    def ensure_stream(self, stream_format: StreamFormat):
+        if self.stream is not None and self.stream_format != stream_format:
+            self.logger.info(f"Stream format changed. ({stream_format=})")
+            self.close_stream()
+        if self.next_device_name != self.device_name:
+            self.logger.info(f"Device changed. ({self.next_device_name=})")
+            self.close_stream()
+            self.device_name = self.next_device_name
+        if self.stream is None:
+            sample_width, channels, rate = stream_format
+            p = engine.get_py_audio()
+            self.chunk = buffer_tuner.chunk(self.device_name, "output", CHUNK)
+            self.stream = p.open(
+                format=p.get_format_from_width(sample_width),
+                channels=channels,
+                rate=rate,
                 output=True,
-                output_device_index=self.get_device_index(p),
+                output_device_index=engine.get_device_index(self.device_name),
+                frames_per_buffer=self.chunk,
             )
+            self.stream_format = stream_format
+        elif self.stream.is_stopped():
+            self.stream.start_stream()
 
-            self.logger.info("Start playing sound.")
+    def write(self, data: bytes):
+        try:
+            self.stream.write(data, exception_on_underflow=True)
+        except OSError as e:
+            # The chunk has been written even when underflow is reported.
+            if e.errno != paOutputUnderflowed:
+                raise
+            self.underflows += 1
+            if self.underflows == 1:
+                self.logger.warn("Output underflow.", extra={"flight_dump": "xrun"})
+        self.frames += len(data) // (self.stream_format[0] * self.stream_format[1])
 
-            while len(data := wf.readframes(CHUNK)):
-                if not self.stop_req:
-                    stream.write(data)
-                else:
-                    self.logger.info("Stop playing sound.")
-                    break
+    def stop_stream(self):
+        if self.stream is None or self.stream.is_stopped():
+            return
+        latency = self.stream.get_output_latency()
+        self.stream.stop_stream()
+        self.report(latency)
+
+    def discard_stream(self):
+        # After an error, when the stream may be unusable.
+        stream, self.stream = self.stream, None
+        if stream is None:
+            return
+        try:
             stream.close()
-            p.terminate()
-            self.logger.info("Finish playing sound.")
+        except Exception:
+            self.logger.exception("Failed to close stream.")
 
-    def get_device_index(self, py_audio: PyAudio = PyAudio()) -> Optional[int]:
-        for index in range(py_audio.get_device_count()):
-            if self.device_name in str(
-                py_audio.get_device_info_by_index(index)["name"]
-            ):
-                self.logger.info(f"Found speaker. ({index=})")
-                return index
-        self.logger.error("Not found speaker.")
-        return None
+    def close_stream(self):
+        if self.stream is None:
+            return
+        latency = self.stream.get_output_latency()
+        stopped = self.stream.is_stopped()
+        self.stream.close()  # discards buffered audio
+        self.stream = None
+        if not stopped:
+            self.report(latency)
 
-    def stop(self):
-        self.logger.info("Stop requested.")
-        self.stop_req = True
+    def report(self, latency: float):
+        buffer_tuner.report(
+            self.device_name,
+            "output",
+            self.chunk,
+            self.underflows,
+            self.frames / self.stream_format[2],
+            latency,
+        )
+        self.frames = 0
+        self.underflows = 0
 
 
 class Speaker:
     def __init__(self):
         self.logger = log.get_logger("Speaker")
         self.device_name = config.get("speaker_name")
+        self.prompt_cache: Dict[LocalVox, bytes] = {}
+        self.queue = PlaybackQueue(self.device_name)
+        self.queue.start()
+        config.subscribe(self.on_config_changed, ["speaker_name", "delta_volume"])
         self.logger.info("Initialized")
 
-    def play_local_vox(self, local_vox: LocalVox) -> PlayThread:
+    def warm_up(self):
+        engine.warm_up(self.device_name)
+
+    def on_config_changed(self, snapshot: config.Snapshot, keys: Set[str]):
+        if "speaker_name" in keys:
+            self.device_name = snapshot.get("speaker_name")
+            self.logger.info(f"Switch speaker. ({self.device_name=})")
+            self.warm_up()
+            self.queue.set_device(self.device_name)
+        if "delta_volume" in keys and self.prompt_cache:
+            self.load_prompt_cache()
+
+    def load_prompt_cache(self):
+        self.logger.info("Load prompt cache.")
+        prompt_cache = {}
+        for local_vox, path in local_vox_paths.items():
+            if not os_path.exists(path):
+                self.logger.warn(f"Local vox not found. ({local_vox=}, {path=})")
+                continue
+            with open(path, "rb") as bf:
+                prompt_cache[local_vox] = convert(BytesIO(bf.read())).getvalue()
+        self.prompt_cache = prompt_cache
+        self.logger.info(f"Prompt cache loaded. ({len(prompt_cache)=})")
+
+    def play_local_vox(self, local_vox: LocalVox) -> AudioHandle:
         self.logger.info(f"play local vox. ({local_vox=})")
+        priority = local_vox_priorities.get(local_vox, Priority.Normal)
+        if local_vox in self.prompt_cache:
+            return self.play(
+                BytesIO(self.prompt_cache[local_vox]), converted=True, priority=priority
+            )
         path = local_vox_paths[local_vox]
-        return self.play_by_path(path)
+        return self.play_by_path(path, priority)
 
-    def play_by_path(self, path: str | PathLike) -> PlayThread:
+    def play_by_path(
+        self, path: str | PathLike, priority: Priority = Priority.Normal
+    ) -> AudioHandle:
         self.logger.info(f"Play sound by path. ({path=})")
         with open(path, "rb") as bf:
             buffer_file = BytesIO(bf.read())
-            return self.play(buffer_file)
+            return self.play(buffer_file, priority=priority)
+
+    def play(
+        self,
+        file: BinaryIO,
+        converted: bool = False,
+        audio_format: ReplyFormat = ReplyFormat.Wav,
+        priority: Priority = Priority.Normal,
+    ) -> AudioHandle:
+        # Queued after what is already playing; await the handle to wait for
+        # this item. The file is closed once the item has played or has been
+        # cancelled.
+        self.logger.info(f"Play sound. ({audio_format=}, {priority=})")
+        return self.queue.enqueue(file, converted, audio_format, priority)
 
-    def play(self, file: BinaryIO) -> PlayThread:
-        self.logger.info("Play sound.")
-        thread = PlayThread(file, self.device_name)
-        thread.start()
-        return thread
+    def cancel_pending(self):
+        self.queue.cancel_pending()
 
 
 speaker = Speaker()
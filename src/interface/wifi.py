@@ -1,25 +1,153 @@
 import asyncio
-from typing import Optional
+from enum import Enum, auto
+from typing import Callable, List, NamedTuple, Optional
+import src.config.config as config
+from src.log.log import log
 
 
 PING_INTERVAL = 10
+INTERFACE = config.get("wifi_interface")
+SAMPLE_INTERVAL = config.get("wifi_sample_interval")
+WIRELESS_PATH = "/proc/net/wireless"
+SMOOTHING = 0.3  # EWMA weight of the newest sample
+HYSTERESIS = 3  # dBm
+LEVEL_HIGH = -60  # dBm
+LEVEL_MIDDLE = -70  # dBm
+NOISE_UNKNOWN = -256
 
 
-class Wifi:
-    ## TODO
-    async def wait_for_enable(self):
-        while not await self.strength():
-            await asyncio.sleep(PING_INTERVAL)
+class WifiLevel(Enum):
+    High = auto()
+    Middle = auto()
+    Low = auto()
+    Disconnect = auto()
+
+
+class LinkQuality(NamedTuple):
+    link: float
+    level: float  # dBm
+    noise: Optional[float]  # dBm, None if the driver does not report it
+
+
+WifiSubscriber = Callable[[WifiLevel, Optional[LinkQuality]], None]
+
 
-    async def strength(self) -> Optional[int]:
+def read_link_quality(interface: str = INTERFACE) -> Optional[LinkQuality]:
+    # /proc/net/wireless:
+    #  face | tus | link level noise | ...
+    #  wlan0: 0000   54.  -56.  -256 ...
+    with open(WIRELESS_PATH) as f:
+        for line in f.readlines()[2:]:
+            name, _, values = line.partition(":")
+            if name.strip() != interface:
+                continue
+            fields = values.split()
+            link, level, noise = (float(field.rstrip(".")) for field in fields[1:4])
+            return LinkQuality(
+                link, level, None if noise <= NOISE_UNKNOWN else noise
+            )
+    return None
+
+
+def smooth(new: Optional[float], old: Optional[float]) -> Optional[float]:
+    if new is None:
         return None
-        # proc = await asyncio.create_subprocess_shell(
-        #     ["sudo", "iw", "dev"],
-        #     stdout=asyncio.subprocess.PIPE,
-        #     stderr=asyncio.subprocess.PIPE,
-        # )
-        # stdout, stderr = await proc.communicate()
-        # # TODO: stdoutからtxpowerを正規表現で取り出す
+    return new if old is None else old + SMOOTHING * (new - old)
+
+
+def classify(level: float, current: WifiLevel) -> WifiLevel:
+    # Thresholds move away from the current level by HYSTERESIS so that a
+    # signal hovering around a boundary does not flap.
+    rank = [WifiLevel.Low, WifiLevel.Middle, WifiLevel.High]
+    current_rank = rank.index(current) if current in rank else -1
+    result = WifiLevel.Low
+    for index, threshold in ((1, LEVEL_MIDDLE), (2, LEVEL_HIGH)):
+        margin = HYSTERESIS if index > current_rank else -HYSTERESIS
+        if level >= threshold + margin:
+            result = rank[index]
+    return result
+
+
+class Wifi:
+    def __init__(self):
+        self.logger = log.get_logger("Wifi")
+        self.level = WifiLevel.Disconnect
+        self.quality: Optional[LinkQuality] = None
+        self.available = True
+        self.subscribers: List[WifiSubscriber] = []
+        self.changed = asyncio.Event()
+        self.monitor_task: Optional[asyncio.Task] = None
+        self.logger.info("Initialized.")
+
+    def subscribe(self, subscriber: WifiSubscriber):
+        self.subscribers.append(subscriber)
+
+    def unsubscribe(self, subscriber: WifiSubscriber):
+        if subscriber in self.subscribers:
+            self.subscribers.remove(subscriber)
+
+    def start_monitoring(self):
+        self.sample()
+        if self.monitor_task is None:
+            self.monitor_task = asyncio.create_task(self.run_monitor())
+
+    def stop_monitoring(self):
+        if self.monitor_task:
+            self.monitor_task.cancel()
+            self.monitor_task = None
+
+    async def run_monitor(self):
+        self.logger.info(f"Start monitoring. ({INTERFACE=}, {SAMPLE_INTERVAL=})")
+        while self.available:
+            await asyncio.sleep(SAMPLE_INTERVAL)
+            self.sample()
+
+    def sample(self):
+        try:
+            quality = read_link_quality()
+        except (OSError, ValueError) as e:
+            self.logger.warn(f"Failed to read link quality. Stop monitoring. ({e=})")
+            self.available = False
+            return
+
+        if quality is None:
+            self.quality = None
+            self.publish(WifiLevel.Disconnect)
+            return
+
+        if self.quality is not None:
+            quality = LinkQuality(
+                *(smooth(new, old) for new, old in zip(quality, self.quality))
+            )
+        self.quality = quality
+        self.publish(classify(quality.level, self.level))
+
+    def publish(self, level: WifiLevel):
+        if level == self.level:
+            return
+        self.logger.info(f"Wi-Fi level changed. ({self.level} -> {level}, {self.quality=})")
+        self.level = level
+        self.changed.set()
+        self.changed = asyncio.Event()
+        for subscriber in list(self.subscribers):
+            try:
+                subscriber(level, self.quality)
+            except Exception:
+                self.logger.exception("Wi-Fi subscriber failed.")
+
+    def is_disconnected(self) -> bool:
+        return self.available and self.level == WifiLevel.Disconnect
+
+    async def wait_for_change(self, timeout: Optional[float] = None) -> WifiLevel:
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.level
+
+    async def wait_for_enable(self):
+        while self.is_disconnected():
+            await self.wait_for_change(PING_INTERVAL)
 
 
 wifi = Wifi()
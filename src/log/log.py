@@ -1,42 +1,222 @@
-from logging import getLogger, Formatter, StreamHandler, FileHandler, Logger, DEBUG
+from logging import (
+    getLogger,
+    Formatter,
+    Handler,
+    StreamHandler,
+    Logger,
+    LogRecord,
+    DEBUG,
+    INFO,
+    ERROR,
+)
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from collections import deque
+from queue import Queue, Full
+from time import time
+from typing import Deque, Dict, Tuple
+import atexit
 import json
 
 LOG_FILE_NAME = "futarin-raspi.log"
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUP_COUNT = 3
+LOG_ROTATE_INTERVAL = 24 * 60 * 60
+FILE_LEVEL = INFO
+FLIGHT_RECORDER_FILE_NAME = "futarin-raspi.flight.log"
+FLIGHT_RECORDER_SIZE = 2000
+QUEUE_SIZE = 10000
+
+TARGET_CONSOLE = "console"
+TARGET_FILE = "file"
 
 
 class FileFormatter(Formatter):
+    # t: created, lv: level, n: logger name, src: file:line, fn: function,
+    # th: thread, m: message (includes traceback if any)
     def format(self, record):
-        return json.dumps(record.__dict__, default=str)
+        return json.dumps(
+            {
+                "t": round(record.created, 3),
+                "lv": record.levelname,
+                "n": record.name,
+                "src": f"{record.filename}:{record.lineno}",
+                "fn": record.funcName,
+                "th": record.threadName,
+                "m": record.getMessage(),
+            },
+            ensure_ascii=False,
+        )
+
+
+class SizeTimedRotatingFileHandler(RotatingFileHandler):
+    def __init__(self, filename, max_bytes: int, backup_count: int, interval: float):
+        super().__init__(
+            filename,
+            maxBytes=max_bytes,
+            backupCount=backup_count,
+            encoding="utf-8",
+            delay=True,
+        )
+        self.interval = interval
+        self.rollover_at = time() + interval
+
+    def shouldRollover(self, record):
+        if self.stream is None:
+            self.stream = self._open()
+        size = self.stream.tell()
+        if time() >= self.rollover_at:
+            if size > 0:
+                return True
+            self.rollover_at = time() + self.interval
+        return 0 < self.maxBytes <= size
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = time() + self.interval
+
+
+class FlightRecorderHandler(Handler):
+    # Keep recent records of every level in memory and write them out only
+    # when something goes wrong (ERROR or a record with `flight_dump` extra).
+    def __init__(self, dump_handler: Handler, size: int = FLIGHT_RECORDER_SIZE):
+        super().__init__(DEBUG)
+        self.dump_handler = dump_handler
+        self.ring: Deque[LogRecord] = deque(maxlen=size)
+        self.dumps = 0
+
+    def emit(self, record: LogRecord):
+        self.ring.append(record)
+        reason = getattr(record, "flight_dump", None)
+        if reason is None and record.levelno >= ERROR:
+            reason = record.levelname
+        if reason is not None:
+            self.dump(reason)
+
+    def dump(self, reason: str):
+        records = list(self.ring)
+        self.ring.clear()
+        self.dumps += 1
+        header = LogRecord(
+            "FlightRecorder",
+            INFO,
+            __file__,
+            0,
+            f"Dump flight recorder. ({reason=}, {len(records)=})",
+            None,
+            None,
+        )
+        for record in [header, *records]:
+            self.dump_handler.handle(record)
+        self.dump_handler.flush()
+
+
+class TargetQueueHandler(QueueHandler):
+    def __init__(self, queue: Queue, targets: Tuple[str, ...]):
+        super().__init__(queue)
+        self.targets = targets
+        self.dropped = 0
+
+    def prepare(self, record: LogRecord) -> LogRecord:
+        record = super().prepare(record)
+        record.log_targets = self.targets
+        return record
+
+    def enqueue(self, record: LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+def target_filter(target: str):
+    def filter(record: LogRecord) -> bool:
+        return target in getattr(record, "log_targets", ())
+
+    return filter
 
 
 class Log:
     def __init__(self):
-        self.loggers = []
+        self.loggers: Dict[str, Logger] = {}
+        self.queue: Queue = Queue(QUEUE_SIZE)
+        self.queue_handlers: Dict[Tuple[str, ...], TargetQueueHandler] = {}
+
         self.console_formatter = Formatter(
             "%(asctime)s.%(msecs)03d %(levelname)s [%(name)s] [%(filename)s:%(lineno)d %(funcName)s]: %(message)s",
             datefmt="%H:%M:%S",
         )
         self.file_formatter = FileFormatter()
-        self.file_handler = FileHandler(filename=LOG_FILE_NAME)
-        self.file_handler.setLevel(DEBUG)
+        self.file_handler = SizeTimedRotatingFileHandler(
+            LOG_FILE_NAME, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_ROTATE_INTERVAL
+        )
+        self.file_handler.setLevel(FILE_LEVEL)
         self.file_handler.setFormatter(self.file_formatter)
+        self.file_handler.addFilter(target_filter(TARGET_FILE))
+
+        self.flight_dump_handler = SizeTimedRotatingFileHandler(
+            FLIGHT_RECORDER_FILE_NAME,
+            LOG_MAX_BYTES,
+            LOG_BACKUP_COUNT,
+            LOG_ROTATE_INTERVAL,
+        )
+        self.flight_dump_handler.setLevel(DEBUG)
+        self.flight_dump_handler.setFormatter(self.file_formatter)
+        self.flight_recorder = FlightRecorderHandler(self.flight_dump_handler)
+        self.flight_recorder.addFilter(target_filter(TARGET_FILE))
 
         self.console_handler = StreamHandler()
         self.console_handler.setLevel(DEBUG)
         self.console_handler.setFormatter(self.console_formatter)
+        self.console_handler.addFilter(target_filter(TARGET_CONSOLE))
+
+        self.listener = QueueListener(
+            self.queue,
+            self.console_handler,
+            self.file_handler,
+            self.flight_recorder,
+            respect_handler_level=True,
+        )
+        self.listener.start()
+        atexit.register(self.stop)
 
         self.logger = self.get_logger("LoggerManager")
         self.logger.info("Initialized.")
 
     def get_logger(self, name: str, console: bool = True, file: bool = True) -> Logger:
+        targets = tuple(
+            target
+            for target, enabled in ((TARGET_CONSOLE, console), (TARGET_FILE, file))
+            if enabled
+        )
+        if targets not in self.queue_handlers:
+            self.queue_handlers[targets] = TargetQueueHandler(self.queue, targets)
+        queue_handler = self.queue_handlers[targets]
+
         logger = getLogger(name)
         logger.setLevel(DEBUG)
-        if console:
-            logger.addHandler(self.console_handler)
-        if file:
-            logger.addHandler(self.file_handler)
-        self.loggers.append(logger)
+        for handler in list(logger.handlers):
+            if isinstance(handler, TargetQueueHandler) and handler is not queue_handler:
+                logger.removeHandler(handler)
+        if queue_handler not in logger.handlers:
+            logger.addHandler(queue_handler)
+        self.loggers[name] = logger
         return logger
 
+    def dump_flight_recorder(self, reason: str):
+        # Dumped on the listener thread, after everything logged so far.
+        self.logger.info(
+            f"Flight recorder dump requested. ({reason=})",
+            extra={"flight_dump": reason},
+        )
+
+    def dropped(self) -> int:
+        return sum(handler.dropped for handler in self.queue_handlers.values())
+
+    def stop(self):
+        if self.listener._thread is not None:
+            self.listener.stop()
+        self.file_handler.close()
+        self.flight_dump_handler.close()
+
 
 log = Log()
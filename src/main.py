@@ -1,51 +1,142 @@
 import asyncio
-from typing import Optional
-from pydub import AudioSegment
-from pydub.exceptions import PydubException
+import signal
+from io import BytesIO
+from time import monotonic
+from typing import List, Optional
 from enum import Enum, auto
 
 
+import src.config.config as config
 from src.log.log import log
+from src.metrics.metrics import metrics
 from src.interface.mic import mic
 from src.backend.api import api
+from src.backend.inbox import inbox
+from src.backend.log_shipper import log_shipper
+from src.audio.codec import wav_seconds
+from src.util.spool import Spool
 from src.interface.led import led, LedPattern
 from src.interface.speaker import speaker, LocalVox
 from src.interface.button import button, ButtonEnum
+from src.interface.audio import engine, AudioHandle
+from src.audio.offload import audio_worker
+from src.diag.profiler import profiler
+from src.diag.watchdog import watchdog
+from src.diag.memory import memory
+from src.diag.trace import tracer
+from src.interface.wifi import wifi, WifiLevel, LinkQuality
+from src.util.task_graph import TaskGraph
 
 ### Alias
 ct = asyncio.create_task
 
+PLEASE_WAIT_AFTER = config.get("please_wait_after")
+FIRST_BYTE_BUCKETS = (0.5, 1, 1.5, 2, 3, 5, 8, 13, 20, 30, 60)
+
 
 class Mode(Enum):
     Normal = auto()
     Message = auto()
 
 
+wifi_led_patterns = {
+    WifiLevel.High: LedPattern.WifiHigh,
+    WifiLevel.Middle: LedPattern.WifiMiddle,
+    WifiLevel.Low: LedPattern.WifiLow,
+    WifiLevel.Disconnect: LedPattern.WifiDisconnect,
+}
+
+
 class Main:
     def __init__(self):
         self.mode = Mode.Normal
+        self.idle = False
+        self.downloading = False
+        self.boot: Optional[TaskGraph] = None
+        self.boot_task: Optional[asyncio.Task] = None
         self.logger = log.get_logger("Main")
         self.logger.info("Initialized")
 
     async def main(self):
         self.logger.info("Start Main.main")
-        await self.setup()
-        await self.main_loop()
-        await self.shutdown()
+        profiler.start(asyncio.get_running_loop())
+        watchdog.start()
+        memory.start()
+        tracer.start()
+        metrics.start_logging()
+        try:
+            await self.setup()
+            await self.main_loop()
+            await self.shutdown()
+        finally:
+            metrics.stop_logging()
+            tracer.stop()
+            memory.stop()
+            watchdog.stop()
+            profiler.stop()
 
     async def setup(self):
-        led.req(LedPattern.SystemSetup)
-        await api.wait_for_connect()
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGUSR1, log.dump_flight_recorder, "signal"
+        )
 
-        await api.start_listening_notifications()
+        tracer.watch_buttons(button, lambda: self.idle)
+
+        boot = TaskGraph("Boot")
+        boot.add("led", lambda: asyncio.to_thread(led.req, LedPattern.SystemSetup))
+        boot.add(
+            "audio_warm_up",
+            lambda: asyncio.to_thread(
+                engine.warm_up, speaker.device_name, mic.device_name
+            ),
+        )
+        boot.add("audio_worker", lambda: asyncio.to_thread(audio_worker.start))
+        boot.add(
+            "prompt_cache",
+            lambda: asyncio.to_thread(speaker.load_prompt_cache),
+            depends=["audio_worker"],
+        )
+        boot.add("config_watch", lambda: asyncio.to_thread(config.start_watching))
+        boot.add("wifi_check", self.check_wifi)
+        boot.add("api_ping", api.wait_for_connect, depends=["wifi_check"])
+        boot.add(
+            "ws_negotiate", api.start_listening_notifications, depends=["api_ping"]
+        )
+        boot.add("log_shipper", self.start_log_shipper, depends=["api_ping"])
+        boot.start()
+        self.boot = boot
+        self.boot_task = ct(boot.run())
+
+    async def start_log_shipper(self):
+        log_shipper.start()
+
+    async def check_wifi(self):
+        wifi.subscribe(self.on_wifi_changed)
+        wifi.start_monitoring()
+        self.logger.info(f"Checked Wi-Fi. ({wifi.level=}, {wifi.quality=})")
+
+    def on_wifi_changed(self, level: WifiLevel, quality: Optional[LinkQuality]):
+        if self.idle:
+            led.req(wifi_led_patterns[level])
+
+    def get_wifi_led_pattern(self) -> LedPattern:
+        # Without wireless statistics (e.g. wired development boards) keep the
+        # previous behaviour.
+        if not wifi.available:
+            return LedPattern.WifiHigh
+        return wifi_led_patterns[wifi.level]
 
     async def main_loop(self):
         self.logger.info("Start Main.main_loop")
-        welcome_message_thread = speaker.play_local_vox(LocalVox.Welcome)
+        if self.boot:
+            await self.boot.wait_for("led")
+        welcome_message = speaker.play_local_vox(LocalVox.Welcome)
+        self.logger.info("Ready for local interaction.")
 
         while True:
             self.logger.info("Start loop.")
-            led.req(LedPattern.WifiHigh)
+            led.req(self.get_wifi_led_pattern())
+            self.idle = True
 
             self.logger.info("Wait for button to press or notifing.")
             done_task_index = await self.wait_multi_tasks(
@@ -53,33 +144,31 @@ class Main:
                 ct(button.wait_for_press_main()),
                 ct(button.wait_for_press_sub()),
             )
+            self.idle = False
 
             # Try to stop welcome message
-            if welcome_message_thread.is_alive():
+            if not welcome_message.done():
                 self.logger.info("Stop welcome message.")
-                welcome_message_thread.stop()
-                welcome_message_thread.join()
+                await welcome_message.cancel()
 
             # if notified
             if done_task_index == 0:
                 self.logger.debug("Notified.")
-                message_file = await api.get_message()
+                with log_shipper.paused():
+                    message_ids = await api.download_messages(
+                        self.on_download_progress
+                    )
 
-                if message_file:
-                    self.logger.error("Success to get message_file.")
+                if message_ids:
+                    self.logger.info(f"Success to get messages. ({message_ids=})")
                     led.req(LedPattern.Notifing)
                     await button.wait_for_press_main()
 
-                    playing_receive_message_thread = speaker.play_local_vox(
-                        LocalVox.ReceiveMessage
-                    )
-                    playing_receive_message_thread.join()
-
-                    led.req(LedPattern.AudioPlaying)
-                    speaker.play(message_file).join()
+                    if await self.play_messages(message_ids):
+                        await self.start_turn(barge_in=True)
 
                 else:
-                    self.logger.error("Failed to get message_file.")
+                    self.logger.error("Failed to get messages.")
 
             # if button pressed
             else:
@@ -91,12 +180,7 @@ class Main:
 
                 # if main button pressed
                 if pressed_button == ButtonEnum.Main:
-                    if self.mode == Mode.Normal:
-                        self.logger.debug("Call normal mode.")
-                        await self.normal()
-                    else:
-                        self.logger.debug("Call message mode.")
-                        await self.message()
+                    await self.start_turn()
                 # if sub button pressed
                 else:
                     # observer sub button
@@ -110,81 +194,205 @@ class Main:
                         self.logger.debug("Exit main_loop.")
                         return
 
+    async def start_turn(self, barge_in: bool = False):
+        # Log shipping must not take bandwidth or CPU from the turn.
+        with log_shipper.paused(), memory.turn():
+            if self.mode == Mode.Normal:
+                self.logger.debug("Call normal mode.")
+                await self.normal(barge_in)
+            else:
+                self.logger.debug("Call message mode.")
+                await self.message(barge_in)
+
+    def on_download_progress(self, received: int, total: Optional[int]):
+        if received and not self.downloading:
+            self.downloading = True
+            led.req(LedPattern.ApiProcessing)
+        if total and received >= total:
+            self.downloading = False
+
+    async def play_messages(self, message_ids: List[int]) -> bool:
+        # Queue the prompt and all messages at once so that they play without
+        # gaps. Return True on barge-in; the remaining messages are dropped
+        # from the queue and stay in the inbox.
+        speaker.play_local_vox(LocalVox.ReceiveMessage)
+        playing = []
+        for message_id in message_ids:
+            with inbox.open(message_id) as f:
+                message_file = BytesIO(f.read())
+            playing.append(
+                speaker.play(message_file, audio_format=inbox.format(message_id))
+            )
+        led.req(LedPattern.AudioPlaying)
+        for message_id, handle in zip(message_ids, playing):
+            barge_in = await self.play_interruptible(handle)
+            inbox.consume(message_id)
+            if barge_in:
+                speaker.cancel_pending()
+                return True
+        return False
+
+    async def play_interruptible(self, playing: AudioHandle) -> bool:
+        # Return True if the main button was pressed while playing (barge-in).
+        # Playback stops within one chunk; it is not awaited so that the next
+        # recording can start right away.
+        done_task_index = await self.wait_multi_tasks(
+            ct(playing.wait()),
+            ct(self.wait_for_barge_in()),
+        )
+        if done_task_index == 1 and not playing.done():
+            self.logger.info("Barge-in. Stop playing.")
+            playing.stop()
+            return True
+        return False
+
+    async def wait_for_barge_in(self):
+        # Need a new press, not the one that may still be held from before.
+        await button.wait_for_release_main()
+        await button.wait_for_press_main()
+
     async def toggle_mode(self):
         self.logger.info("Toggle mode.")
         if self.mode == Mode.Normal:
             self.logger.info("Switch to message mode.")
             self.mode = Mode.Message
-            messages_mode_message_thread = speaker.play_local_vox(LocalVox.MessagesMode)
-            messages_mode_message_thread.join()
+            await speaker.play_local_vox(LocalVox.MessagesMode)
 
         else:
             self.mode = Mode.Normal
             self.logger.info("Switch to normal mode.")
-            normal_mode_message_thread = speaker.play_local_vox(LocalVox.NormalMode)
-            normal_mode_message_thread.join()
+            await speaker.play_local_vox(LocalVox.NormalMode)
 
-    async def message(self):
+    async def message(self, barge_in: bool = False):
         self.logger.info("Start message mode")
-        what_up_thread = speaker.play_local_vox(LocalVox.WhatUp)
-        what_up_thread.join()
+        if not barge_in:
+            await speaker.play_local_vox(LocalVox.WhatUp)
 
         self.logger.info("Record message to send.")
-        recoard_thread = mic.record()
-        await button.wait_for_release_main()
-        recoard_thread.stop()
-        recoard_thread.join()
-        file = recoard_thread.get_recorded_file()
-        if await api.messages(file):
-            what_happen_thread = speaker.play_local_vox(LocalVox.SendMessage)
-            what_happen_thread.join()
+        with memory.stage("record"):
+            file = await self.record()
+        with memory.stage("api"):
+            is_success = await api.messages(file)
+        file.close()
+        if is_success:
+            await speaker.play_local_vox(LocalVox.SendMessage)
         else:
-            what_happen_thread = speaker.play_local_vox(LocalVox.Fail)
-            what_happen_thread.join()
+            await speaker.play_local_vox(LocalVox.Fail)
 
-    async def normal(self):
-        self.logger.info("Start message mode")
-        playing_what_happen_thread = speaker.play_local_vox(LocalVox.WhatUp)
-        playing_what_happen_thread.join()
-
-        self.logger.info("Record voice.")
-        recoard_thread = mic.record()
-        led.req(LedPattern.AudioRecording)
-        await button.wait_for_release_main()
-        recoard_thread.stop()
-        recoard_thread.join()
-
-        self.logger.info("Check recorded file.")
-        file = recoard_thread.get_recorded_file()
-        audio_seconds = self.get_audio_seconds(file)
-        if audio_seconds is None or audio_seconds < 1:
-            self.logger.info("Inviled recorded file.")
-            speaker_thread = speaker.play_local_vox(LocalVox.Fail)
-            speaker_thread.join()
-            return
-
-        self.logger.info("Call api.normal")
-        received_file = await api.normal(file)
-        if received_file is None:
-            speaker_thread = speaker.play_local_vox(LocalVox.Fail)
-            speaker_thread.join()
-        else:
-            speaker_thread = speaker.play(received_file)
+    async def normal(self, barge_in: bool = False):
+        self.logger.info("Start normal mode")
+        while True:
+            if not barge_in:
+                await speaker.play_local_vox(LocalVox.WhatUp)
+
+            self.logger.info("Record voice.")
+            led.req(LedPattern.AudioRecording)
+            with memory.stage("record"):
+                file = await self.record()
+
+            self.logger.info("Check recorded file.")
+            audio_seconds = self.get_audio_seconds(file)
+            if audio_seconds is None or audio_seconds < 1:
+                self.logger.info("Inviled recorded file.")
+                file.close()
+                await speaker.play_local_vox(LocalVox.Fail)
+                return
+
+            self.logger.info("Call api.normal")
+            started_at = monotonic()  # end of recording
+            responded = asyncio.Event()
+
+            def on_response():
+                responded.set()
+                metrics.histogram(
+                    "api.normal.first_byte_seconds", FIRST_BYTE_BUCKETS
+                ).observe(monotonic() - started_at)
+
+            please_wait = ct(self.please_wait(responded))
+            try:
+                with memory.stage("api"):
+                    response = await api.normal(file, on_response=on_response)
+            except BaseException:
+                # The filler must not start, or go on, over what comes next.
+                self.cancel_please_wait(please_wait)
+                raise
+            finally:
+                file.close()
+            responded.set()
+            filler = await please_wait
+            if response is None:
+                failing = speaker.play_local_vox(LocalVox.Fail)
+                if filler:
+                    filler.stop()
+                await failing
+                return
+
+            # Queue the reply and cut off the filler only once the reply is
+            # converted, so that the stream stays open and the reply follows
+            # without a gap.
+            playing = speaker.play(response.file, audio_format=response.audio_format())
+            metrics.histogram("turn.reply_seconds", FIRST_BYTE_BUCKETS).observe(
+                monotonic() - started_at
+            )
+            if filler:
+                await playing.wait_ready()
+                filler.stop()
             led.req(LedPattern.AudioPlaying)
-            speaker_thread.join()
-
-    def get_audio_seconds(self, audio_file) -> Optional[int]:
+            with memory.stage("play"):
+                barge_in = await self.play_interruptible(playing)
+            if not barge_in:
+                return
+
+    async def please_wait(self, responded: asyncio.Event) -> Optional[AudioHandle]:
+        # Play the please-wait prompt if no reply has started arriving within
+        # PLEASE_WAIT_AFTER. The caller cuts it off when the reply is ready.
+        metrics.counter("please_wait.requests").inc()
+        if PLEASE_WAIT_AFTER <= 0:
+            return None
         try:
-            audio = AudioSegment.from_file(audio_file, "wav")
-            return audio.duration_seconds
-        except PydubException:
-            self.logger.error("Failed to convert recorded audio to AudioSegment.")
+            await asyncio.wait_for(responded.wait(), PLEASE_WAIT_AFTER)
             return None
+        except asyncio.TimeoutError:
+            pass
+        metrics.counter("please_wait.played").inc()
+        self.logger.info(f"Reply is slow. Play please-wait. ({PLEASE_WAIT_AFTER=})")
+        return speaker.play_local_vox(LocalVox.PleaseWait)
+
+    def cancel_please_wait(self, please_wait: asyncio.Task):
+        if not please_wait.done():
+            please_wait.cancel()
+        elif not please_wait.cancelled() and please_wait.result() is not None:
+            please_wait.result().stop()
+
+    async def record(self) -> Spool:
+        # Record until the main button is released or the max duration is hit.
+        recording = mic.record()
+        await self.wait_multi_tasks(
+            ct(button.wait_for_release_main()),
+            ct(recording.wait()),
+        )
+        file = await recording.cancel()
+        tracer.audio("record", file)
+        return file
+
+    def get_audio_seconds(self, audio_file) -> Optional[float]:
+        # Read from the WAV header; no need to decode the whole recording.
+        audio_seconds = wav_seconds(audio_file)
+        if audio_seconds is None:
+            self.logger.error("Failed to read recorded audio header.")
+        return audio_seconds
 
     async def shutdown(self):
         self.logger.info("Shutdown.")
+        if self.boot:
+            self.boot.cancel()
+        wifi.stop_monitoring()
+        await asyncio.to_thread(config.stop_watching)
+        log_shipper.stop()
         led.req(LedPattern.SystemOff)
         await api.stop_listening_notifications()
+        await api.close()
+        audio_worker.stop()
         led.req(LedPattern.SystemTurnOff)
 
     async def wait_multi_tasks(
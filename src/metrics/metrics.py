@@ -0,0 +1,146 @@
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence
+import asyncio
+import threading
+import src.config.config as config
+from src.log.log import log
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LOG_INTERVAL = config.get("metrics_log_interval")
+
+
+class Counter:
+    def __init__(self, lock: threading.Lock):
+        self.lock = lock
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        with self.lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge:
+    def __init__(self, lock: threading.Lock):
+        self.lock = lock
+        self.value: Optional[float] = None
+
+    def set(self, value: float):
+        self.value = value
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram:
+    def __init__(self, lock: threading.Lock, buckets: Sequence[float]):
+        self.lock = lock
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        with self.lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "count": self.count,
+                "sum": self.sum,
+                "max": self.max,
+                "buckets": {
+                    **{str(le): n for le, n in zip(self.buckets, self.counts)},
+                    "+Inf": self.counts[-1],
+                },
+            }
+
+
+MetricListener = Callable[[str, float], None]
+
+
+class Metrics:
+    def __init__(self):
+        self.logger = log.get_logger("Metrics")
+        self.lock = threading.Lock()
+        self.counters: Dict[str, Counter] = {}
+        self.gauges: Dict[str, Gauge] = {}
+        self.histograms: Dict[str, Histogram] = {}
+        self.listeners: List[MetricListener] = []
+        self.log_task: Optional[asyncio.Task] = None
+
+    # Metrics are created from the audio and worker threads too.
+    def counter(self, name: str) -> Counter:
+        with self.lock:
+            if name not in self.counters:
+                self.counters[name] = Counter(self.lock)
+            return self.counters[name]
+
+    def gauge(self, name: str) -> Gauge:
+        with self.lock:
+            if name not in self.gauges:
+                self.gauges[name] = Gauge(self.lock)
+            return self.gauges[name]
+
+    def histogram(self, name: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram(self.lock, buckets)
+            return self.histograms[name]
+
+    def set_gauge(self, name: str, value: float):
+        # Gauges set through here are also pushed to listeners (e.g. progress).
+        self.gauge(name).set(value)
+        for listener in list(self.listeners):
+            listener(name, value)
+
+    def subscribe(self, listener: MetricListener):
+        self.listeners.append(listener)
+
+    def unsubscribe(self, listener: MetricListener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def snapshot(self) -> Dict[str, Dict]:
+        # Histogram.snapshot() takes the lock itself, so only copy under it.
+        with self.lock:
+            counters = list(self.counters.items())
+            gauges = list(self.gauges.items())
+            histograms = list(self.histograms.items())
+        return {
+            "counters": {k: v.snapshot() for k, v in counters},
+            "gauges": {k: v.snapshot() for k, v in gauges},
+            "histograms": {k: v.snapshot() for k, v in histograms},
+        }
+
+    def log_snapshot(self):
+        self.logger.info(f"Metrics. ({self.snapshot()})")
+
+    def start_logging(self):
+        # The snapshot goes to the log file (and with it to the backend, when
+        # log shipping is on) every LOG_INTERVAL.
+        if LOG_INTERVAL <= 0 or self.log_task is not None:
+            return
+        self.log_task = asyncio.create_task(self.run_logging())
+
+    def stop_logging(self):
+        if self.log_task is not None:
+            self.log_task.cancel()
+            self.log_task = None
+            self.log_snapshot()
+
+    async def run_logging(self):
+        while True:
+            await asyncio.sleep(LOG_INTERVAL)
+            self.log_snapshot()
+
+
+metrics = Metrics()
@@ -1,8 +1,8 @@
 from flask import Flask, render_template, request
-from src.log.logger import get_logger
+from src.log.log import log
 import src.setting.wifi as wifi
 
-logger = get_logger("SettingServer")
+logger = log.get_logger("SettingServer")
 
 app = Flask(
     __name__,
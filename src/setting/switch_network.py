@@ -1,35 +1,207 @@
-from subprocess import run
+import asyncio
+import fcntl
+import socket
+import struct
+from time import monotonic
+from typing import Optional
+from src.log.log import log
+from src.util.task_graph import TaskGraph, TaskGraphError
 
 
-def ap():
-    run(["sudo", "systemctl", "stop", "systemd-networkd"])
-    run(["sudo", "systemctl", "stop", "systemd-networkd.socket"])
-    run(["sudo", "systemctl", "stop", "systemd-resolved"])
+# No config here: the setting tools import this module on their own, and
+# config parses the command line at import.
+INTERFACE = "wlan0"
+AP_ADDRESS = "192.168.222.1"
+ROUTE_PATH = "/proc/net/route"
+SIOCGIFADDR = 0x8915
+POLL_INTERVAL = 0.2
+AP_READY_TIMEOUT = 15
+DHCP_TIMEOUT = 40
 
-    run(["sudo", "ip", "addr", "add", "192.168.222.1", "dev", "wlan0"])
-    run(
-        [
-            "sudo",
+logger = log.get_logger("SwitchNetwork")
+
+
+class CommandError(Exception):
+    def __init__(self, cmd, returncode, stderr):
+        self.cmd = cmd
+        self.returncode = returncode
+        self.stderr = stderr
+
+    def __str__(self):
+        return f"{' '.join(self.cmd)} exited with {self.returncode} ({self.stderr})"
+
+
+async def run(*cmd: str, allow_exists: bool = False):
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    _, stderr = await proc.communicate()
+    message = stderr.decode(errors="replace").strip()
+    if proc.returncode != 0:
+        if allow_exists and "File exists" in message:
+            return
+        raise CommandError(cmd, proc.returncode, message)
+
+
+def sudo(*cmd: str, allow_exists: bool = False):
+    return lambda: run("sudo", *cmd, allow_exists=allow_exists)
+
+
+def get_ipv4_address(interface: str = INTERFACE) -> Optional[str]:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        try:
+            ifreq = fcntl.ioctl(
+                s.fileno(), SIOCGIFADDR, struct.pack("256s", interface[:15].encode())
+            )
+        except OSError:
+            return None
+    return socket.inet_ntoa(ifreq[20:24])
+
+
+def has_default_route(interface: str = INTERFACE) -> bool:
+    with open(ROUTE_PATH) as f:
+        for line in f.readlines()[1:]:
+            fields = line.split()
+            if fields[0] == interface and fields[1] == "00000000":
+                return True
+    return False
+
+
+async def is_active(service: str) -> bool:
+    try:
+        await run("systemctl", "is-active", "--quiet", service)
+    except CommandError:
+        return False
+    return True
+
+
+async def poll(name: str, check, timeout: float):
+    started_at = monotonic()
+    while monotonic() - started_at < timeout:
+        if await check():
+            return
+        await asyncio.sleep(POLL_INTERVAL)
+    raise TimeoutError(f"{name} not ready in {timeout}s")
+
+
+def ap_address_ready(interface: str):
+    async def check() -> bool:
+        return get_ipv4_address(interface) == AP_ADDRESS
+
+    return check
+
+
+async def hostapd_ready() -> bool:
+    return await is_active("hostapd")
+
+
+def dhcp_lease_ready(interface: str):
+    async def check() -> bool:
+        address = get_ipv4_address(interface)
+        return (
+            address is not None
+            and address != AP_ADDRESS
+            and has_default_route(interface)
+        )
+
+    return check
+
+
+def ap_graph(interface: str = INTERFACE) -> TaskGraph:
+    graph = TaskGraph("SwitchToAp")
+    graph.add("stop_networkd", sudo("systemctl", "stop", "systemd-networkd"))
+    graph.add(
+        "stop_networkd_socket", sudo("systemctl", "stop", "systemd-networkd.socket")
+    )
+    graph.add("stop_resolved", sudo("systemctl", "stop", "systemd-resolved"))
+    graph.add(
+        "add_address",
+        sudo("ip", "addr", "add", AP_ADDRESS, "dev", interface, allow_exists=True),
+        depends=["stop_networkd", "stop_networkd_socket"],
+    )
+    graph.add(
+        "add_route",
+        sudo(
             "ip",
             "route",
             "add",
             "default",
             "via",
-            "192.168.222.1",
+            AP_ADDRESS,
             "dev",
-            "wlan0",
-        ]
+            interface,
+            allow_exists=True,
+        ),
+        depends=["add_address"],
+    )
+    graph.add(
+        "wait_address",
+        lambda: poll("address", ap_address_ready(interface), AP_READY_TIMEOUT),
+        depends=["add_address"],
+    )
+    graph.add(
+        "start_dnsmasq",
+        sudo("systemctl", "start", "dnsmasq"),
+        depends=["wait_address", "stop_resolved"],
     )
+    graph.add(
+        "start_hostapd",
+        sudo("systemctl", "start", "hostapd"),
+        depends=["wait_address"],
+    )
+    graph.add(
+        "wait_hostapd",
+        lambda: poll("hostapd", hostapd_ready, AP_READY_TIMEOUT),
+        depends=["start_hostapd"],
+    )
+    return graph
+
 
-    run(["sudo", "systemctl", "start", "dnsmasq"])
-    run(["sudo", "systemctl", "start", "hostapd"])
+def client_graph(interface: str = INTERFACE) -> TaskGraph:
+    graph = TaskGraph("SwitchToClient")
+    graph.add("stop_hostapd", sudo("systemctl", "stop", "hostapd"))
+    graph.add("stop_dnsmasq", sudo("systemctl", "stop", "dnsmasq"))
+    graph.add(
+        "flush_address",
+        sudo("ip", "addr", "flush", "dev", interface),
+        depends=["stop_hostapd", "stop_dnsmasq"],
+    )
+    graph.add("netplan_apply", sudo("netplan", "apply"), depends=["flush_address"])
+    graph.add(
+        "start_resolved",
+        sudo("systemctl", "start", "systemd-resolved"),
+        depends=["stop_dnsmasq"],
+    )
+    graph.add(
+        "wait_dhcp_lease",
+        lambda: poll("DHCP lease", dhcp_lease_ready(interface), DHCP_TIMEOUT),
+        depends=["netplan_apply"],
+    )
+    return graph
+
+
+async def switch(graph: TaskGraph, rollback_graph: Optional[TaskGraph]) -> bool:
+    started_at = monotonic()
+    try:
+        timings = await graph.run(raise_on_error=True)
+    except TaskGraphError as e:
+        logger.error(f"Failed to switch network. ({graph.name=}, {e})")
+        if rollback_graph is not None:
+            logger.info(f"Roll back. ({rollback_graph.name=})")
+            await switch(rollback_graph, None)
+        return False
+    logger.info(
+        f"Switched network. ({graph.name=}, total={monotonic() - started_at:.3f}s, {timings=})"
+    )
+    return True
 
 
-def client():
-    run(["sudo", "systemctl", "stop", "hostapd"])
-    run(["sudo", "systemctl", "stop", "dnsmasq"])
+async def ap(interface: str = INTERFACE) -> bool:
+    return await switch(ap_graph(interface), client_graph(interface))
 
-    run(["sudo", "ip", "addr", "flush", "dev", "wlan0"])
 
-    run(["sudo", "netplan", "apply"])
-    run(["sudo", "systemctl", "start", "systemd-resolved"])
+async def client(interface: str = INTERFACE) -> bool:
+    # If the saved network cannot be joined, go back to provisioning.
+    return await switch(client_graph(interface), ap_graph(interface))
@@ -0,0 +1,92 @@
+import mmap
+import tempfile
+from io import BytesIO
+from typing import BinaryIO, Optional
+
+
+class Spool:
+    # File-like buffer that stays in memory up to max_memory bytes and then
+    # moves to a temporary file. view() gives a zero-copy memoryview of the
+    # content (BytesIO buffer or mmap of the temporary file).
+    def __init__(self, max_memory: int, name: str = "spool"):
+        self.max_memory = max_memory
+        self.name = name
+        self.file: BinaryIO = BytesIO()
+        self.rolled = False
+        self.mmap: Optional[mmap.mmap] = None
+
+    def write(self, data) -> int:
+        if not self.rolled and self.file.tell() + len(data) > self.max_memory:
+            self.rollover()
+        return self.file.write(data)
+
+    def rollover(self):
+        memory_file = self.file
+        position = memory_file.tell()
+        file = tempfile.TemporaryFile(prefix=f"futarin-{self.name}-")
+        file.write(memory_file.getbuffer())
+        file.seek(position)
+        memory_file.close()
+        self.file = file
+        self.rolled = True
+
+    def read(self, size: int = -1) -> bytes:
+        return self.file.read(size)
+
+    def readinto(self, buffer) -> int:
+        return self.file.readinto(buffer)
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        return self.file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self.file.tell()
+
+    def flush(self):
+        self.file.flush()
+
+    def size(self) -> int:
+        position = self.file.tell()
+        size = self.file.seek(0, 2)
+        self.file.seek(position)
+        return size
+
+    def readable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    @property
+    def closed(self) -> bool:
+        return self.file.closed
+
+    def view(self) -> memoryview:
+        # Do not write while a view is alive.
+        if not self.rolled:
+            return self.file.getbuffer()
+        if self.mmap is None:
+            self.file.flush()
+            if self.size() == 0:
+                return memoryview(b"")
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self.mmap)
+
+    def close(self):
+        if self.mmap is not None:
+            try:
+                self.mmap.close()
+            except BufferError:
+                # A view is still exported; the mapping is released with it.
+                pass
+            self.mmap = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
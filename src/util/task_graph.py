@@ -0,0 +1,115 @@
+import asyncio
+from time import monotonic
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+from src.log.log import log
+
+
+class TaskGraphError(Exception):
+    def __init__(self, name, cause=None):
+        self.name = name
+        self.cause = cause
+
+    def __str__(self):
+        return f"{self.name} failed ({self.cause!r})"
+
+
+class Node:
+    def __init__(
+        self,
+        name: str,
+        func: Callable[[], Awaitable[Any]],
+        depends: Iterable[str] = (),
+    ):
+        self.name = name
+        self.func = func
+        self.depends: List[str] = list(depends)
+        self.task: Optional[asyncio.Task] = None
+        self.started_at: Optional[float] = None
+        self.elapsed: Optional[float] = None
+        self.ok = False
+
+
+class TaskGraph:
+    def __init__(self, name: str):
+        self.name = name
+        self.logger = log.get_logger(f"TaskGraph.{name}")
+        self.nodes: Dict[str, Node] = {}
+        self.started_at: Optional[float] = None
+
+    def add(
+        self,
+        name: str,
+        func: Callable[[], Awaitable[Any]],
+        depends: Iterable[str] = (),
+    ):
+        for depend in depends:
+            if depend not in self.nodes:
+                raise KeyError(f"{depend} is not found from {self.name}")
+        self.nodes[name] = Node(name, func, depends)
+
+    def start(self):
+        self.started_at = monotonic()
+        for node in self.nodes.values():
+            node.task = asyncio.create_task(self.run_node(node), name=node.name)
+
+    async def run(self, raise_on_error: bool = False) -> Dict[str, Optional[float]]:
+        if self.started_at is None:
+            self.start()
+        tasks = [node.task for node in self.nodes.values() if node.task]
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.report()
+        if raise_on_error:
+            for node in self.nodes.values():
+                if not node.ok:
+                    cause = None
+                    if node.task and not node.task.cancelled():
+                        cause = node.task.exception()
+                    raise TaskGraphError(node.name, cause)
+        return self.timings()
+
+    async def wait_for(self, name: str) -> bool:
+        node = self.nodes[name]
+        if node.task is None:
+            raise RuntimeError(f"{self.name} has not been started")
+        await asyncio.wait([node.task])
+        return node.ok
+
+    async def run_node(self, node: Node):
+        for depend in node.depends:
+            if not await self.wait_for(depend):
+                self.logger.warn(f"Skip {node.name}. ({depend=} failed)")
+                raise TaskGraphError(node.name, f"{depend} failed")
+
+        node.started_at = monotonic()
+        self.logger.debug(f"Start {node.name}.")
+        try:
+            result = await node.func()
+        except asyncio.CancelledError:
+            self.logger.info(f"{node.name} cancelled.")
+            raise
+        except Exception as e:
+            node.elapsed = monotonic() - node.started_at
+            self.logger.error(f"{node.name} failed. ({node.elapsed=:.3f}s, {e=})")
+            raise TaskGraphError(node.name, e) from e
+        node.elapsed = monotonic() - node.started_at
+        node.ok = True
+        self.logger.info(
+            f"{node.name} done. ({node.elapsed=:.3f}s, since start={monotonic() - self.started_at:.3f}s)"
+        )
+        return result
+
+    def cancel(self):
+        for node in self.nodes.values():
+            if node.task and not node.task.done():
+                node.task.cancel()
+
+    def timings(self) -> Dict[str, Optional[float]]:
+        return {name: node.elapsed for name, node in self.nodes.items()}
+
+    def report(self):
+        total = monotonic() - self.started_at if self.started_at else 0
+        summary = ", ".join(
+            f"{name}={'-' if elapsed is None else f'{elapsed:.3f}s'}"
+            for name, elapsed in self.timings().items()
+        )
+        self.logger.info(f"{self.name} finished in {total:.3f}s. ({summary})")
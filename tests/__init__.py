@@ -0,0 +1,51 @@
+# src.config.config parses sys.argv and reads futarin.toml when it is
+# imported, and most modules read their settings at import. The tests get a
+# config of their own, written here before anything from src is imported,
+# and run in a temporary directory so that logs and caches stay out of the
+# tree.
+import json
+import os
+import socket
+import sys
+import tempfile
+from typing import Any, Dict
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def write_config(config_path: str, values: Dict[str, Any]):
+    with open(config_path, "w") as f:
+        for key, value in values.items():
+            f.write(f"{key}={json.dumps(value)}\n")
+
+
+WORK_DIR = tempfile.mkdtemp(prefix="futarin-tests-")
+API_PORT = free_port()
+CONFIG_PATH = os.path.join(WORK_DIR, "futarin.toml")
+CONFIG = {
+    "api_origin": f"http://127.0.0.1:{API_PORT}",
+    "id": 1,
+    "led_server_origin": f"http://127.0.0.1:{free_port()}",
+    "cache_dir": os.path.join(WORK_DIR, "cache"),
+    "upload_part_size": 4096,
+    "message_cache_max_bytes": 64 * 1024,
+    "reply_formats": [],
+    "audio_worker": False,
+    "log_shipping": False,
+}
+
+write_config(CONFIG_PATH, CONFIG)
+sys.path.insert(0, ROOT_DIR)
+os.chdir(WORK_DIR)
+argv = sys.argv
+sys.argv = [argv[0], "--config-file", CONFIG_PATH]
+import src.config.config  # noqa: E402
+
+sys.argv = argv
@@ -0,0 +1,92 @@
+import os
+import unittest
+from unittest.mock import patch
+import src.config.config as config
+from tests import CONFIG, WORK_DIR, write_config
+
+
+class BuildSnapshotTest(unittest.TestCase):
+    def test_defaults_file_and_args(self):
+        snapshot = config.build_snapshot({"delta_volume": -3}, {"skip_introduction": True})
+        self.assertEqual(snapshot.get("delta_volume"), -3)
+        self.assertEqual(snapshot.get("mic_name"), "BY Y02")
+        self.assertTrue(snapshot.get("skip_introduction"))
+        with self.assertRaises(config.ConfigNotSetError):
+            snapshot.get("api_origin")
+
+    def test_store_true_options_from_file(self):
+        # Options not given on the command line must not override the file.
+        from_args = vars(config.get_arg_parser(config.config).parse_args([]))
+        snapshot = config.build_snapshot({"profile": True}, from_args)
+        self.assertTrue(snapshot.get("profile"))
+
+        from_args = vars(config.get_arg_parser(config.config).parse_args(["--profile"]))
+        snapshot = config.build_snapshot({}, from_args)
+        self.assertTrue(snapshot.get("profile"))
+
+    def test_type_check(self):
+        previous = config.build_snapshot({"delta_volume": 2}, {})
+        snapshot = config.build_snapshot(
+            {"delta_volume": "loud", "id": "7", "wifi_sample_interval": 1}, {}, previous
+        )
+        self.assertEqual(snapshot.get("delta_volume"), 2)  # invalid: kept
+        self.assertEqual(snapshot.get("id"), 7)
+        self.assertEqual(snapshot.get("wifi_sample_interval"), 1.0)
+        self.assertEqual(snapshot.version, previous.version + 1)
+
+    def test_immutable(self):
+        with self.assertRaises(TypeError):
+            config.snapshot.values["delta_volume"] = 1
+
+
+class ReloadTest(unittest.TestCase):
+    def setUp(self):
+        self.config_path = os.path.join(WORK_DIR, "reload.toml")
+        write_config(self.config_path, CONFIG)
+        patches = (
+            patch.object(config, "config_file_path", self.config_path),
+            patch.object(config, "snapshot", config.snapshot),
+            patch.object(config, "subscribers", []),
+        )
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+        self.changes = []
+        config.subscribe(lambda snapshot, keys: self.changes.append(keys), ["delta_volume"])
+
+    def test_live_keys_are_applied(self):
+        write_config(self.config_path, {**CONFIG, "delta_volume": -6})
+        config.reload()
+        self.assertEqual(config.get("delta_volume"), -6)
+        self.assertEqual(self.changes, [{"delta_volume"}])
+
+    def test_other_keys_need_restart(self):
+        part_size = config.get("upload_part_size")
+        write_config(self.config_path, {**CONFIG, "upload_part_size": part_size * 2})
+        config.reload()
+        self.assertEqual(config.get("upload_part_size"), part_size)
+        self.assertEqual(self.changes, [])
+
+    def test_removed_key_reverts_to_default(self):
+        write_config(self.config_path, {**CONFIG, "delta_volume": -6})
+        config.reload()
+        write_config(self.config_path, CONFIG)
+        config.reload()
+        self.assertEqual(config.get("delta_volume"), 0)
+
+    def test_broken_file_keeps_config(self):
+        version = config.snapshot.version
+        with open(self.config_path, "w") as f:
+            f.write("delta_volume = = 3\n")
+        config.reload()
+        self.assertEqual(config.snapshot.version, version)
+
+    def test_failing_subscriber(self):
+        def fail(snapshot, keys):
+            raise RuntimeError("subscriber failed")
+
+        config.subscribe(fail, ["delta_volume"])
+        config.subscribe(lambda snapshot, keys: self.changes.append(keys), ["delta_volume"])
+        write_config(self.config_path, {**CONFIG, "delta_volume": 3})
+        config.reload()
+        self.assertEqual(self.changes, [{"delta_volume"}, {"delta_volume"}])
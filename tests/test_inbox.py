@@ -0,0 +1,90 @@
+import os
+import unittest
+from src.audio.codec import ReplyFormat
+from src.backend.inbox import (
+    CACHE_MAX_BYTES,
+    INBOX_FILE_PATH,
+    MAX_DOWNLOAD_ATTEMPTS,
+    Inbox,
+)
+
+
+class InboxTest(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(INBOX_FILE_PATH):
+            os.remove(INBOX_FILE_PATH)
+        self.inbox = Inbox()
+
+    def tearDown(self):
+        for message in self.inbox.pending():
+            self.inbox.consume(message["id"])
+
+    def store(self, message_id: int, size: int):
+        with open(self.inbox.message_path(message_id), "wb") as f:
+            f.write(bytes(size))
+        self.inbox.mark_stored(message_id, ReplyFormat.Opus)
+
+    def test_add_ignores_duplicates(self):
+        self.assertTrue(self.inbox.add(1))
+        self.assertFalse(self.inbox.add(1))
+        self.inbox.consume(1)
+        self.assertFalse(self.inbox.add(1))
+        self.assertEqual(self.inbox.pending(), [])
+
+    def test_persists_across_restarts(self):
+        self.inbox.add(1)
+        self.inbox.add(2)
+        self.store(1, 100)
+
+        self.inbox = Inbox()
+        self.assertEqual(self.inbox.downloaded(), [1])
+        self.assertEqual(self.inbox.not_downloaded(), [2])
+        self.assertEqual(self.inbox.format(1), ReplyFormat.Opus)
+
+    def test_missing_audio_is_downloaded_again(self):
+        self.inbox.add(1)
+        self.store(1, 100)
+        os.remove(self.inbox.message_path(1))
+
+        self.inbox = Inbox()
+        self.assertEqual(self.inbox.not_downloaded(), [1])
+
+    def test_dropped_after_max_attempts(self):
+        self.inbox.add(1)
+        for _ in range(MAX_DOWNLOAD_ATTEMPTS - 1):
+            self.inbox.mark_failed(1)
+        self.assertEqual(self.inbox.not_downloaded(), [1])
+
+        self.inbox = Inbox()  # attempts are persisted
+        self.inbox.mark_failed(1)
+        self.assertEqual(self.inbox.pending(), [])
+        self.assertFalse(self.inbox.add(1))
+
+    def test_stored_resets_attempts(self):
+        self.inbox.add(1)
+        self.inbox.mark_failed(1)
+        self.store(1, 100)
+        self.assertNotIn("attempts", self.inbox.find(1))
+
+    def test_drop(self):
+        self.inbox.add(1)
+        self.store(1, 100)
+        self.inbox.drop(1, "gone")
+        self.assertEqual(self.inbox.pending(), [])
+        self.assertFalse(os.path.exists(self.inbox.message_path(1)))
+
+    def test_cache_limit_keeps_unplayed_audio(self):
+        size = CACHE_MAX_BYTES // 2 + 1
+        for message_id in (1, 2, 3):
+            self.inbox.add(message_id)
+        self.store(1, size)
+        self.assertTrue(self.inbox.has_room())
+        self.store(2, size)
+        self.assertFalse(self.inbox.has_room())
+
+        # Nothing waiting to be played is evicted.
+        self.assertEqual(self.inbox.downloaded(), [1, 2])
+        self.assertTrue(os.path.exists(self.inbox.message_path(1)))
+
+        self.inbox.consume(1)
+        self.assertTrue(self.inbox.has_room())
@@ -0,0 +1,54 @@
+import unittest
+from src.audio.codec import UploadTier, choose_tier
+from src.backend.link import MIN_TRANSFER_SECONDS, SMOOTHING, LinkEstimator
+
+
+class LinkEstimatorTest(unittest.TestCase):
+    def test_first_sample(self):
+        estimator = LinkEstimator()
+        estimator.observe_upload("wlan0", 100_000, 2.0)
+        stats = estimator.get("wlan0")
+        self.assertEqual(stats.throughput, 50_000)
+        self.assertEqual(stats.samples, 1)
+        self.assertIsNone(stats.rtt)
+
+    def test_smoothing(self):
+        estimator = LinkEstimator()
+        estimator.observe_upload("wlan0", 100_000, 1.0)
+        estimator.observe_upload("wlan0", 200_000, 1.0)
+        expected = 100_000 + SMOOTHING * (200_000 - 100_000)
+        self.assertAlmostEqual(estimator.get("wlan0").throughput, expected)
+
+    def test_rtt_is_not_transfer_time(self):
+        estimator = LinkEstimator()
+        estimator.observe_rtt("wlan0", 0.5)
+        estimator.observe_upload("wlan0", 100_000, 1.5)
+        stats = estimator.get("wlan0")
+        self.assertEqual(stats.throughput, 100_000)
+        self.assertAlmostEqual(stats.predict_seconds(200_000), 2.5)
+
+    def test_min_transfer_seconds(self):
+        estimator = LinkEstimator()
+        estimator.observe_rtt("wlan0", 1.0)
+        estimator.observe_upload("wlan0", 1000, 0.5)
+        self.assertEqual(estimator.get("wlan0").throughput, 1000 / MIN_TRANSFER_SECONDS)
+
+    def test_links_are_separate(self):
+        estimator = LinkEstimator()
+        estimator.observe_upload("wlan0", 1000, 1.0)
+        self.assertIsNone(estimator.get("eth0").throughput)
+        self.assertIsNone(estimator.get("eth0").predict_seconds(1000))
+
+
+class ChooseTierTest(unittest.TestCase):
+    def test_without_estimate(self):
+        self.assertEqual(choose_tier(10, None, None, 3.0), UploadTier.Pcm)
+
+    def test_fast_link(self):
+        self.assertEqual(choose_tier(10, 10_000_000, 0.05, 3.0), UploadTier.Pcm)
+
+    def test_slow_links(self):
+        # 10 s of audio in 3 s: 16 kHz mono needs ~107 kB/s, Opus 32k ~13 kB/s.
+        self.assertEqual(choose_tier(10, 120_000, None, 3.0), UploadTier.PcmMono16k)
+        self.assertEqual(choose_tier(10, 20_000, None, 3.0), UploadTier.Opus32k)
+        self.assertEqual(choose_tier(10, 100, None, 3.0), UploadTier.Opus12k)
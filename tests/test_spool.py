@@ -0,0 +1,37 @@
+import unittest
+from src.util.spool import Spool
+
+
+class SpoolTest(unittest.TestCase):
+    def test_stays_in_memory(self):
+        with Spool(1024) as spool:
+            spool.write(b"a" * 1000)
+            self.assertFalse(spool.rolled)
+            self.assertEqual(spool.size(), 1000)
+            self.assertEqual(bytes(spool.view()), b"a" * 1000)
+
+    def test_rolls_over_to_file(self):
+        with Spool(1024) as spool:
+            spool.write(b"a" * 1000)
+            spool.write(b"b" * 1000)
+            self.assertTrue(spool.rolled)
+            self.assertEqual(spool.size(), 2000)
+            self.assertEqual(spool.tell(), 2000)
+            spool.seek(0)
+            self.assertEqual(spool.read(), b"a" * 1000 + b"b" * 1000)
+            self.assertEqual(bytes(spool.view()), b"a" * 1000 + b"b" * 1000)
+
+    def test_empty_view(self):
+        with Spool(0) as spool:
+            spool.write(b"")
+            spool.rollover()
+            self.assertEqual(bytes(spool.view()), b"")
+
+    def test_close_with_live_view(self):
+        spool = Spool(10)
+        spool.write(b"x" * 100)
+        view = spool.view()
+        spool.close()
+        self.assertTrue(spool.closed)
+        self.assertEqual(len(view), 100)
+        view.release()
@@ -0,0 +1,173 @@
+import json
+import os
+import random
+import tempfile
+import threading
+import unittest
+from io import BytesIO
+from werkzeug.serving import make_server
+from src.audio.codec import UploadTier
+from src.backend.api import Api, Endpoint, ResourceGoneError, endpoints
+from src.backend.inbox import inbox
+from src.backend.standin import StandIn, create_app
+from tests import API_PORT, WORK_DIR
+
+
+def recording(app, requests: list):
+    # Keeps (method, path, Range, If-Range) of every request.
+    def wsgi(environ, start_response):
+        requests.append(
+            (
+                environ["REQUEST_METHOD"],
+                environ["PATH_INFO"],
+                environ.get("HTTP_RANGE"),
+                environ.get("HTTP_IF_RANGE"),
+            )
+        )
+        return app(environ, start_response)
+
+    return wsgi
+
+
+class StandInTest(unittest.IsolatedAsyncioTestCase):
+    # Api against the stand-in backend; requests are served one at a time so
+    # that --fail-rate drops the same requests on every run.
+    @classmethod
+    def setUpClass(cls):
+        cls.standin = StandIn(tempfile.mkdtemp(dir=WORK_DIR))
+        cls.requests = []
+        cls.server = make_server(
+            "127.0.0.1", API_PORT, recording(create_app(cls.standin), cls.requests)
+        )
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    async def asyncSetUp(self):
+        random.seed(0)
+        self.standin.fail_rate = 0.0
+        self.requests.clear()
+        self.api = Api()
+        self.data = random.randbytes(40 * 1024 + 123)
+        self.file_path = os.path.join(tempfile.mkdtemp(dir=WORK_DIR), "message.audio")
+
+    async def asyncTearDown(self):
+        await self.api.close()
+
+    def message_endpoint(self, message_id: int) -> str:
+        return f"{endpoints[Endpoint.Messages]}/{message_id}"
+
+    def ranges(self):
+        return [(r[2], r[3]) for r in self.requests if r[0] == "GET"]
+
+    def read(self, file_path: str) -> bytes:
+        with open(file_path, "rb") as f:
+            return f.read()
+
+    async def test_upload_chunked_with_failures(self):
+        self.standin.fail_rate = 0.3
+        response = await self.api.upload_chunked(
+            endpoints[Endpoint.Messages], BytesIO(self.data), UploadTier.Pcm
+        )
+        self.assertIsNotNone(response)
+        message_id = response.json["id"]
+        self.assertEqual(self.read(self.standin.message_path(message_id)), self.data)
+
+        parts = len(range(0, len(self.data), 4096))
+        puts = [r for r in self.requests if r[0] == "PUT"]
+        self.assertGreater(len(puts), parts)  # some were dropped and sent again
+
+    async def test_response_close(self):
+        with await self.api.post(endpoints[Endpoint.WsNegotiate]) as response:
+            self.assertIn("url", response.json)
+        self.assertTrue(response.body.closed)
+
+    async def test_download(self):
+        message_id = self.standin.save_message(self.data)
+        content_type = await self.api.download(
+            self.message_endpoint(message_id), self.file_path
+        )
+        self.assertEqual(content_type, "audio/wav")
+        self.assertEqual(self.read(self.file_path), self.data)
+        self.assertFalse(os.path.exists(f"{self.file_path}.part"))
+        self.assertFalse(os.path.exists(f"{self.file_path}.part.json"))
+
+    async def test_download_resumes_with_range(self):
+        message_id = self.standin.save_message(self.data)
+        endpoint = self.message_endpoint(message_id)
+
+        # Every response is cut off: the download gives up with a part left.
+        self.standin.fail_rate = 1.0
+        self.assertIsNone(await self.api.download(endpoint, self.file_path))
+        part_size = os.path.getsize(f"{self.file_path}.part")
+        self.assertGreater(part_size, 0)
+        with open(f"{self.file_path}.part.json") as f:
+            etag = json.load(f)["etag"]
+
+        # A later call continues from the part with Range and If-Range.
+        self.standin.fail_rate = 0.0
+        self.requests.clear()
+        self.assertIsNotNone(await self.api.download(endpoint, self.file_path))
+        self.assertEqual(self.read(self.file_path), self.data)
+        self.assertEqual(self.ranges(), [(f"bytes={part_size}-", etag)])
+
+    async def test_download_with_failures(self):
+        message_id = self.standin.save_message(self.data)
+        self.standin.fail_rate = 0.5
+        self.assertIsNotNone(
+            await self.api.download(self.message_endpoint(message_id), self.file_path)
+        )
+        self.assertEqual(self.read(self.file_path), self.data)
+        self.assertGreater(len(self.ranges()), 1)
+
+    async def test_download_restarts_on_changed_resource(self):
+        message_id = self.standin.save_message(self.data)
+        with open(f"{self.file_path}.part", "wb") as f:
+            f.write(b"stale" * 100)
+        with open(f"{self.file_path}.part.json", "w") as f:
+            json.dump({"etag": '"stale"', "total": len(self.data)}, f)
+
+        # If-Range does not match: the server sends the whole body.
+        self.assertIsNotNone(
+            await self.api.download(self.message_endpoint(message_id), self.file_path)
+        )
+        self.assertEqual(self.read(self.file_path), self.data)
+        self.assertEqual(self.ranges(), [("bytes=500-", '"stale"')])
+
+    async def test_download_no_longer_wanted(self):
+        message_id = self.standin.save_message(self.data)
+        wanted = [True]
+
+        def on_progress(received, total):
+            wanted[0] = False  # e.g. the message was consumed meanwhile
+
+        self.assertIsNone(
+            await self.api.download(
+                self.message_endpoint(message_id),
+                self.file_path,
+                on_progress,
+                wanted=lambda: wanted[0],
+            )
+        )
+        for suffix in ("", ".part", ".part.json"):
+            self.assertFalse(os.path.exists(f"{self.file_path}{suffix}"))
+
+    async def test_download_gone(self):
+        with self.assertRaises(ResourceGoneError):
+            await self.api.download(self.message_endpoint(9999), self.file_path)
+        self.assertEqual(len(self.ranges()), 1)  # not retried
+
+    async def test_download_messages_skips_gone_message(self):
+        message_id = self.standin.save_message(self.data)
+        inbox.add(9998)
+        inbox.add(message_id)
+        try:
+            self.assertEqual(await self.api.download_messages(), [message_id])
+            self.assertIsNone(inbox.find(9998))
+            with inbox.open(message_id) as f:
+                self.assertEqual(f.read(), self.data)
+        finally:
+            inbox.consume(message_id)
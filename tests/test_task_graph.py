@@ -0,0 +1,78 @@
+import asyncio
+import unittest
+from src.util.task_graph import TaskGraph, TaskGraphError
+
+
+class TaskGraphTest(unittest.IsolatedAsyncioTestCase):
+    async def test_runs_after_dependencies(self):
+        order = []
+
+        def step(name: str, delay: float = 0):
+            async def run():
+                await asyncio.sleep(delay)
+                order.append(name)
+
+            return run
+
+        graph = TaskGraph("Test")
+        graph.add("slow", step("slow", 0.05))
+        graph.add("fast", step("fast"))
+        graph.add("last", step("last"), depends=["slow", "fast"])
+        timings = await graph.run()
+
+        self.assertEqual(order, ["fast", "slow", "last"])
+        self.assertEqual(set(timings), {"slow", "fast", "last"})
+        self.assertTrue(all(elapsed is not None for elapsed in timings.values()))
+
+    async def test_failure_skips_dependents(self):
+        ran = []
+
+        async def fail():
+            raise OSError("no device")
+
+        async def dependent():
+            ran.append("dependent")
+
+        async def independent():
+            ran.append("independent")
+
+        graph = TaskGraph("Test")
+        graph.add("fail", fail)
+        graph.add("dependent", dependent, depends=["fail"])
+        graph.add("independent", independent)
+        timings = await graph.run()
+
+        self.assertEqual(ran, ["independent"])
+        self.assertIsNone(timings["dependent"])
+        self.assertFalse(await graph.wait_for("fail"))
+        self.assertTrue(await graph.wait_for("independent"))
+
+    async def test_raise_on_error(self):
+        async def fail():
+            raise OSError("no device")
+
+        graph = TaskGraph("Test")
+        graph.add("fail", fail)
+        with self.assertRaises(TaskGraphError) as cm:
+            await graph.run(raise_on_error=True)
+        self.assertEqual(cm.exception.name, "fail")
+        self.assertIsInstance(cm.exception.cause, TaskGraphError)
+
+    def test_unknown_dependency(self):
+        async def noop():
+            pass
+
+        graph = TaskGraph("Test")
+        with self.assertRaises(KeyError):
+            graph.add("node", noop, depends=["missing"])
+
+    async def test_cancel(self):
+        async def forever():
+            await asyncio.sleep(60)
+
+        graph = TaskGraph("Test")
+        graph.add("forever", forever)
+        graph.start()
+        await asyncio.sleep(0)
+        graph.cancel()
+        self.assertFalse(await graph.wait_for("forever"))
@@ -0,0 +1,56 @@
+import unittest
+from unittest.mock import patch
+from src.interface.wifi import SMOOTHING, LinkQuality, Wifi, WifiLevel, classify
+
+
+class ClassifyTest(unittest.TestCase):
+    def test_levels(self):
+        self.assertEqual(classify(-55, WifiLevel.Disconnect), WifiLevel.High)
+        self.assertEqual(classify(-65, WifiLevel.Disconnect), WifiLevel.Middle)
+        self.assertEqual(classify(-80, WifiLevel.Disconnect), WifiLevel.Low)
+
+    def test_hysteresis_going_down(self):
+        # Stays until the level is HYSTERESIS below the threshold.
+        self.assertEqual(classify(-62, WifiLevel.High), WifiLevel.High)
+        self.assertEqual(classify(-64, WifiLevel.High), WifiLevel.Middle)
+        self.assertEqual(classify(-72, WifiLevel.Middle), WifiLevel.Middle)
+        self.assertEqual(classify(-74, WifiLevel.Middle), WifiLevel.Low)
+
+    def test_hysteresis_going_up(self):
+        # Moves up only HYSTERESIS above the threshold.
+        self.assertEqual(classify(-68, WifiLevel.Low), WifiLevel.Low)
+        self.assertEqual(classify(-66, WifiLevel.Low), WifiLevel.Middle)
+        self.assertEqual(classify(-58, WifiLevel.Middle), WifiLevel.Middle)
+        self.assertEqual(classify(-56, WifiLevel.Middle), WifiLevel.High)
+
+    def test_hovering_does_not_flap(self):
+        level = WifiLevel.Middle
+        for sample in (-61, -59, -60, -58, -61):
+            level = classify(sample, level)
+            self.assertEqual(level, WifiLevel.Middle)
+
+
+class SampleTest(unittest.TestCase):
+    def sample(self, *qualities: LinkQuality) -> Wifi:
+        wifi = Wifi()
+        with patch("src.interface.wifi.read_link_quality", side_effect=qualities):
+            for _ in qualities:
+                wifi.sample()
+        return wifi
+
+    def test_smoothing(self):
+        wifi = self.sample(LinkQuality(50, -60, -90), LinkQuality(60, -50, -80))
+        self.assertAlmostEqual(wifi.quality.level, -60 + SMOOTHING * 10)
+        self.assertAlmostEqual(wifi.quality.noise, -90 + SMOOTHING * 10)
+
+    def test_noise_reported_later(self):
+        wifi = self.sample(LinkQuality(50, -60, None), LinkQuality(50, -60, -90))
+        self.assertEqual(wifi.quality.noise, -90)
+
+    def test_noise_missing_once(self):
+        wifi = self.sample(
+            LinkQuality(50, -60, -90),
+            LinkQuality(50, -60, None),
+            LinkQuality(50, -60, -80),
+        )
+        self.assertEqual(wifi.quality.noise, -80)